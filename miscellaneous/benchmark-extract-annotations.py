@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+__description__ =\
+"""
+Purpose: Benchmark the per-region latency of extract-annotations.py VCF and GFF queries.
+VCF: regions are queried one at a time (as one script run per region would) and all at once (--regions),
+with the in-process reader (vcf_reader.py) and with bcftools, if it is installed.
+Without --vcf, a synthetic VCF is generated, and bgzip-compressed and tabix-indexed if pysam is installed.
+GFF: the interval index build, indexed queries, a full scan per region as in extract-annotations.py v2.1,
+and attribute parsing are timed on a large GFF3 (synthetic without --gff).
+"""
+__author__ = "Erick Samera"
+__version__ = "1.1.2"
+__comments__ = "stable"
+# --------------------------------------------------
+from argparse import (
+    Namespace,
+    ArgumentParser,
+    RawTextHelpFormatter)
+from pathlib import Path
+# --------------------------------------------------
+import gzip
+import importlib.util
+import random
+import statistics
+import sys
+import tempfile
+import time
+try:
+    import pysam
+except ImportError:
+    pysam = None
+# --------------------------------------------------
+SCRIPT_PATH = Path(__file__).resolve().parent.joinpath('extract-annotations.py')
+# --------------------------------------------------
+def get_args() -> Namespace:
+    """ Get command-line arguments """
+
+    parser = ArgumentParser(
+        description=__description__,
+        epilog=f"v{__version__} : {__author__} | {__comments__}",
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--vcf',
+        type=Path,
+        metavar="<FILE>",
+        default=None,
+        help="VCF file to query, ideally bgzip-compressed with a .tbi/.csi index [default: synthetic VCF]")
+    parser.add_argument('--gff',
+        type=Path,
+        metavar="<FILE>",
+        default=None,
+        help="GFF3 file to query, its interval index is written next to it [default: synthetic GFF3]")
+    parser.add_argument('--only',
+        type=str,
+        choices=['vcf', 'gff'],
+        default=None,
+        help="only run the VCF or the GFF benchmark [default: both]")
+    parser.add_argument('--variants',
+        type=int,
+        metavar="<N>",
+        default=500_000,
+        help="number of variants of the synthetic VCF [default: 500000]")
+    parser.add_argument('--genes',
+        type=int,
+        metavar="<N>",
+        default=200_000,
+        help="number of genes (with an mRNA and 3 exons each) of the synthetic GFF3 [default: 200000]")
+    parser.add_argument('--chromosomes',
+        type=int,
+        metavar="<N>",
+        default=4,
+        help="number of chromosomes of the synthetic VCF/GFF3 [default: 4]")
+    parser.add_argument('--chromosome-length',
+        dest='chromosome_length',
+        type=int,
+        metavar="<N>",
+        default=10_000_000,
+        help="length of each chromosome of the synthetic VCF/GFF3 [default: 10000000]")
+    parser.add_argument('-n', '--regions',
+        type=int,
+        metavar="<N>",
+        default=200,
+        help="number of random regions to query [default: 200]")
+    parser.add_argument('-w', '--width',
+        type=int,
+        metavar="<N>",
+        default=5000,
+        help="width of each region [default: 5000]")
+    parser.add_argument('-r', '--repeats',
+        type=int,
+        metavar="<N>",
+        default=3,
+        help="number of timed runs, the median is reported [default: 3]")
+    parser.add_argument('--seed',
+        type=int,
+        default=0,
+        help="random seed for the synthetic data and regions [default: 0]")
+
+    args = parser.parse_args()
+
+    # parser errors and processing
+    # --------------------------------------------------
+    if args.vcf and not args.vcf.exists(): parser.error(f'ERROR: {args.vcf} does not exist!')
+    if args.gff and not args.gff.exists(): parser.error(f'ERROR: {args.gff} does not exist!')
+    if min(args.variants, args.genes, args.chromosomes, args.chromosome_length, args.regions, args.width, args.repeats) < 1:
+        parser.error('ERROR: numeric options must be positive.')
+
+    return args
+# --------------------------------------------------
+def _load_extract_annotations():
+    """
+    Function imports extract-annotations.py as a module (the file name is not a valid module name).
+    """
+
+    sys.path.insert(0, str(SCRIPT_PATH.parent))
+    spec = importlib.util.spec_from_file_location('extract_annotations', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+def _write_synthetic_vcf(_output_path: Path, _num_variants: int, _num_chromosomes: int, _chromosome_length: int, _seed: int) -> dict:
+    """
+    Function writes a sorted, synthetic VCF file of single nucleotide variants.
+
+    ### Parameters:
+        _output_path: Path
+            path of the VCF file
+        _num_variants: int
+            total number of variants, spread evenly over the chromosomes
+        _num_chromosomes: int
+            number of chromosomes (chr1, chr2, ..)
+        _chromosome_length: int
+            length of each chromosome
+        _seed: int
+            random seed
+
+    ### Returns:
+        (dict) of chromosome lengths.
+    """
+
+    rng = random.Random(_seed)
+    chromosomes: dict = {f'chr{i + 1}': _chromosome_length for i in range(_num_chromosomes)}
+    with open(_output_path, 'w') as output_file:
+        output_file.write('##fileformat=VCFv4.2\n')
+        for chromosome, length in chromosomes.items(): output_file.write(f'##contig=<ID={chromosome},length={length}>\n')
+        output_file.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chromosome, length in chromosomes.items():
+            positions: list = sorted(rng.sample(range(1, length + 1), min(length, _num_variants // _num_chromosomes)))
+            for position in positions:
+                ref, alt = rng.sample('ACGT', 2)
+                rsid: str = f'rs{rng.randrange(1, 10**8)}' if rng.random() < 0.5 else '.'
+                output_file.write(f'{chromosome}\t{position}\t{rsid}\t{ref}\t{alt}\t.\tPASS\t.\n')
+    return chromosomes
+def _write_synthetic_gff(_output_path: Path, _num_genes: int, _num_chromosomes: int, _chromosome_length: int, _seed: int) -> dict:
+    """
+    Function writes a sorted, synthetic GFF3 file of genes, each with one mRNA and three exons.
+    Attribute values contain percent-encoded characters, as in real annotations.
+
+    ### Parameters:
+        _output_path: Path
+            path of the GFF3 file
+        _num_genes: int
+            total number of genes, spread evenly over the chromosomes
+        _num_chromosomes: int
+            number of chromosomes (chr1, chr2, ..)
+        _chromosome_length: int
+            length of each chromosome
+        _seed: int
+            random seed
+
+    ### Returns:
+        (dict) of chromosome lengths.
+    """
+
+    rng = random.Random(_seed)
+    chromosomes: dict = {f'chr{i + 1}': _chromosome_length for i in range(_num_chromosomes)}
+    gene_number: int = 0
+    with open(_output_path, 'w') as output_file:
+        output_file.write('##gff-version 3\n')
+        for chromosome, length in chromosomes.items(): output_file.write(f'##sequence-region {chromosome} 1 {length}\n')
+        for chromosome, length in chromosomes.items():
+            for gene_start in sorted(rng.randrange(1, max(2, length - 10_000)) for _ in range(_num_genes // _num_chromosomes)):
+                gene_number += 1
+                gene_id: str = f'gene{gene_number:07d}'
+                gene_end: int = gene_start + rng.randint(1_000, 10_000)
+                strand: str = rng.choice('+-')
+                output_file.write(f'{chromosome}\tsynthetic\tgene\t{gene_start}\t{gene_end}\t.\t{strand}\t.\tID={gene_id};Name=G{gene_number};Note=putative%20kinase%3B%20family%20{gene_number % 97}\n')
+                output_file.write(f'{chromosome}\tsynthetic\tmRNA\t{gene_start}\t{gene_end}\t.\t{strand}\t.\tID={gene_id}.t1;Parent={gene_id};Dbxref=GO:{rng.randrange(10**7):07d}\n')
+                exon_bounds: list = sorted(rng.sample(range(gene_start, gene_end + 1), 6))
+                for exon_number in range(3):
+                    output_file.write(f'{chromosome}\tsynthetic\texon\t{exon_bounds[2*exon_number]}\t{exon_bounds[2*exon_number+1]}\t.\t{strand}\t.\tID={gene_id}.t1.e{exon_number + 1};Parent={gene_id}.t1\n')
+    return chromosomes
+def _legacy_parse_gff(_input_path: Path, _chromosome: str, _start: int, _end: int) -> list:
+    """
+    Function parses a GFF file for one region as extract-annotations.py v2.1 did: a full scan that splits
+    every line and all of its attributes, as the baseline of the GFF benchmark.
+    """
+
+    list_of_features: list = []
+    with open(_input_path, encoding='utf-8') as input_gff_file:
+        for line in input_gff_file.readlines():
+            if line.startswith('#'): continue
+            line_chr, _, annot_type, line_pos_1, line_pos_2, _, _, _, qualifiers = line.strip().split('\t')
+            line_pos_1: int = int(line_pos_1); line_pos_2: int = int(line_pos_2)
+            if not line_chr == _chromosome: continue
+            if not ((_start < line_pos_1 < _end) or (_start < line_pos_2 < _end)): continue
+            list_of_features.append((annot_type, min(line_pos_1, line_pos_2), {key: value for key, value in [qualifier.split('=') for qualifier in qualifiers.split(';')]}))
+    return list_of_features
+def _read_chromosome_lengths(_input_path: Path) -> dict:
+    """
+    Function finds the chromosomes of a VCF file and their last variant position, as the range to draw regions from.
+    """
+
+    with open(_input_path, 'rb') as input_file: compressed: bool = input_file.read(2) == b'\x1f\x8b'
+    chromosomes: dict = {}
+    with (gzip.open(_input_path, 'rb') if compressed else open(_input_path, 'rb')) as input_file:
+        for line in input_file:
+            if line.startswith(b'#') or not line.strip(): continue
+            chromosome, position = line.split(b'\t', 2)[:2]
+            chromosomes[chromosome.decode()] = max(chromosomes.get(chromosome.decode(), 0), int(position))
+    return chromosomes
+def _random_regions(_chromosomes: dict, _num_regions: int, _width: int, _seed: int) -> list:
+    """
+    Function draws random (chromosome, start, end, name) regions, sorted as extract-annotations.py sorts them.
+    """
+
+    rng = random.Random(_seed)
+    regions: list = []
+    for i in range(_num_regions):
+        chromosome: str = rng.choice(list(_chromosomes))
+        start: int = rng.randint(1, max(1, _chromosomes[chromosome] - _width))
+        regions.append((chromosome, start, start + _width - 1, f'region_{i}'))
+    return sorted(regions, key=lambda region: region[:3])
+def _time_queries(_function, _repeats: int) -> float:
+    """
+    Function returns the median run time (s) of a function.
+    """
+
+    run_times: list = []
+    for _ in range(_repeats):
+        start_time = time.perf_counter()
+        _function()
+        run_times.append(time.perf_counter() - start_time)
+    return statistics.median(run_times)
+def _benchmark_vcf(_extract_annotations, _vcf_path: Path, _backend: str, _regions: list, _repeats: int) -> tuple:
+    """
+    Function times the VCF queries of one file and backend, one region at a time and all regions at once.
+
+    ### Returns:
+        (tuple) of the per-region time (ms) of single-region queries, of a batch query, and the number of variants found.
+    """
+
+    single_time: float = _time_queries(lambda: [_extract_annotations._parse_vcf_regions(_vcf_path, [region], _backend) for region in _regions], _repeats)
+    batch_time: float = _time_queries(lambda: _extract_annotations._parse_vcf_regions(_vcf_path, _regions, _backend), _repeats)
+    num_variants: int = sum(len(features) for features in _extract_annotations._parse_vcf_regions(_vcf_path, _regions, _backend))
+    return (1000 * single_time / len(_regions), 1000 * batch_time / len(_regions), num_variants)
+def _run_vcf_benchmark(_extract_annotations, _temp_dir: Path, args: Namespace) -> None:
+    """
+    Function runs the VCF benchmark and prints its results.
+    """
+
+    vcf_paths: list = []
+    if args.vcf:
+        chromosomes: dict = _read_chromosome_lengths(args.vcf)
+        vcf_paths.append(args.vcf)
+    else:
+        plain_path = _temp_dir.joinpath('synthetic.vcf')
+        print(f'Writing synthetic VCF ({args.variants} variants) ..', file=sys.stderr)
+        chromosomes: dict = _write_synthetic_vcf(plain_path, args.variants, args.chromosomes, args.chromosome_length, args.seed)
+        vcf_paths.append(plain_path)
+        if pysam:
+            # tabix_index compresses a copy of the file, so the plain file is kept for the streaming benchmark
+            vcf_paths.insert(0, Path(pysam.tabix_index(str(plain_path), preset='vcf', keep_original=True, force=True)))
+        else: print('pysam is not installed, so the synthetic VCF is not indexed (streaming only).', file=sys.stderr)
+    regions: list = _random_regions(chromosomes, args.regions, args.width, args.seed)
+
+    backends: list = ['native'] + (['bcftools'] if _extract_annotations._bcftools_installed() else [])
+    if 'bcftools' not in backends: print('bcftools is not installed, only the native reader is benchmarked.', file=sys.stderr)
+
+    print(f'VCF: {len(regions)} regions of {args.width} bp, median of {args.repeats} runs')
+    print('\t'.join(('file', 'backend', 'indexed', 'ms/region (single)', 'ms/region (batch)', 'variants')))
+    for vcf_path in vcf_paths:
+        with _extract_annotations.VcfReader(vcf_path) as vcf_reader: indexed: bool = vcf_reader.indexed
+        for backend in backends:
+            single_ms, batch_ms, num_variants = _benchmark_vcf(_extract_annotations, vcf_path, backend, regions, args.repeats)
+            print('\t'.join((vcf_path.name, backend, str(indexed), f'{single_ms:.3f}', f'{batch_ms:.3f}', str(num_variants))))
+def _run_gff_benchmark(_extract_annotations, _temp_dir: Path, args: Namespace) -> None:
+    """
+    Function runs the GFF benchmark and prints its results.
+    """
+
+    if args.gff: gff_path: Path = args.gff
+    else:
+        gff_path: Path = _temp_dir.joinpath('synthetic.gff3')
+        print(f'Writing synthetic GFF3 ({args.genes} genes) ..', file=sys.stderr)
+        _write_synthetic_gff(gff_path, args.genes, args.chromosomes, args.chromosome_length, args.seed)
+
+    build_time: float = _time_queries(lambda: _extract_annotations._build_gff_index(gff_path), 1)
+    index: dict = _extract_annotations._load_gff_index(gff_path)
+    # regions are drawn up to the last feature end of each chromosome
+    chromosomes: dict = {chromosome: int(index['max_ends'][index['bounds'][i+1] - 1]) for i, chromosome in enumerate(index['chromosomes'].tolist()) if index['bounds'][i+1] > index['bounds'][i]}
+    regions: list = _random_regions(chromosomes, args.regions, args.width, args.seed)
+    # the full scan reads the whole file per region, so it is only timed on a few regions
+    legacy_regions: list = regions[:5]
+
+    single_time: float = _time_queries(lambda: [_extract_annotations._parse_gff_regions(gff_path, [region]) for region in regions], args.repeats)
+    batch_time: float = _time_queries(lambda: _extract_annotations._parse_gff_regions(gff_path, regions), args.repeats)
+    legacy_time: float = _time_queries(lambda: [_legacy_parse_gff(gff_path, *region[:3]) for region in legacy_regions], 1)
+    num_features: int = sum(len(features) for features in _extract_annotations._parse_gff_regions(gff_path, regions))
+
+    # attribute parsing on its own, over the attribute columns of the first 100000 features
+    attribute_columns: list = []
+    with open(gff_path, encoding='utf-8') as input_gff_file:
+        for line in input_gff_file:
+            if line.startswith('#'): continue
+            line_fields: list = line.rstrip('\r\n').split('\t', 8)
+            if len(line_fields) == 9: attribute_columns.append(line_fields[8])
+            if len(attribute_columns) == 100_000: break
+    attribute_time: float = _time_queries(lambda: [_extract_annotations._parse_gff_attributes(attributes) for attributes in attribute_columns], args.repeats)
+    try: legacy_attribute_time: float = _time_queries(lambda: [{key: value for key, value in [qualifier.split('=') for qualifier in attributes.split(';')]} for attributes in attribute_columns], args.repeats)
+    except ValueError: legacy_attribute_time: float = float('nan')
+
+    print(f'GFF: {gff_path.name} ({gff_path.stat().st_size / 1e6:.1f} MB), {len(regions)} regions of {args.width} bp, {num_features} features, median of {args.repeats} runs')
+    print('\t'.join(('query', 'ms/region')))
+    print(f'full scan (v2.1, {len(legacy_regions)} regions)\t{1000 * legacy_time / max(1, len(legacy_regions)):.3f}')
+    print(f'indexed (single)\t{1000 * single_time / len(regions):.3f}')
+    print(f'indexed (batch)\t{1000 * batch_time / len(regions):.3f}')
+    print(f'index build: {build_time:.2f} s (once per GFF file)')
+    print(f'attribute parsing: {1e6 * attribute_time / max(1, len(attribute_columns)):.2f} us/feature, v2.1 split: {1e6 * legacy_attribute_time / max(1, len(attribute_columns)):.2f} us/feature (nan: fails on this file; it does not decode %XX)')
+# --------------------------------------------------
+def main() -> None:
+    """ Insert docstring here """
+
+    args = get_args()
+    extract_annotations = _load_extract_annotations()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if args.only != 'gff': _run_vcf_benchmark(extract_annotations, Path(temp_dir), args)
+        if args.only != 'vcf': _run_gff_benchmark(extract_annotations, Path(temp_dir), args)
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 __description__ =\
 """
-Purpose: Given an input FASTA and region, add annotations from gff and vcf files to produce a GenBank file.
+Purpose: Given an input FASTA and region(s), add annotations from gff and vcf files to produce a GenBank file.
 """
 __author__ = "Erick Samera"
-__version__ = "2.0.0"
+__version__ = "2.6.3"
 __comments__ = "easier to just wrap bcftools"
 # --------------------------------------------------
 from argparse import (
@@ -12,13 +12,32 @@ from argparse import (
     ArgumentParser,
     RawTextHelpFormatter)
 from pathlib import Path
+import io
+import os
 # --------------------------------------------------
 import re
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import unquote
+import numpy as np
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.SeqFeature import SeqFeature, FeatureLocation
+from vcf_reader import VcfReader
+# --------------------------------------------------
+FASTA_INDEX_SUFFIX = '.fai'
+GFF_INDEX_SUFFIX = '.gffidx.npz'
+GFF_INDEX_VERSION = 1
+REGION_PATTERN = re.compile(r"^(.+):(\d+)(?:-|\.\.)(\d+)$")
+# percent-decoding of GFF attributes, cached as encoded values (notes, products) repeat across features
+_unquote_cached = lru_cache(maxsize=1 << 14)(unquote)
 # --------------------------------------------------
 def get_args() -> Namespace:
     """ Get command-line arguments """
@@ -34,7 +53,14 @@ def get_args() -> Namespace:
     parser.add_argument('position',
         metavar="<COORDS>",
         type=str,
+        nargs='?',
+        default=None,
         help="chr:start-end / chr:start..end")
+    parser.add_argument('--regions',
+        type=Path,
+        metavar="<FILE>",
+        default=None,
+        help="BED file (chr, start, end[, name]) or list of chr:start-end regions, one per line,\ninstead of <COORDS>")
     parser.add_argument('--gff',
         type=Path,
         action='append',
@@ -43,32 +69,323 @@ def get_args() -> Namespace:
         type=Path,
         action='append',
         help="input VCF file (multiple accepted)")
+    parser.add_argument('--vcf-backend',
+        dest='vcf_backend',
+        type=str,
+        choices=['auto', 'native', 'bcftools'],
+        default='auto',
+        help="how VCF files are read [default: auto]\nnative: in-process, using the .tbi/.csi index of bgzip VCFs or streaming other VCFs\nbcftools: bcftools view subprocess\nauto: native, and bcftools for .bcf files")
 
     parser.add_argument('--desc',
         type=str,
         metavar="<STR>",
         default="{chromosome}:{start}-{end}",
-        help="edit sequence description [default: {chromosome}:{start}-{end}]\n{chromosome}/{start}/{end} are evaluated as input coords.")
+        help="edit sequence description [default: {chromosome}:{start}-{end}]\n{chromosome}/{start}/{end} are evaluated as input coords, {name} as the BED name.")
+    parser.add_argument('--split-dir',
+        dest='split_dir',
+        type=Path,
+        metavar="<DIR>",
+        default=None,
+        help="write one GenBank file per region into this directory, instead of all records to stdout;\nfiles are named by the BED name, with the coordinates added to names that repeat")
+    parser.add_argument('-t', '--threads',
+        type=int,
+        metavar="<N>",
+        default=4,
+        help="number of GFF/VCF files read at the same time [default: 4]")
 
     args = parser.parse_args()
 
     # parser errors and processing
     # --------------------------------------------------
+    if (args.position is None) == (args.regions is None):
+        parser.error("ERROR: Give either a region (<COORDS>) or a regions file (--regions)")
     # ensure that coords match format
-    if not re.match(r".*:\d+(-|\.\.)\d+", args.position):
+    if args.position and not REGION_PATTERN.match(args.position):
         parser.error("ERROR: Incorrect region format, must be (chr:start-end/chr:start..end)")
-    if not _bcftools_installed(): 
-        parser.error('ERROR: bcftools not installed! Please install it to continue.')
+    if args.regions:
+        try: args.regions = _read_regions(args.regions)
+        except (OSError, ValueError) as error: parser.error(f"ERROR: {error}")
+        if not args.regions: parser.error("ERROR: No regions in the regions file")
+    else: args.regions = [_parse_region(args.position)]
+    if args.threads < 1: parser.error("ERROR: --threads must be at least 1")
+    # regions are handled sorted by chromosome and position, so each annotation file is swept once
+    args.regions.sort(key=lambda region: region[:3])
+    if any(_vcf_backend(vcf, args.vcf_backend) == 'bcftools' for vcf in (args.vcf or [])) and not _bcftools_installed(): 
+        parser.error('ERROR: bcftools not installed! Please install it, or use --vcf-backend native for VCF files.')
 
     return args
 # --------------------------------------------------
-def _parse_gff(_input_path: Path, _chromosome: str, _start: int, _end: int) -> list:
+def _parse_region(_position: str, _name: str = '') -> tuple:
+    """
+    Function parses a chr:start-end / chr:start..end region.
+
+    ### Parameters:
+        _position: str
+            region string
+        _name: str
+            name of the region
+    
+    ### Returns:
+        (tuple) of chromosome, start, end, name.
     """
-    Function parses a GFF file and returns a list of features.
+
+    region_match = REGION_PATTERN.match(_position.strip())
+    if not region_match: raise ValueError(f"Incorrect region format: {_position.strip()}")
+    chromosome, start, end = region_match.groups()
+    return (chromosome, int(start), int(end), _name)
+def _read_regions(_input_path: Path) -> list:
+    """
+    Function reads regions from a BED file (0-based start, end) or a list of chr:start-end regions.
+
+    ### Parameters:
+        _input_path: Path
+            path to the regions file
+    
+    ### Returns:
+        (list) of (chromosome, start, end, name) regions, with 1-based inclusive coordinates.
+    """
+
+    regions: list = []
+    with open(_input_path, encoding='utf-8') as input_regions_file:
+        for line in input_regions_file:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')): continue
+            if '\t' in line:
+                line_fields = line.rstrip('\r\n').split('\t')
+                try: regions.append((line_fields[0], int(line_fields[1]) + 1, int(line_fields[2]), line_fields[3] if len(line_fields) > 3 else ''))
+                except (IndexError, ValueError): raise ValueError(f"Incorrect BED line: {line.strip()}")
+            else:
+                regions.append(_parse_region(line))
+    return regions
+def _regions_per_chromosome(_regions: list) -> dict:
+    """
+    Function groups sorted regions by chromosome, with the running maximum of their ends, to find the
+    regions containing a position with a binary search.
+    """
+
+    regions_per_chromosome: dict = {}
+    for region_index, (chromosome, start, end, _) in enumerate(_regions):
+        starts, max_ends, indices = regions_per_chromosome.setdefault(chromosome, ([], [], []))
+        starts.append(start); indices.append(region_index)
+        max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+    return regions_per_chromosome
+def _regions_containing(_regions: list, _regions_per_chromosome: dict, _chromosome: str, _position: int) -> list:
+    """
+    Function returns the indices of the regions strictly containing a position (start < position < end).
+    """
+
+    if _chromosome not in _regions_per_chromosome: return []
+    starts, max_ends, indices = _regions_per_chromosome[_chromosome]
+    containing: list = []
+    i = bisect_left(starts, _position) - 1
+    while i >= 0 and max_ends[i] > _position:
+        if _regions[indices[i]][2] > _position: containing.append(indices[i])
+        i -= 1
+    return sorted(containing)
+def _build_fasta_index(_input_path: Path) -> dict:
+    """
+    Function reads a FASTA file once and builds a samtools-style index of its sequences: the length, the byte
+    offset of the first base, and the bases and bytes per line of each sequence.
+
+    ### Parameters:
+        _input_path: Path
+            path to the FASTA file
+    
+    ### Returns:
+        (dict) of sequence name to (length, offset, line bases, line bytes), or None if the lines of a sequence
+        have different lengths (the FASTA file can't be indexed).
+    """
+
+    fasta_index: dict = {}
+    name: str = None
+    offset: int = 0
+    with open(_input_path, 'rb') as input_fasta_file:
+        for line in input_fasta_file:
+            offset += len(line)
+            if line.startswith(b'>'):
+                if name is not None: fasta_index[name] = (length, sequence_offset, line_bases, line_bytes)
+                # same record IDs as SeqIO: the first word of the title
+                name = line[1:].decode().split(None, 1)[0] if line[1:].strip() else ''
+                if name in fasta_index: raise ValueError(f"Duplicate sequence name in {_input_path}: {name}")
+                length, sequence_offset, line_bases, line_bytes = 0, offset, 0, 0
+                last_line = False
+                continue
+            if name is None: continue
+
+            bases: int = len(line.rstrip(b'\r\n'))
+            if not bases: last_line = True; continue
+            if last_line: return None
+            if not line_bases: line_bases, line_bytes = bases, len(line)
+            elif bases > line_bases or (bases == line_bases and len(line) != line_bytes): return None
+            # only the last line of a sequence can be shorter
+            if bases < line_bases: last_line = True
+            length += bases
+    if name is not None: fasta_index[name] = (length, sequence_offset, line_bases, line_bytes)
+    return fasta_index
+def _load_fasta_index(_input_path: Path) -> dict:
+    """
+    Function loads the samtools-style index of a FASTA file (<fasta>.fai), and (re)builds it if it doesn't exist
+    or is older than the FASTA file.
+
+    ### Parameters:
+        _input_path: Path
+            path to the FASTA file
+    
+    ### Returns:
+        (dict) of sequence name to (length, offset, line bases, line bytes), or None if the FASTA file can't be indexed.
+    """
+
+    index_path: Path = _input_path.with_name(_input_path.name + FASTA_INDEX_SUFFIX)
+    if index_path.exists() and index_path.stat().st_mtime_ns >= _input_path.stat().st_mtime_ns:
+        try:
+            with open(index_path, encoding='utf-8') as index_file:
+                fasta_index: dict = {line_fields[0]: tuple(int(field) for field in line_fields[1:5]) for line_fields in (line.rstrip('\r\n').split('\t') for line in index_file if line.strip())}
+            # a truncated or damaged index is rebuilt
+            fasta_size: int = _input_path.stat().st_size
+            if all(len(entry) == 4 and entry[3] > entry[2] > 0 and entry[1] + entry[0] <= fasta_size for entry in fasta_index.values()): return fasta_index
+        except (OSError, ValueError): pass
+
+    fasta_index: dict = _build_fasta_index(_input_path)
+    if fasta_index is None:
+        print(f"WARNING: lines of {_input_path} have different lengths, so it can't be indexed; whole sequences are read instead.", file=sys.stderr)
+        return None
+    try: _write_index(index_path, ''.join('\t'.join([name] + [str(field) for field in entry]) + '\n' for name, entry in fasta_index.items()).encode('utf-8'))
+    except OSError: print(f"WARNING: could not write FASTA index {index_path}, the index is rebuilt on every run.", file=sys.stderr)
+    return fasta_index
+def _write_index(_index_path: Path, _data: bytes) -> None:
+    """
+    Function writes an index file to a temporary file in the same directory and then replaces the index with it,
+    so an interrupted write, or another run writing the same index, never leaves a partial index behind.
+
+    ### Parameters:
+        _index_path: Path
+            path to the index file
+        _data: bytes
+            contents of the index file
+    """
+
+    with tempfile.NamedTemporaryFile(dir=_index_path.parent, prefix=_index_path.name + '.', suffix='.partial', delete=False) as temporary_file:
+        try:
+            temporary_file.write(_data)
+            temporary_file.close()
+            os.replace(temporary_file.name, _index_path)
+        except BaseException:
+            os.unlink(temporary_file.name)
+            raise
+def _read_fasta_region(_input_fasta_file, _index_entry: tuple, _start: int, _end: int) -> str:
+    """
+    Function reads a region of a sequence by seeking to its first base, without reading the rest of the sequence.
+
+    ### Parameters:
+        _input_fasta_file:
+            FASTA file opened in binary mode
+        _index_entry: tuple
+            (length, offset, line bases, line bytes) of the sequence
+        _start: int
+            integer genomic start position of target region
+        _end: int
+            integer genomic end position of target region
+    
+    ### Returns:
+        (str) of the bases of the region.
+    """
+
+    length, offset, line_bases, line_bytes = _index_entry
+    start: int = max(_start - 1, 0); end: int = min(_end, length)
+    if start >= end: return ''
+
+    # byte offset of a 0-based position: full lines before it, and its column in its line
+    start_offset: int = offset + (start // line_bases) * line_bytes + start % line_bases
+    end_offset: int = offset + (end // line_bases) * line_bytes + end % line_bases
+    _input_fasta_file.seek(start_offset)
+    return _input_fasta_file.read(end_offset - start_offset).decode().replace('\n', '').replace('\r', '')
+def _build_gff_index(_input_path: Path) -> dict:
+    """
+    Function reads a GFF file once and builds an interval index of its features: per chromosome, the byte
+    offsets of the feature lines sorted by start, with their start, end, and running maximum end.
+
+    ### Parameters:
+        _input_path: Path
+            path to the GFF file
+    
+    ### Returns:
+        (dict) of index arrays.
+    """
+
+    features_per_chromosome: dict = {}
+    offset: int = 0
+    with open(_input_path, 'rb') as input_gff_file:
+        for line in input_gff_file:
+            line_offset = offset
+            offset += len(line)
+            if line.startswith(b'##FASTA'): break
+            if line.startswith(b'#') or not line.strip(): continue
+
+            line_fields = line.split(b'\t', 5)
+            if len(line_fields) < 6: continue
+            try: line_pos_1: int = int(line_fields[3]); line_pos_2: int = int(line_fields[4])
+            except ValueError: continue
+            features_per_chromosome.setdefault(line_fields[0].decode(), []).append((min(line_pos_1, line_pos_2), max(line_pos_1, line_pos_2), line_offset))
+
+    chromosomes: list = sorted(features_per_chromosome)
+    bounds: list = [0]
+    starts, ends, offsets = [], [], []
+    for chromosome in chromosomes:
+        chromosome_features = sorted(features_per_chromosome[chromosome])
+        starts.extend(feature[0] for feature in chromosome_features)
+        ends.extend(feature[1] for feature in chromosome_features)
+        offsets.extend(feature[2] for feature in chromosome_features)
+        bounds.append(len(starts))
+
+    gff_stat = _input_path.stat()
+    index = {
+        'version': np.array(GFF_INDEX_VERSION),
+        'gff_size': np.array(gff_stat.st_size, dtype=np.int64),
+        'gff_mtime': np.array(gff_stat.st_mtime_ns, dtype=np.int64),
+        'chromosomes': np.array(chromosomes, dtype=str),
+        'bounds': np.array(bounds, dtype=np.int64),
+        'starts': np.array(starts, dtype=np.int64),
+        'ends': np.array(ends, dtype=np.int64),
+        'offsets': np.array(offsets, dtype=np.int64)}
+    # running maximum of the ends per chromosome, to find the first feature that can reach a region
+    index['max_ends'] = np.concatenate([np.maximum.accumulate(index['ends'][bounds[i]:bounds[i+1]]) for i in range(len(chromosomes))]) if chromosomes else np.zeros(0, dtype=np.int64)
+    return index
+def _load_gff_index(_input_path: Path) -> dict:
+    """
+    Function loads the interval index of a GFF file (<gff>.gffidx.npz), and (re)builds it if it doesn't exist
+    or the GFF file changed (size or modification time) since it was built.
 
     ### Parameters:
         _input_path: Path
             path to the GFF file
+    
+    ### Returns:
+        (dict) of index arrays.
+    """
+
+    index_path: Path = _input_path.with_name(_input_path.name + GFF_INDEX_SUFFIX)
+    gff_stat = _input_path.stat()
+    if index_path.exists():
+        try:
+            with np.load(index_path) as index_file:
+                index: dict = {key: index_file[key] for key in index_file.files}
+            if index['version'] == GFF_INDEX_VERSION and index['gff_size'] == gff_stat.st_size and index['gff_mtime'] == gff_stat.st_mtime_ns:
+                return index
+        # a truncated or otherwise unreadable index (e.g. zipfile.BadZipFile) is rebuilt
+        except Exception: pass
+
+    index: dict = _build_gff_index(_input_path)
+    index_bytes = io.BytesIO()
+    np.savez(index_bytes, **index)
+    try: _write_index(index_path, index_bytes.getvalue())
+    except OSError: print(f"WARNING: could not write GFF index {index_path}, the index is rebuilt on every run.", file=sys.stderr)
+    return index
+def _query_gff_index(_index: dict, _chromosome: str, _start: int, _end: int) -> np.ndarray:
+    """
+    Function finds the byte offsets of the features that overlap a region, in file order.
+
+    ### Parameters:
+        _index: dict
+            index arrays of the GFF file
         _chromosome: str
             chromosome target region
         _start: int
@@ -77,48 +394,113 @@ def _parse_gff(_input_path: Path, _chromosome: str, _start: int, _end: int) -> l
             integer genomic end position of target region
     
     ### Returns:
-        (list) of features.
+        (np.ndarray) of byte offsets.
     """
 
-    list_of_features: list = []
+    chromosome_index = np.flatnonzero(_index['chromosomes'] == _chromosome)
+    if not chromosome_index.size: return np.zeros(0, dtype=np.int64)
+    lower, upper = _index['bounds'][chromosome_index[0]], _index['bounds'][chromosome_index[0]+1]
 
-    with open(_input_path, encoding='utf-8') as input_gff_file:
-        for line in input_gff_file.readlines():
-            if line.startswith('#'): continue
-            
-            # parse gff file into respective relevant information
-            line_chr, _, annot_type, line_pos_1, line_pos_2, _, line_strand, _, qualifiers = line.strip().split('\t')
-            line_pos_1: int = int(line_pos_1); line_pos_2: int = int(line_pos_2)
-            
-            # skip if not in target region
-            if not line_chr == _chromosome: continue
-            if not ((_start < line_pos_1 < _end) or (_start < line_pos_2 < _end)): continue
+    # features starting before the end of the region, from the first one whose running maximum end reaches the region
+    first = lower + np.searchsorted(_index['max_ends'][lower:upper], _start, side='right')
+    last = lower + np.searchsorted(_index['starts'][lower:upper], _end, side='left')
+    candidates = np.arange(first, max(first, last))
+    candidates = candidates[_index['ends'][candidates] > _start]
+    return np.sort(_index['offsets'][candidates])
+def _parse_gff_attributes(_attributes: str) -> dict:
+    """
+    Function parses the attributes column of a GFF3 line (tag=value;tag=value) into qualifiers.
+    Values may contain '=', empty items (e.g. a trailing ';') are skipped, and percent-encoded characters are decoded.
+    """
 
-            if line_pos_1 < line_pos_2:
-                line_start: int = line_pos_1; line_end: int = line_pos_2; line_strand = +1
-            elif line_pos_1 > line_pos_2:
-                line_start: int = line_pos_2; line_end: int = line_pos_1; line_strand = -1
+    qualifiers: dict = {}
+    for attribute in _attributes.split(';'):
+        key, _, value = attribute.partition('=')
+        key = key.strip()
+        if not key: continue
+        # most values have nothing to decode
+        qualifiers[_unquote_cached(key) if '%' in key else key] = _unquote_cached(value) if '%' in value else value
+    return qualifiers
+def _gff_feature(_line: bytes, _start: int, _end: int) -> SeqFeature:
+    """
+    Function converts a GFF line into a feature relative to a region, or None if it isn't in the region.
+    The coordinates are checked from a partial split of the line, and the rest of the line is only parsed for features in the region.
+    """
 
-            if line_start < _start: line_start = _start
-            if line_end > _end: line_end = _end
+    line_fields: list = _line.split(b'\t', 5)
+    line_pos_1: int = int(line_fields[3]); line_pos_2: int = int(line_fields[4])
 
-            relative_start: int = line_start - _start
-            relative_end: int = line_end - line_start + relative_start + 1
+    # skip if not in target region
+    if not ((_start < line_pos_1 < _end) or (_start < line_pos_2 < _end)): return None
 
-            SeqFeature_to_append = SeqFeature(
-                FeatureLocation(relative_start, relative_end, strand=line_strand),
-                type=annot_type,
-                qualifiers={key: value for key, value in [qualifier.split('=') for qualifier in qualifiers.split(';')]})
-            list_of_features.append(SeqFeature_to_append)
+    line_fields: list = _line.decode('utf-8').rstrip('\r\n').split('\t', 8)
+    annot_type: str = line_fields[2]
+    qualifiers: str = line_fields[8] if len(line_fields) > 8 else ''
+
+    if line_pos_1 < line_pos_2:
+        line_start: int = line_pos_1; line_end: int = line_pos_2; line_strand = +1
+    elif line_pos_1 > line_pos_2:
+        line_start: int = line_pos_2; line_end: int = line_pos_1; line_strand = -1
+    else:
+        # single-base features take the strand column
+        line_start: int = line_pos_1; line_end: int = line_pos_2; line_strand = -1 if len(line_fields) > 6 and line_fields[6] == '-' else +1
+
+    if line_start < _start: line_start = _start
+    if line_end > _end: line_end = _end
+
+    relative_start: int = line_start - _start
+    relative_end: int = line_end - line_start + relative_start + 1
 
-    return list_of_features
-def _parse_vcf(_input_path: Path, _chromosome: str, _start: int, _end: int) -> list:
+    return SeqFeature(
+        FeatureLocation(relative_start, relative_end, strand=line_strand),
+        type=annot_type,
+        qualifiers=_parse_gff_attributes(qualifiers))
+def _parse_gff_regions(_input_path: Path, _regions: list) -> list:
     """
-    Function parses a VCF file and returns a list of features.
+    Function parses a GFF file and returns a list of features per region.
+    Only the lines of features overlapping the regions are read, each once, using the interval index of the GFF file.
 
     ### Parameters:
         _input_path: Path
-            path to the vcf file
+            path to the GFF file
+        _regions: list
+            list of (chromosome, start, end, name) target regions
+    
+    ### Returns:
+        (list) of lists of features, in the order of the regions.
+    """
+
+    features_per_region: list = [[] for _ in _regions]
+    index: dict = _load_gff_index(_input_path)
+
+    # byte offsets of the overlapping lines, and which regions they overlap
+    regions_per_offset: dict = {}
+    for region_index, (chromosome, start, end, _) in enumerate(_regions):
+        for offset in _query_gff_index(index, chromosome, start, end).tolist():
+            regions_per_offset.setdefault(offset, []).append(region_index)
+
+    # read the lines in file order
+    chromosome_prefixes: list = [f'{chromosome}\t'.encode('utf-8') for chromosome, _, _, _ in _regions]
+    with open(_input_path, 'rb') as input_gff_file:
+        for offset in sorted(regions_per_offset):
+            input_gff_file.seek(offset)
+            line: bytes = input_gff_file.readline()
+
+            # parse gff file into respective relevant information, checking the chromosome before splitting the line
+            for region_index in regions_per_offset[offset]:
+                _, start, end, _ = _regions[region_index]
+                if not line.startswith(chromosome_prefixes[region_index]): continue
+                SeqFeature_to_append = _gff_feature(line, start, end)
+                if SeqFeature_to_append: features_per_region[region_index].append(SeqFeature_to_append)
+
+    return features_per_region
+def _parse_gff(_input_path: Path, _chromosome: str, _start: int, _end: int) -> list:
+    """
+    Function parses a GFF file and returns a list of features.
+
+    ### Parameters:
+        _input_path: Path
+            path to the GFF file
         _chromosome: str
             chromosome target region
         _start: int
@@ -130,76 +512,218 @@ def _parse_vcf(_input_path: Path, _chromosome: str, _start: int, _end: int) -> l
         (list) of features.
     """
 
-    list_of_annotations: list = []
+    return _parse_gff_regions(_input_path, [(_chromosome, _start, _end, '')])[0]
+def _merge_regions(_regions: list) -> list:
+    """
+    Function merges overlapping sorted regions, so each position is only read once.
+
+    ### Returns:
+        (list) of (chromosome, start, end) merged regions.
+    """
+
+    merged_regions: list = []
+    for chromosome, start, end, _ in _regions:
+        if merged_regions and merged_regions[-1][0] == chromosome and start <= merged_regions[-1][2]:
+            merged_regions[-1][2] = max(merged_regions[-1][2], end)
+        else: merged_regions.append([chromosome, start, end])
+    return [tuple(region) for region in merged_regions]
+def _vcf_backend(_input_path: Path, _backend: str) -> str:
+    """
+    Function resolves the backend used to read a VCF file: 'auto' reads VCF files natively, and BCF files with bcftools.
+    """
+
+    if _backend == 'auto': return 'bcftools' if _input_path.suffix == '.bcf' else 'native'
+    return _backend
+def _bcftools_records(_input_path: Path, _merged_regions: list) -> list:
+    """
+    Function reads the records of the merged regions of a VCF file with a single bcftools process.
+
+    ### Returns:
+        (list) of records, as lists of fields.
+    """
+
+    region_list: str = ','.join(f'{chromosome}:{start}-{end}' for chromosome, start, end in _merged_regions)
 
     # try random access first
-    command = f'bcftools view --no-header -r {_chromosome}:{_start}-{_end} {_input_path}'
-    bcftools_result = subprocess.run(command, shell=True, capture_output=True)
+    command = ['bcftools', 'view', '--no-header', '-r', region_list, str(_input_path)]
+    bcftools_result = subprocess.run(command, capture_output=True)
 
     # and if not, just do by stream
     if bcftools_result.stderr.decode().strip() == f"Failed to read from {_input_path}: not compressed with bgzip":
-        command = f'bcftools view --no-header -t {_chromosome}:{_start}-{_end} {_input_path}'
-        bcftools_result = subprocess.run(command, shell=True, capture_output=True)
+        command = ['bcftools', 'view', '--no-header', '-t', region_list, str(_input_path)]
+        bcftools_result = subprocess.run(command, capture_output=True)
+
+    return [line.strip().split('\t') for line in bcftools_result.stdout.decode().splitlines() if not line.startswith('#')]
+def _native_records(_input_path: Path, _merged_regions: list) -> list:
+    """
+    Function reads the records of the merged regions of a VCF file in-process: through the .tbi/.csi index
+    for bgzip VCF files that have one, or in a single pass through other VCF files.
+
+    ### Returns:
+        (list) of records, as lists of fields.
+    """
 
-    for line in bcftools_result.stdout.decode().splitlines():
-        if line.startswith('#'): continue
-        
+    with VcfReader(_input_path) as vcf_reader:
+        return [record for region_records in vcf_reader.fetch_regions(_merged_regions) for record in region_records]
+def _parse_vcf_regions(_input_path: Path, _regions: list, _backend: str = 'auto') -> list:
+    """
+    Function parses a VCF file and returns a list of features per region.
+    All regions are read at once, in-process or by a single bcftools process.
+
+    ### Parameters:
+        _input_path: Path
+            path to the vcf file
+        _regions: list
+            list of (chromosome, start, end, name) target regions, sorted
+        _backend: str
+            'auto', 'native' or 'bcftools'
+    
+    ### Returns:
+        (list) of lists of features, in the order of the regions.
+    """
+
+    features_per_region: list = [[] for _ in _regions]
+    regions_per_chromosome: dict = _regions_per_chromosome(_regions)
+    merged_regions: list = _merge_regions(_regions)
+
+    if _vcf_backend(_input_path, _backend) == 'bcftools': records: list = _bcftools_records(_input_path, merged_regions)
+    else: records: list = _native_records(_input_path, merged_regions)
+
+    for record in records:
         # parse vcf file into respective relevant information
-        line_chr, line_pos, rsid, *_ = line.strip().split('\t')
+        line_chr, line_pos, rsid, *_ = record
         line_pos: int = int(line_pos)
 
         # skip if not in target region
-        if not line_chr == _chromosome: continue
-        if not _start < line_pos < _end: continue
-        relative_pos: int = line_pos - _start
+        for region_index in _regions_containing(_regions, regions_per_chromosome, line_chr, line_pos):
+            relative_pos: int = line_pos - _regions[region_index][1]
+
+            SeqFeature_to_append = SeqFeature(
+                        FeatureLocation(relative_pos, relative_pos+1, strand=+1),
+                        type="polymorphism")
+            if rsid.replace('.', ''): SeqFeature_to_append.qualifiers['ID'] = rsid
+            features_per_region[region_index].append(SeqFeature_to_append)
+
+    return features_per_region
+def _parse_vcf(_input_path: Path, _chromosome: str, _start: int, _end: int, _backend: str = 'auto') -> list:
+    """
+    Function parses a VCF file and returns a list of features.
+
+    ### Parameters:
+        _input_path: Path
+            path to the vcf file
+        _chromosome: str
+            chromosome target region
+        _start: int
+            integer genomic start position of target region
+        _end: int
+            integer genomic end position of target region
+        _backend: str
+            'auto', 'native' or 'bcftools'
+    
+    ### Returns:
+        (list) of features.
+    """
 
-        SeqFeature_to_append = SeqFeature(
-                    FeatureLocation(relative_pos, relative_pos+1, strand=+1),
-                    type="polymorphism")
-        if rsid.replace('.', ''): SeqFeature_to_append.qualifiers['ID'] = rsid
-        list_of_annotations.append(SeqFeature_to_append)
+    return _parse_vcf_regions(_input_path, [(_chromosome, _start, _end, '')], _backend)[0]
+def _collect_features(_source: tuple, _regions: list, _vcf_backend: str) -> tuple:
+    """
+    Function parses one annotation file for all of the regions, and times it.
 
-    return list_of_annotations
-def _format_sequence_description(seq_desc_template: str, chromosome: str, start: int, end: int) -> str:
+    ### Parameters:
+        _source: tuple
+            ('gff' or 'vcf', path to the annotation file)
+        _regions: list
+            list of (chromosome, start, end, name) target regions, sorted
+        _vcf_backend: str
+            'auto', 'native' or 'bcftools'
+    
+    ### Returns:
+        (tuple) of the lists of features per region, and the run time in seconds.
+    """
+
+    file_type, input_path = _source
+    start_time: float = time.perf_counter()
+    if file_type == 'gff': features_per_region: list = _parse_gff_regions(input_path, _regions)
+    else: features_per_region: list = _parse_vcf_regions(input_path, _regions, _vcf_backend)
+    return (features_per_region, time.perf_counter() - start_time)
+def _format_sequence_description(seq_desc_template: str, chromosome: str, start: int, end: int, name: str = '') -> str:
+    """
+    Formats the sequence description template with the given chromosome, start, end, and name.
     """
-    Formats the sequence description template with the given chromosome, start, and end.
+    return seq_desc_template.format(chromosome=chromosome, start=start, end=end, name=name)
+def _split_file_names(_regions: list) -> list:
     """
-    return seq_desc_template.format(chromosome=chromosome, start=start, end=end)
+    Function names the GenBank file of each region for --split-dir: the BED name (or the coordinates), with characters
+    that aren't safe in file names replaced. Names that repeat get the coordinates added, and a counter if those repeat too,
+    so no region overwrites the file of another.
+    """
+
+    base_names: list = [re.sub(r'[^\w.-]', '_', name if name else f'{chromosome}_{start}-{end}') for chromosome, start, end, name in _regions]
+    name_counts: dict = {}
+    for base_name in base_names: name_counts[base_name] = name_counts.get(base_name, 0) + 1
+
+    file_names: list = []
+    used_names: set = set()
+    for base_name, (chromosome, start, end, _) in zip(base_names, _regions):
+        file_name: str = base_name if name_counts[base_name] == 1 else re.sub(r'[^\w.-]', '_', f'{base_name}_{chromosome}_{start}-{end}')
+        unique_name, copy_number = file_name, 1
+        while unique_name in used_names:
+            copy_number += 1
+            unique_name = f'{file_name}_{copy_number}'
+        used_names.add(unique_name)
+        file_names.append(f'{unique_name}.gb')
+    return file_names
 def _bcftools_installed() -> bool:
     """
     Check if bcftools is installed.
     """
-    command = 'bcftools'
-    result = subprocess.run(command, shell=True, capture_output=True)
-    if 'bcftools: not found' in result.stderr.decode().strip():
-        return False
-    return True
+    return shutil.which('bcftools') is not None
 # --------------------------------------------------
 def main() -> None:
     """ Main stuff. """
 
     args = get_args()
-    chromosome, start, end = re.split('[:-]|\\.\\.', args.position)
-    start: int = int(start); end: int = int(end)
+    regions: list = args.regions
+
+    # regions are read through the .fai index; FASTA files that can't be indexed are read per sequence
+    fasta_index: dict = _load_fasta_index(args.input_fasta)
+    record_dict = SeqIO.index(str(args.input_fasta), "fasta") if fasta_index is None else None
+
+    # one pass through each annotation file for all of the regions, reading the files in parallel (mostly I/O and bcftools)
+    sources: list = [('gff', annotation) for annotation in (args.gff or [])] + [('vcf', annotation) for annotation in (args.vcf or [])]
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results: list = list(executor.map(lambda source: _collect_features(source, regions, args.vcf_backend), sources))
 
-    record_dict = SeqIO.index(str(args.input_fasta), "fasta")
+    # merged in the order of the sources, then sorted by position; the sort is stable, so ties keep that order
+    features_per_region: list = [[] for _ in regions]
+    for (file_type, annotation), (source_features, run_time) in zip(sources, results):
+        print(f"{annotation} ({file_type}): {sum(len(features) for features in source_features)} features in {run_time:.3f} s", file=sys.stderr)
+        for region_features, features in zip(features_per_region, source_features): region_features.extend(features)
+    for region_features in features_per_region: region_features.sort(key=lambda feature: int(feature.location.start))
 
-    formatted_seq_desc: str = _format_sequence_description(args.seq_desc, chromosome, start, end)
+    if args.split_dir: args.split_dir.mkdir(parents=True, exist_ok=True)
+    split_file_names: list = _split_file_names(regions) if args.split_dir else [None] * len(regions)
+    with open(args.input_fasta, 'rb') as input_fasta_file:
+        for (chromosome, start, end, name), annotations, split_file_name in zip(regions, features_per_region, split_file_names):
+            formatted_seq_desc: str = _format_sequence_description(args.desc, chromosome, start, end, name)
 
-    record_to_print = SeqRecord(
-        Seq(record_dict[chromosome].seq[start-1:end]).upper(),
-        id=chromosome,
-        name="",
-        description=formatted_seq_desc,
-        annotations={"molecule_type": "DNA"}
-    )
+            if fasta_index is None: region_sequence: str = str(record_dict[chromosome].seq[start-1:end])
+            else: region_sequence: str = _read_fasta_region(input_fasta_file, fasta_index[chromosome], start, end)
 
-    annotations: list = []
-    if args.gff: [annotations.extend(_parse_gff(annotation, chromosome, start, end)) for annotation in args.gff]
-    if args.vcf: [annotations.extend(_parse_vcf(annotation, chromosome, start, end)) for annotation in args.vcf]
-    for annotation in annotations: record_to_print.features.append(annotation)
+            record_to_print = SeqRecord(
+                Seq(region_sequence).upper(),
+                id=chromosome,
+                name="",
+                description=formatted_seq_desc,
+                annotations={"molecule_type": "DNA"}
+            )
+            for annotation in annotations: record_to_print.features.append(annotation)
 
-    print(record_to_print.format('gb'))
+            if args.split_dir:
+                with open(args.split_dir.joinpath(split_file_name), mode='w', encoding='utf-8') as output_file:
+                    output_file.write(record_to_print.format('gb'))
+            else: print(record_to_print.format('gb'))
 # --------------------------------------------------
 if __name__ == '__main__':
     main()
@@ -0,0 +1,367 @@
+__description__ =\
+"""
+vcf_reader.py - In-process VCF reader for region queries, without bcftools.
+
+bgzip-compressed VCFs with a tabix (.tbi) or CSI (.csi) index are read by seeking straight to the BGZF
+blocks of a region, using the binning index and (for .tbi) the linear index. Plain and gzip VCFs, and
+bgzip VCFs without an index, are streamed once for all regions.
+
+Classes
+-------
+BgzfReader : random access to the lines of a BGZF file through virtual offsets
+VcfReader : records of a VCF file within regions
+
+Functions
+---------
+reg2bins : bins of the binning index that overlap a region
+"""
+
+__author__  = "Erick Samera"
+__version__ = "1.0.1"
+__comments__ = "stable"
+
+from bisect import bisect_right
+import gzip
+import os
+from pathlib import Path
+import struct
+import zlib
+
+#BGZF block header: gzip header with the 'BC' extra subfield holding the block size
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+_BGZF_HEADER_SIZE = 18
+#Tabix binning scheme
+_TABIX_MIN_SHIFT = 14
+_TABIX_DEPTH = 5
+
+def reg2bins(beg: int, end: int, min_shift: int = _TABIX_MIN_SHIFT, depth: int = _TABIX_DEPTH) -> list:
+    """
+    Bins of the (tabix/CSI) binning index that overlap a region, as in htslib.
+
+    Parameters
+    ----------
+    beg, end : int
+        0-based, half-open region
+    min_shift : int
+        size of the smallest bins (2^min_shift)
+    depth : int
+        number of levels below the root bin
+
+    Return
+    ------
+    bins : list
+        bin numbers
+    """
+    end = max(end, beg + 1) - 1
+    bins = []
+    shift = min_shift + depth * 3
+    level_offset = 0
+    for level in range(depth + 1):
+        bins.extend(range(level_offset + (beg >> shift), level_offset + (end >> shift) + 1))
+        level_offset += 1 << (level * 3)
+        shift -= 3
+    return bins
+
+def is_bgzf(path: Path) -> bool:
+    """Whether a file is BGZF (bgzip) compressed, rather than plain text or plain gzip"""
+    with open(path, 'rb') as input_file:
+        header = input_file.read(_BGZF_HEADER_SIZE)
+    return len(header) == _BGZF_HEADER_SIZE and header[:4] == _BGZF_MAGIC and header[12:14] == b'BC'
+
+class BgzfReader():
+    """
+    BgzfReader - reads lines of a BGZF file from virtual offsets (compressed block offset << 16 |
+    offset within the uncompressed block), decompressing only the blocks that are read.
+
+    Methods
+    -------
+    seek : move to a virtual offset
+    tell : current virtual offset
+    readline : next line (bytes), b'' at the end of the file
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._block_offset = None
+        self._next_block_offset = 0
+        self._data = b''
+        self._position = 0
+
+    def _load_block(self, block_offset: int) -> bool:
+        """Decompress the block at a file offset, False at the end of the file"""
+        if block_offset >= self._size:
+            return False
+        self._file.seek(block_offset)
+        header = self._file.read(_BGZF_HEADER_SIZE)
+        if len(header) < _BGZF_HEADER_SIZE or header[:4] != _BGZF_MAGIC:
+            raise ValueError(f'{self.path} is not BGZF compressed (at offset {block_offset}).')
+        #Total block size - 1 is stored in the BC subfield
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        compressed = self._file.read(block_size - _BGZF_HEADER_SIZE)
+        self._data = zlib.decompress(compressed[:-8], -15)
+        self._block_offset = block_offset
+        self._next_block_offset = block_offset + block_size
+        self._position = 0
+        return True
+
+    def seek(self, virtual_offset: int) -> None:
+        block_offset, position = virtual_offset >> 16, virtual_offset & 0xFFFF
+        if block_offset != self._block_offset:
+            self._load_block(block_offset)
+        self._position = position
+
+    def tell(self) -> int:
+        #At the end of a block, the next read starts at the following block
+        if self._position >= len(self._data):
+            return self._next_block_offset << 16
+        return (self._block_offset << 16) | self._position
+
+    def readline(self) -> bytes:
+        parts = []
+        while True:
+            if self._position >= len(self._data):
+                #Next block; empty blocks (such as the EOF marker) are skipped
+                if not self._load_block(self._next_block_offset):
+                    break
+                continue
+            newline = self._data.find(b'\n', self._position)
+            if newline == -1:
+                parts.append(self._data[self._position:])
+                self._position = len(self._data)
+                continue
+            parts.append(self._data[self._position:newline + 1])
+            self._position = newline + 1
+            break
+        return b''.join(parts)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def _read_tabix_header(data: bytes, offset: int) -> tuple:
+    """
+    Tabix header fields (format, columns, meta character, skipped lines) and sequence names.
+
+    Return
+    ------
+    (header, names, offset) : tuple
+        header dictionary, list of sequence names, offset after the names
+    """
+    file_format, col_seq, col_beg, col_end, meta, skip, names_length = struct.unpack_from('<7i', data, offset)
+    offset += 28
+    names = data[offset:offset + names_length].split(b'\x00')[:-1]
+    offset += names_length
+    header = {'format': file_format, 'col_seq': col_seq, 'col_beg': col_beg, 'col_end': col_end, 'meta': chr(meta), 'skip': skip}
+    return (header, [name.decode() for name in names], offset)
+
+class _RegionIndex():
+    """
+    Binning index of a .tbi or .csi file: per sequence, the chunks of each bin, and (.tbi only) the
+    linear index that gives the lowest virtual offset a region can start at.
+    """
+
+    def __init__(self, index_path: Path) -> None:
+        data = gzip.decompress(index_path.read_bytes())
+        self.references = {}
+        if data[:4] == b'TBI\x01':
+            self.min_shift, self.depth = _TABIX_MIN_SHIFT, _TABIX_DEPTH
+            num_references = struct.unpack_from('<i', data, 4)[0]
+            self.header, names, offset = _read_tabix_header(data, 8)
+            for name in names:
+                bins = {}
+                num_bins = struct.unpack_from('<i', data, offset)[0]
+                offset += 4
+                for _ in range(num_bins):
+                    bin_number, num_chunks = struct.unpack_from('<Ii', data, offset)
+                    offset += 8
+                    bins[bin_number] = (0, struct.unpack_from(f'<{2 * num_chunks}Q', data, offset))
+                    offset += 16 * num_chunks
+                num_intervals = struct.unpack_from('<i', data, offset)[0]
+                offset += 4
+                linear_index = struct.unpack_from(f'<{num_intervals}Q', data, offset)
+                offset += 8 * num_intervals
+                self.references[name] = (bins, linear_index)
+            if len(names) != num_references:
+                raise ValueError(f'{index_path} is not a valid tabix index.')
+        elif data[:4] == b'CSI\x01':
+            self.min_shift, self.depth, aux_length = struct.unpack_from('<3i', data, 4)
+            if aux_length < 28:
+                raise ValueError(f'{index_path} has no sequence names (not a tabix-style CSI index).')
+            self.header, names, _ = _read_tabix_header(data, 16)
+            offset = 16 + aux_length
+            num_references = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            for name in names[:num_references]:
+                bins = {}
+                num_bins = struct.unpack_from('<i', data, offset)[0]
+                offset += 4
+                for _ in range(num_bins):
+                    bin_number, bin_offset, num_chunks = struct.unpack_from('<IQi', data, offset)
+                    offset += 16
+                    bins[bin_number] = (bin_offset, struct.unpack_from(f'<{2 * num_chunks}Q', data, offset))
+                    offset += 16 * num_chunks
+                self.references[name] = (bins, ())
+        else:
+            raise ValueError(f'{index_path} is not a tabix (.tbi) or CSI (.csi) index.')
+
+    def chunks(self, chromosome: str, beg: int, end: int) -> list:
+        """
+        Merged (start, end) virtual offset chunks that can hold records of a 0-based, half-open region.
+        """
+        if chromosome not in self.references:
+            return []
+        bins, linear_index = self.references[chromosome]
+        #Records of the region can't start before the linear index offset of its first interval
+        min_offset = linear_index[min(beg >> self.min_shift, len(linear_index) - 1)] if linear_index else 0
+        chunks = []
+        for bin_number in reg2bins(beg, end, self.min_shift, self.depth):
+            if bin_number not in bins:
+                continue
+            _, bin_chunks = bins[bin_number]
+            for i in range(0, len(bin_chunks), 2):
+                if bin_chunks[i + 1] > min_offset:
+                    chunks.append([max(bin_chunks[i], min_offset), bin_chunks[i + 1]])
+        chunks.sort()
+        merged = []
+        for chunk in chunks:
+            if merged and chunk[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk[1])
+            else:
+                merged.append(chunk)
+        return merged
+
+class VcfReader():
+    """
+    VcfReader - records of a VCF file within regions. Uses the .tbi/.csi index of a bgzip VCF
+    if there is one, otherwise streams the (plain, gzip or bgzip) file.
+
+    Attributes
+    ----------
+    path : path of the VCF file
+    indexed : whether region queries use an index
+
+    Methods
+    -------
+    fetch : records of one region
+    fetch_regions : records of many regions, reading each part of the file once
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._index = None
+        self._bgzf = None
+        if is_bgzf(self.path):
+            for suffix in ('.tbi', '.csi'):
+                index_path = self.path.with_name(self.path.name + suffix)
+                if index_path.exists():
+                    self._index = _RegionIndex(index_path)
+                    self._bgzf = BgzfReader(self.path)
+                    break
+        self.indexed = self._index is not None
+
+    def _open_text(self):
+        with open(self.path, 'rb') as input_file:
+            compressed = input_file.read(2) == b'\x1f\x8b'
+        return gzip.open(self.path, 'rb') if compressed else open(self.path, 'rb')
+
+    def fetch(self, chromosome: str, start: int, end: int) -> list:
+        """
+        Records with a position (POS) in a region.
+
+        Parameters
+        ----------
+        chromosome : str
+            chromosome of the region
+        start, end : int
+            1-based, inclusive region
+
+        Return
+        ------
+        records : list
+            list of the tab-separated fields of each record (str), in file order
+        """
+        return self.fetch_regions([(chromosome, start, end)])[0]
+
+    def fetch_regions(self, regions: list) -> list:
+        """
+        Records with a position (POS) in each of many regions.
+
+        Parameters
+        ----------
+        regions : list
+            (chromosome, start, end) 1-based, inclusive regions
+
+        Return
+        ------
+        records : list
+            list of records (lists of fields) per region, in the order of the regions
+        """
+        records_per_region = [[] for _ in regions]
+        if self.indexed:
+            for region_index, (chromosome, start, end) in enumerate(regions):
+                for line in self._indexed_lines(chromosome, start - 1, end):
+                    line_fields = line.decode().rstrip('\r\n').split('\t')
+                    if line_fields[0] == chromosome and start <= int(line_fields[1]) <= end:
+                        records_per_region[region_index].append(line_fields)
+            return records_per_region
+
+        #Without an index, the whole file is read once for all regions.
+        #The regions of each chromosome are sorted by start, with the running maximum of their ends,
+        #so the regions containing a position are found by bisection instead of checking every region.
+        regions_per_chromosome = {}
+        for region_index, (chromosome, start, end) in enumerate(regions):
+            regions_per_chromosome.setdefault(chromosome.encode(), []).append((start, end, region_index))
+        for chromosome, chromosome_regions in regions_per_chromosome.items():
+            chromosome_regions.sort()
+            max_ends = []
+            for _, end, _ in chromosome_regions:
+                max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+            regions_per_chromosome[chromosome] = ([start for start, _, _ in chromosome_regions], max_ends, chromosome_regions)
+        with self._open_text() as input_file:
+            for line in input_file:
+                if line.startswith(b'#') or not line.strip():
+                    continue
+                chromosome, position = line.split(b'\t', 2)[:2]
+                if chromosome not in regions_per_chromosome:
+                    continue
+                position = int(position)
+                starts, max_ends, chromosome_regions = regions_per_chromosome[chromosome]
+                line_fields = None
+                i = bisect_right(starts, position) - 1
+                while i >= 0 and max_ends[i] >= position:
+                    _, end, region_index = chromosome_regions[i]
+                    if end >= position:
+                        line_fields = line_fields or line.decode().rstrip('\r\n').split('\t')
+                        records_per_region[region_index].append(line_fields)
+                    i -= 1
+        return records_per_region
+
+    def _indexed_lines(self, chromosome: str, beg: int, end: int):
+        """Lines of the index chunks of a 0-based, half-open region"""
+        meta = self._index.header['meta'].encode()
+        for chunk_start, chunk_end in self._index.chunks(chromosome, beg, end):
+            self._bgzf.seek(chunk_start)
+            while self._bgzf.tell() < chunk_end:
+                line = self._bgzf.readline()
+                if not line:
+                    break
+                if line.startswith(meta):
+                    continue
+                yield line
+
+    def close(self) -> None:
+        if self._bgzf:
+            self._bgzf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,223 @@
+__description__ =\
+"""
+abif_reader.py - Minimal reader for ABIF (.ab1) files that only decodes the tags that are asked for.
+
+Biopython's 'abi' format decodes every tag of the file, including all of the trace channels, to build
+'abif_raw'. Most QC only needs a handful of tags, so this reader memory-maps the file, reads the tag
+directory, and decodes single tags on demand. Decoded values are the same as in Biopython's 'abif_raw'
+(e.g. pStrings as bytes, dates as 'YYYY-MM-DD' strings), so the reader can stand in for that dictionary.
+
+Classes
+-------
+AbifReader : lazy, dictionary-like access to the tags of an ABIF file
+
+Functions
+---------
+read_ab1_record : build the same SeqRecord as SeqIO.read(path, 'abi') from the base calls only
+"""
+
+__author__  = "Michael Ke"
+__version__ = "1.0.0"
+__comments__ = "stable"
+
+import datetime
+import mmap
+from pathlib import Path
+import struct
+
+import numpy as np
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+#Header (after the 'ABIF' marker) and directory entry layouts
+_HEADER_FORMAT = '>H4sI2H3I'
+_DIRECTORY_FORMAT = '>4sI2H4I'
+_DIRECTORY_SIZE = struct.calcsize(_DIRECTORY_FORMAT)
+
+#struct formats of the element types, same as Biopython's AbiIO
+_ELEMENT_FORMATS = {
+    1: 'b',  # byte
+    2: 's',  # char
+    3: 'H',  # word
+    4: 'h',  # short
+    5: 'i',  # long
+    7: 'f',  # float
+    8: 'd',  # double
+    10: 'h2B',  # date
+    11: '4B',  # time
+    12: '2i2b',  # thumb
+    13: 'B',  # bool
+    18: 's',  # pString
+    19: 's',  # cString
+}
+
+#NumPy dtypes of the numeric element types, for whole arrays such as trace data
+_ELEMENT_DTYPES = {1: '>i1', 3: '>u2', 4: '>i2', 5: '>i4', 7: '>f4', 8: '>f8'}
+
+class AbifReader():
+    """
+    AbifReader - memory-maps an ABIF file and decodes tags only when they are requested.
+    Tags are keyed like Biopython's 'abif_raw', by tag name and number (e.g. 'TrSc1').
+
+    Attributes
+    ----------
+    path : path of the ABIF file
+    directory : dictionary of tag key to (element type, number of elements, data size, data offset)
+
+    Methods
+    -------
+    get : decoded value of a tag, or a default if the tag is missing
+    array : tag data as a NumPy array, without building Python tuples
+    keys : keys of all tags in the file
+    close : close the memory map and the file
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f'{self.path} is empty.')
+        self._cache = {}
+        try:
+            self.directory = self._read_directory()
+        except (ValueError, struct.error) as error:
+            self.close()
+            raise ValueError(f'{self.path} is not a readable ABIF file: {error}')
+
+    def _read_directory(self) -> dict:
+        """
+        Read the tag directory that the header points to.
+        """
+        if self._data[:4] != b'ABIF':
+            raise ValueError(f'file should start with ABIF, not {self._data[:4]!r}')
+        header = struct.unpack_from(_HEADER_FORMAT, self._data, 4)
+        entry_size, num_entries, directory_offset = header[4], header[5], header[7]
+        if directory_offset + entry_size * num_entries > len(self._data):
+            raise ValueError('tag directory extends past the end of the file')
+
+        directory = {}
+        for index in range(num_entries):
+            entry_offset = directory_offset + index * entry_size
+            name, number, element_type, _, num_elements, data_size, data_offset, _ = struct.unpack_from(
+                _DIRECTORY_FORMAT, self._data, entry_offset)
+            #Data of 4 bytes or less is stored in the directory entry itself
+            if data_size <= 4:
+                data_offset = entry_offset + 20
+            directory[name.decode(errors='replace') + str(number)] = (element_type, num_elements, data_size, data_offset)
+        return directory
+
+    def _raw(self, key: str) -> bytes:
+        element_type, num_elements, data_size, data_offset = self.directory[key]
+        if data_offset + data_size > len(self._data):
+            raise ValueError(f'{self.path}: data of {key} extends past the end of the file')
+        return self._data[data_offset:data_offset + data_size]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.directory
+
+    def __getitem__(self, key: str):
+        if key not in self._cache:
+            self._cache[key] = self._decode(key)
+        return self._cache[key]
+
+    def _decode(self, key: str):
+        """
+        Decode a tag the same way Biopython's AbiIO does.
+        """
+        element_type, num_elements, _, _ = self.directory[key]
+        if element_type not in _ELEMENT_FORMATS:
+            return None
+        element_format = '>' + ('' if num_elements == 1 else str(num_elements)) + _ELEMENT_FORMATS[element_type]
+        raw_data = self._raw(key)
+        if len(raw_data) != struct.calcsize(element_format):
+            raise ValueError(f'{self.path}: unexpected data size for {key}')
+        data = struct.unpack(element_format, raw_data)
+
+        if element_type not in (10, 11) and len(data) == 1:
+            data = data[0]
+        if element_type == 10:
+            return str(datetime.date(*data))
+        elif element_type == 11:
+            return str(datetime.time(*data[:3]))
+        elif element_type == 13:
+            return bool(data)
+        elif element_type == 18:
+            return data[1:]
+        elif element_type == 19:
+            return data[:-1]
+        return data
+
+    def get(self, key: str, default=None):
+        """Decoded value of a tag, or default if the file doesn't have it"""
+        return self[key] if key in self.directory else default
+
+    def array(self, key: str) -> np.ndarray:
+        """
+        Numeric tag data (e.g. trace channels 'DATA9' or peak locations 'PLOC2') as a NumPy
+        array read straight from the memory map.
+
+        Parameters
+        ----------
+        key : str
+            tag key
+
+        Return
+        ------
+        values : np.ndarray
+            the tag's elements, in native byte order
+        """
+        element_type, num_elements, _, _ = self.directory[key]
+        if element_type not in _ELEMENT_DTYPES:
+            raise ValueError(f'{key} is not a numeric tag')
+        values = np.frombuffer(self._raw(key), dtype=_ELEMENT_DTYPES[element_type], count=num_elements)
+        return values.astype(values.dtype.newbyteorder('='))
+
+    def keys(self):
+        return self.directory.keys()
+
+    def close(self) -> None:
+        self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def read_ab1_record(path: Path) -> tuple:
+    """
+    Build the same SeqRecord that SeqIO.read(path, 'abi') returns (minus 'abif_raw'), from
+    the base calls (PBAS2) and qualities (PCON2) only, without decoding the trace data.
+
+    Parameters
+    ----------
+    path : Path
+        path of the .ab1 file
+
+    Return
+    ------
+    (record, abif) : tuple
+        SeqRecord with 'phred_quality', and the open AbifReader for further tag lookups
+        (the caller is responsible for closing it)
+    """
+    path = Path(path)
+    abif = AbifReader(path)
+    if 'PBAS2' not in abif:
+        abif.close()
+        raise ValueError(f'{path} has no base calls (PBAS2).')
+    sample_id = abif.get('SMPL1')
+    record = SeqRecord(
+        Seq(abif['PBAS2'].decode()),
+        id=sample_id.decode(errors='replace') if sample_id is not None else '<unknown id>',
+        name=path.name.replace('.ab1', ''),
+        description='',
+        annotations={'molecule_type': 'DNA'},
+    )
+    qualities = abif.get('PCON2')
+    if qualities:
+        record.letter_annotations['phred_quality'] = list(qualities)
+    return (record, abif)
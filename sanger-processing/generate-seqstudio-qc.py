@@ -4,7 +4,7 @@ __description__ =\
 Purpose: Create a QC .csv file, similar to the SeqStudio.
 """
 __author__ = "Erick Samera"
-__version__ = "1.0.0"
+__version__ = "1.4.1"
 __comments__ = "lmao it works"
 # --------------------------------------------------
 from argparse import (
@@ -12,8 +12,15 @@ from argparse import (
     ArgumentParser,
     RawTextHelpFormatter)
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import sys
 # --------------------------------------------------
-from Bio import SeqIO
+from abif_reader import AbifReader
+# --------------------------------------------------
+MANIFEST_NAME = 'seqstudio-qc-manifest.json'
+MANIFEST_VERSION = 1
 # --------------------------------------------------
 def get_args() -> Namespace:
     """ Get command-line arguments """
@@ -26,12 +33,38 @@ def get_args() -> Namespace:
         'input_path',
         type=Path,
         help="path of directory containing (.ab1) files")
+    parser.add_argument(
+        '-t', '--threads',
+        type=int,
+        default=8,
+        help="number of files read at the same time (default: 8), helps on network shares")
+    parser.add_argument(
+        '-r', '--recursive',
+        action='store_true',
+        help="also search subdirectories for (.ab1) files, e.g. a share of run folders;\nthe .csv of each plate is written to the same subdirectory of the output directory")
+    parser.add_argument(
+        '-o', '--output',
+        dest='output_path',
+        type=Path,
+        default=None,
+        help="directory of the output .csv files (default: parent of the input directory)")
+    parser.add_argument(
+        '-m', '--manifest',
+        dest='manifest_path',
+        type=Path,
+        default=None,
+        help=f"manifest of already processed files, only new or changed files are read (default: {MANIFEST_NAME} in the output directory)")
+    parser.add_argument(
+        '-f', '--force',
+        action='store_true',
+        help="ignore the manifest, read every file and rewrite every plate .csv")
 
     args = parser.parse_args()
 
     # parser errors and processing
     # --------------------------------------------------
     if not args.input_path.is_dir(): parser.error("Input must be a directory!") 
+    if args.threads < 1: parser.error("Number of threads must be at least 1!")
 
     return args
 # --------------------------------------------------
@@ -56,70 +89,209 @@ def _generate_csv(_output_path: Path, _contents: list) -> None:
         for result in sorted(_contents, key=lambda x: x[-1]):
             output_file.write(','.join([str(field) for field in result[:-1]]) +'\n')
     return None
-def _get_values(_path: Path) -> dict:
+def _get_values(_path: Path) -> tuple:
     """
-    Given an .ab1 path, process it and return dictionary of processed data.
+    Given an .ab1 path, process it and return the plate it belongs to and its processed data.
 
     Parameters:
         _path: Path
             path of .ab1 file to process
     
     Returns:
-        (dict)
-            dictionary with key being the plate it belongs to, and tuple of processed data
+        (tuple)
+            plate name, and tuple of processed data
+    """
+
+    # only the QC tags are decoded, the trace data is never read
+    with AbifReader(_path) as seq_object:
+        return _read_values(seq_object, _path.name)
+def _read_values(_seq_object: AbifReader, _file_name: str) -> tuple:
     """
+    Read the plate and processed data of an already open .ab1 file, see _get_values.
+
+    Parameters:
+        _seq_object: AbifReader
+            open .ab1 file
+        _file_name: str
+            name of the .ab1 file
 
-    file_name = _path.name
+    Returns:
+        (tuple)
+            plate name, and tuple of processed data
+    """
 
-    seq_object = SeqIO.read(_path, 'abi').annotations['abif_raw']
-    sample_name = seq_object.get('SMPL1').decode()
-    well_id = seq_object.get('TUBE1').decode()
-    cap_num = seq_object.get('LANE1')
-    median_pup = seq_object.get('PuSc1', 0)
-    trace_score = seq_object.get('TrSc1', 0)
-    crl = seq_object.get('CRLn1', 0)
-    signal_strength = sum(seq_object.get('S/N%1'))/len(seq_object.get('S/N%1'))
-    run_module = seq_object.get('RMdN1').decode()
-    plate_name = seq_object.get('CTNM1').decode()
+    sample_name = _seq_object.get('SMPL1').decode()
+    well_id = _seq_object.get('TUBE1').decode()
+    cap_num = _seq_object.get('LANE1')
+    median_pup = _seq_object.get('PuSc1', 0)
+    trace_score = _seq_object.get('TrSc1', 0)
+    crl = _seq_object.get('CRLn1', 0)
+    signal_strength = sum(_seq_object.get('S/N%1'))/len(_seq_object.get('S/N%1'))
+    run_module = _seq_object.get('RMdN1').decode()
+    plate_name = _seq_object.get('CTNM1').decode()
 
-    runtime = seq_object.get('RUND3').replace('-', '') + seq_object.get('RUNT3').replace(':', '')
+    runtime = _seq_object.get('RUND3').replace('-', '') + _seq_object.get('RUNT3').replace(':', '')
 
-    qc_scores = [seq_object.get(qc_score, b'fail').decode() for qc_score in ('CRLn2', 'QV202', 'TrSc2')]
+    qc_scores = [_seq_object.get(qc_score, b'fail').decode() for qc_score in ('CRLn2', 'QV202', 'TrSc2')]
     if 'fail' in qc_scores: pass_fail = 'fail'
     elif 'check' in qc_scores: pass_fail = 'check'
     else: pass_fail = 'pass'
 
-    return {plate_name: (file_name, sample_name, well_id, cap_num, median_pup, trace_score, crl, signal_strength, run_module, pass_fail, runtime)}
-def _parse_dir(_abi_dir: Path) -> dict:
+    return (plate_name, (_file_name, sample_name, well_id, cap_num, median_pup, trace_score, crl, signal_strength, run_module, pass_fail, runtime))
+def _index_dir(_abi_dir: Path, _recursive: bool = False) -> dict:
     """
-    Parse a directory containing .ab1 files and return a dictionary of data per plate.
+    Find the .ab1 files of a directory (and its subdirectories if recursive) with their size and modification time.
 
     Parameters:
         _abi_dir: Path
             path of directory containing .ab1 files.
-        
+        _recursive: bool
+            whether to search subdirectories (e.g. a share with one folder per run)
+
     Returns:
         (dict)
-            summarized dictionary of .ab1 files per plate.
+            dictionary with key being the path relative to _abi_dir, and tuple of (path, size, mtime in ns)
     """
 
-    csv_dict: dict = {}
-    processed_values = [_get_values(ab1_file) for ab1_file in _abi_dir.glob('*.ab1')]
-    for processed_value in processed_values:
-        key = list(processed_value.keys())[0]
-        if key in csv_dict: csv_dict[key].append([processed_value[key]][0])
-        else:
-            csv_dict[key] = [[processed_value[key]][0]]
-    
-    return csv_dict
+    index: dict = {}
+    for ab1_file in (_abi_dir.rglob('*.ab1') if _recursive else _abi_dir.glob('*.ab1')):
+        try: file_stat = ab1_file.stat()
+        except OSError: continue
+        index[ab1_file.relative_to(_abi_dir).as_posix()] = (ab1_file, file_stat.st_size, file_stat.st_mtime_ns)
+    return index
+def _read_manifest(_manifest_path: Path) -> dict:
+    """
+    Read the manifest of previously processed .ab1 files.
+
+    Parameters:
+        _manifest_path: Path
+            path of the manifest (.json) file
+
+    Returns:
+        (dict)
+            dictionary with key being the relative path of the .ab1 file, and dictionary of size, mtime, plate and row
+            (plate and row are None, and error is set, for files that could not be read).
+            Empty if there is no (readable) manifest; incomplete entries (e.g. a hand-edited manifest) are left out,
+            so their files are read again.
+    """
+
+    try:
+        with open(_manifest_path, mode='r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError): return {}
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION: return {}
+    files = manifest.get('files')
+    if not isinstance(files, dict): return {}
+    def is_complete(_entry) -> bool:
+        if not isinstance(_entry, dict) or not isinstance(_entry.get('size'), int) or not isinstance(_entry.get('mtime'), int): return False
+        if _entry.get('plate') is None: return _entry.get('row') is None
+        return isinstance(_entry.get('plate'), str) and isinstance(_entry.get('row'), list) and len(_entry['row']) == 11
+    return {key: entry for key, entry in files.items() if is_complete(entry)}
+def _write_manifest(_manifest_path: Path, _files: dict) -> None:
+    """
+    Write the manifest of processed .ab1 files, replacing the old one only once it is completely written.
+
+    Parameters:
+        _manifest_path: Path
+            path of the manifest (.json) file
+        _files: dict
+            dictionary with key being the relative path of the .ab1 file, and dictionary of size, mtime, plate and row.
+
+    Returns
+        (None)
+    """
+
+    temp_path = _manifest_path.with_name(_manifest_path.name + '.partial')
+    with open(temp_path, mode='w', encoding='utf-8') as manifest_file:
+        json.dump({'version': MANIFEST_VERSION, 'files': _files}, manifest_file)
+    os.replace(temp_path, _manifest_path)
+    return None
+def _parse_files(_ab1_files: dict, _threads: int = 8) -> tuple:
+    """
+    Process .ab1 files and collect their processed data per plate, as each file is done.
+    Files are read by a pool of threads, since reading run folders on a network share is
+    mostly waiting on I/O. Files that can't be read are skipped instead of stopping the run.
+
+    Parameters:
+        _ab1_files: dict
+            dictionary with key being the relative path, and tuple of (path, size, mtime in ns), as from _index_dir()
+        _threads: int
+            number of files read at the same time
+        
+    Returns:
+        (tuple)
+            dictionary with key being the plate and a list of (relative path, processed data), and a dictionary with
+            key being the relative path and the reason of each skipped file.
+    """
+
+    processed_plates: dict = {}
+    skipped_files: dict = {}
+    with ThreadPoolExecutor(max_workers=_threads) as executor:
+        futures = {executor.submit(_get_values, ab1_file): key for key, (ab1_file, _, _) in _ab1_files.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            # truncated or unreadable files, or files missing one of the required tags
+            try: plate_name, result = future.result()
+            except (OSError, ValueError, AttributeError, TypeError, ZeroDivisionError) as error:
+                skipped_files[key] = f'{type(error).__name__}: {error}'
+                continue
+            processed_plates.setdefault(plate_name, []).append((key, result))
+
+    return processed_plates, skipped_files
+def _plate_csv_path(_output_dir: Path, _key: str, _plate_name: str) -> Path:
+    """
+    Path of the .csv of a plate: in the subdirectory of the output directory matching the (relative) directory
+    of its files, so plates with the same name in different run folders don't end up in one .csv.
+    """
+
+    return _output_dir.joinpath(Path(_key).parent, f'{_plate_name}.csv')
 def main() -> None:
     """ Insert docstring here """
 
     args = get_args()
-    csv_dict: dict = _parse_dir(args.input_path)
-    for key in csv_dict:
-        output_path = args.input_path.parent.joinpath(f'{key}.csv')
-        _generate_csv(output_path, csv_dict[key])
+    output_dir: Path = args.output_path if args.output_path else args.input_path.parent
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path: Path = args.manifest_path if args.manifest_path else output_dir.joinpath(MANIFEST_NAME)
+
+    # only new or changed files (by size and modification time) are opened, the rest come from the manifest
+    index = _index_dir(args.input_path, args.recursive)
+    old_manifest = {} if args.force else _read_manifest(manifest_path)
+    manifest: dict = {}
+    changed_files: dict = {}
+    for key, (ab1_file, size, mtime) in index.items():
+        entry = old_manifest.get(key)
+        if entry and entry.get('size') == size and entry.get('mtime') == mtime: manifest[key] = entry
+        else: changed_files[key] = (ab1_file, size, mtime)
+
+    processed_plates, skipped_files = _parse_files(changed_files, args.threads)
+    for plate_name, plate_results in processed_plates.items():
+        for key, result in plate_results:
+            _, size, mtime = changed_files[key]
+            manifest[key] = {'size': size, 'mtime': mtime, 'plate': plate_name, 'row': list(result)}
+    # unreadable files are recorded too, so they are only retried once they change
+    for key, reason in sorted(skipped_files.items()):
+        print(f"Skipped {key} ({reason})", file=sys.stderr)
+        _, size, mtime = changed_files[key]
+        manifest[key] = {'size': size, 'mtime': mtime, 'plate': None, 'row': None, 'error': reason}
+    num_unreadable = sum(1 for entry in manifest.values() if entry.get('plate') is None)
+
+    # plates gaining, losing or changing a file, or whose .csv is missing
+    changed_plates = {_plate_csv_path(output_dir, key, entry['plate']) for key, entry in old_manifest.items() if manifest.get(key) != entry and entry.get('plate') is not None}
+    changed_plates.update(_plate_csv_path(output_dir, key, entry['plate']) for key, entry in manifest.items() if old_manifest.get(key) != entry and entry.get('plate') is not None)
+    csv_dict: dict = {}
+    for key, entry in manifest.items():
+        if entry.get('plate') is None: continue
+        csv_dict.setdefault(_plate_csv_path(output_dir, key, entry['plate']), []).append(entry['row'])
+    changed_plates.update(output_path for output_path in csv_dict if not output_path.exists())
+
+    for output_path in sorted(changed_plates):
+        if output_path in csv_dict:
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            _generate_csv(output_path, csv_dict[output_path])
+        # every file of the plate was removed
+        elif output_path.exists(): output_path.unlink()
+    _write_manifest(manifest_path, manifest)
+    print(f"{len(changed_files)} new or changed of {len(index)} .ab1 files, {len(changed_plates)} plate(s) updated, {num_unreadable} unreadable file(s)", file=sys.stderr)
 # --------------------------------------------------
 if __name__ == '__main__':
     main()
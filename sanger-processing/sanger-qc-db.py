@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+__description__ =\
+"""
+Purpose: Keep the QC of all Sanger runs in one SQLite database, and query it.
+
+ingest: load SeqStudio QC .csv files (instrument exports or generate-seqstudio-qc.py output)
+        and generate-seqstudio-qc.py manifests into the database
+query:  select QC rows by plate, sample, primer, status and run date, printed as .csv
+
+Rows are keyed by plate name and sample file name, so a plate name reused for another run
+(e.g. a plate layout name used every year) replaces the earlier rows of the same sample files.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.2"
+__comments__ = "stable"
+# --------------------------------------------------
+from argparse import (
+    Namespace,
+    ArgumentParser,
+    RawTextHelpFormatter)
+from pathlib import Path
+from datetime import datetime
+import csv
+import json
+import sqlite3
+import sys
+# --------------------------------------------------
+COLUMNS = ('plate', 'sample_file', 'sample', 'primer', 'well', 'cap', 'median_pup', 'trace_score', 'crl', 'signal_strength', 'run_module', 'pass_fail', 'run_date', 'run_time', 'source')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS qc (
+    plate TEXT NOT NULL,
+    sample_file TEXT NOT NULL,
+    sample TEXT,
+    primer TEXT,
+    well TEXT,
+    cap INTEGER,
+    median_pup REAL,
+    trace_score REAL,
+    crl REAL,
+    signal_strength REAL,
+    run_module TEXT,
+    pass_fail TEXT,
+    run_date TEXT,
+    run_time TEXT,
+    source TEXT,
+    PRIMARY KEY (plate, sample_file));
+CREATE INDEX IF NOT EXISTS qc_plate ON qc (plate);
+CREATE INDEX IF NOT EXISTS qc_sample ON qc (sample);
+CREATE INDEX IF NOT EXISTS qc_primer ON qc (primer, run_date);
+CREATE INDEX IF NOT EXISTS qc_date ON qc (run_date);
+"""
+# --------------------------------------------------
+def get_args() -> Namespace:
+    """ Get command-line arguments """
+
+    parser = ArgumentParser(
+        description=__description__,
+        epilog=f"v{__version__} : {__author__} | {__comments__}",
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        'db_path',
+        type=Path,
+        help="path of the SQLite (.db) QC database, created if it doesn't exist")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_ingest = subparsers.add_parser('ingest', help="load QC .csv files and manifests into the database")
+    parser_ingest.add_argument(
+        'input_paths',
+        type=Path,
+        nargs='+',
+        help="QC (.csv) files, generate-seqstudio-qc.py manifests (.json), or directories of them")
+
+    parser_query = subparsers.add_parser('query', help="print QC rows as .csv")
+    parser_query.add_argument('--plate', type=str, default=None, help="plate name")
+    parser_query.add_argument('--sample', type=str, default=None, help="sample name, * and ? wildcards allowed")
+    parser_query.add_argument('--primer', type=str, default=None, help="primer name")
+    parser_query.add_argument('--status', type=str, choices=['pass', 'check', 'fail'], default=None, help="pass/fail status")
+    parser_query.add_argument('--since', type=str, default=None, help="first run date (YYYY-MM-DD); rows of .csv files without a date line have no run date,\ningest the generate-seqstudio-qc.py manifest for those")
+    parser_query.add_argument('--until', type=str, default=None, help="last run date (YYYY-MM-DD)")
+    parser_query.add_argument('--count', action='store_true', help="only print the number of matching rows")
+
+    args = parser.parse_args()
+
+    # parser errors and processing
+    # --------------------------------------------------
+    if args.command == 'ingest':
+        for input_path in args.input_paths:
+            if not input_path.exists(): parser.error(f"{input_path} does not exist!")
+    if args.command == 'query':
+        if not args.db_path.exists(): parser.error("Database does not exist, ingest QC files first!")
+        for date in (args.since, args.until):
+            if date:
+                try: datetime.strptime(date, '%Y-%m-%d')
+                except ValueError: parser.error(f"{date} is not a YYYY-MM-DD date!")
+
+    return args
+# --------------------------------------------------
+def _connect(_db_path: Path) -> sqlite3.Connection:
+    """
+    Open the QC database and create the table and indexes if needed.
+
+    Parameters:
+        _db_path: Path
+            path of the SQLite database
+
+    Returns:
+        (sqlite3.Connection)
+            connection to the database
+    """
+
+    connection = sqlite3.connect(_db_path)
+    connection.executescript(SCHEMA)
+    return connection
+def _to_number(_value):
+    """ Numeric value of a .csv field, or None if it's empty or not a number """
+
+    try: return float(_value)
+    except (TypeError, ValueError): return None
+def _primer_name(_sample_file: str) -> str:
+    """ Primer name from a sample file name following the <sample>_<primer>_<well>.ab1 convention """
+
+    name_fields = Path(_sample_file).stem.split('_')
+    return name_fields[1] if len(name_fields) > 1 else None
+def _parse_date(_value: str) -> str:
+    """ YYYY-MM-DD date of a date field in one of the formats SeqStudio uses, or None """
+
+    for date_format in ('%Y-%m-%d', '%m/%d/%Y', '%d-%b-%Y', '%Y/%m/%d'):
+        try: return datetime.strptime(_value.strip().split(' ')[0], date_format).strftime('%Y-%m-%d')
+        except ValueError: continue
+    return None
+def _read_qc_csv(_csv_path: Path) -> list:
+    """
+    Read the QC rows of a SeqStudio-like .csv file. The data header ("Sample File Name", "Sample Name", ...) can be
+    preceded by other lines, as in the instrument exports, including the flag table ("Sample File Name", "QC",
+    "Issues"; see fixtures/seqstudio-export-flags.csv), which is skipped as in sanger-qc.py.
+    The plate and run date are taken from "Plate Name" and "... Date" lines before the header if there are any.
+    Otherwise the plate is the file name, and the run date is left empty (with a warning): the modification time
+    of a .csv is not the date of its run. The .csv files of generate-seqstudio-qc.py have no date lines, their
+    manifest has the run dates.
+
+    Parameters:
+        _csv_path: Path
+            path of the QC .csv file
+
+    Returns:
+        (list)
+            list of rows in the order of COLUMNS
+    """
+
+    plate_name = _csv_path.stem
+    run_date = None
+    rows: list = []
+    with open(_csv_path, mode='r', encoding='utf-8-sig', newline='') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        for line in csv_reader:
+            # the flag table also starts with "Sample File Name", only the data header has "Sample Name" next
+            if len(line) > 1 and line[0] == 'Sample File Name' and line[1] == 'Sample Name':
+                header = {column: i for i, column in enumerate(line)}
+                break
+            if len(line) > 1 and line[0].strip() == 'Plate Name' and line[1].strip():
+                plate_name = line[1].strip()
+            if len(line) > 1 and line[0].strip().endswith('Date') and not run_date:
+                run_date = _parse_date(line[1])
+        else: return rows
+
+        def field(_line, _column):
+            return _line[header[_column]] if _column in header and header[_column] < len(_line) else None
+        for line in csv_reader:
+            if not line or not line[0]: continue
+            sample_name = field(line, 'Sample Name') or ''
+            rows.append((
+                plate_name, line[0], sample_name, _primer_name(line[0]), field(line, 'Well ID'),
+                _to_number(field(line, 'Cap#')), _to_number(field(line, 'Median PUP')), _to_number(field(line, 'Trace Score')),
+                _to_number(field(line, 'CRL')), _to_number(field(line, 'Signal Strength')),
+                field(line, 'Run Module'), field(line, 'Pass/Fail'), run_date, None, str(_csv_path)))
+    if rows and not run_date:
+        print(f"WARNING: {_csv_path} has no run date, its rows don't match --since/--until queries.", file=sys.stderr)
+    return rows
+def _read_manifest(_manifest_path: Path) -> list:
+    """
+    Read the QC rows of a generate-seqstudio-qc.py manifest, which includes the run date and time.
+    Files that generate-seqstudio-qc.py couldn't read are recorded without a row, and are left out.
+
+    Parameters:
+        _manifest_path: Path
+            path of the manifest (.json) file
+
+    Returns:
+        (list)
+            list of rows in the order of COLUMNS
+    """
+
+    with open(_manifest_path, mode='r', encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('files'), dict):
+        raise ValueError("not a generate-seqstudio-qc.py manifest")
+
+    rows: list = []
+    for entry in manifest['files'].values():
+        if not isinstance(entry, dict) or not entry.get('row'): continue
+        file_name, sample_name, well_id, cap_num, median_pup, trace_score, crl, signal_strength, run_module, pass_fail, runtime = entry['row']
+        run_date = f"{runtime[0:4]}-{runtime[4:6]}-{runtime[6:8]}" if len(runtime) >= 8 else None
+        run_time = f"{runtime[8:10]}:{runtime[10:12]}:{runtime[12:14]}" if len(runtime) >= 14 else None
+        rows.append((
+            entry['plate'], file_name, sample_name, _primer_name(file_name), well_id, cap_num,
+            median_pup, trace_score, crl, signal_strength, run_module, pass_fail, run_date, run_time, str(_manifest_path)))
+    return rows
+def _ingest(_connection: sqlite3.Connection, _input_paths: list) -> int:
+    """
+    Load QC .csv files and manifests into the database. Rows are keyed by plate and sample file,
+    so ingesting the same file again replaces its rows instead of duplicating them (as does a reused plate name).
+
+    Parameters:
+        _connection: sqlite3.Connection
+            connection to the QC database
+        _input_paths: list
+            QC .csv files, manifests (.json), or directories of them
+
+    Returns:
+        (int)
+            number of rows loaded
+    """
+
+    input_files: list = []
+    for input_path in _input_paths:
+        if input_path.is_dir(): input_files.extend(sorted(file for file in input_path.rglob('*') if file.suffix in ('.csv', '.json')))
+        else: input_files.append(input_path)
+
+    insert = f"INSERT OR REPLACE INTO qc ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+    num_rows = 0
+    # one transaction for all of the files
+    with _connection:
+        for input_file in input_files:
+            try: rows = _read_manifest(input_file) if input_file.suffix == '.json' else _read_qc_csv(input_file)
+            except (OSError, ValueError, KeyError, TypeError, UnicodeDecodeError) as error:
+                print(f"Skipped {input_file} ({type(error).__name__}: {error})", file=sys.stderr)
+                continue
+            _connection.executemany(insert, rows)
+            num_rows += len(rows)
+    return num_rows
+def _query(_connection: sqlite3.Connection, _args: Namespace) -> list:
+    """
+    Select QC rows matching the query options.
+
+    Parameters:
+        _connection: sqlite3.Connection
+            connection to the QC database
+        _args: Namespace
+            query options (plate, sample, primer, status, since, until)
+
+    Returns:
+        (list)
+            list of matching rows in the order of COLUMNS, by run date, plate and well
+    """
+
+    conditions: list = []
+    parameters: list = []
+    if _args.plate: conditions.append("plate = ?"); parameters.append(_args.plate)
+    if _args.sample: conditions.append("sample GLOB ?"); parameters.append(_args.sample)
+    if _args.primer: conditions.append("primer = ?"); parameters.append(_args.primer)
+    if _args.status: conditions.append("pass_fail = ?"); parameters.append(_args.status)
+    if _args.since: conditions.append("run_date >= ?"); parameters.append(_args.since)
+    if _args.until: conditions.append("run_date <= ?"); parameters.append(_args.until)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    return _connection.execute(f"SELECT {', '.join(COLUMNS)} FROM qc{where} ORDER BY run_date, plate, well", parameters).fetchall()
+def main() -> None:
+    """ Ingest QC files into, or query, the QC database """
+
+    args = get_args()
+    connection = _connect(args.db_path)
+    try:
+        if args.command == 'ingest':
+            num_rows = _ingest(connection, args.input_paths)
+            print(f"Loaded {num_rows} QC rows into {args.db_path}", file=sys.stderr)
+        elif args.command == 'query':
+            rows = _query(connection, args)
+            if args.count: print(len(rows))
+            else:
+                csv_writer = csv.writer(sys.stdout)
+                csv_writer.writerow(COLUMNS)
+                csv_writer.writerows(rows)
+    finally:
+        connection.close()
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
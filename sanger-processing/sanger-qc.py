@@ -1,30 +1,88 @@
 import csv
+import glob
 import pathlib
 import argparse
 
-def check_scores(pup_score, trace_score, min_pup_score, min_trace_score):
-    if (int(pup_score) >= min_pup_score) and (int(trace_score) >= min_trace_score):
+#Data headers:
+#Sample File Name, Sample Name, Well ID, Cap#, Median PUP, Trace Score, CRL, Signal Strength
+DATA_HEADER = 'Sample File Name'
+REPORT_COLUMNS = ('Sample Name', 'Median PUP', 'Trace Score', 'CRL', 'Signal Strength')
+
+def compile_rules(min_pup_score, min_trace_score, min_crl=None, min_signal=None):
+    """
+    Compile the QC thresholds into (column name, minimum) rules, leaving out thresholds that are not set.
+    """
+    thresholds = (('Median PUP', min_pup_score), ('Trace Score', min_trace_score), ('CRL', min_crl), ('Signal Strength', min_signal))
+    return [(column, minimum) for column, minimum in thresholds if minimum is not None]
+
+def bind_rules(rules, header):
+    """
+    Resolve the rule columns to their positions in a header row, once per QC file.
+    Returns a function that checks a data row against all rules.
+    """
+    try:
+        bound_rules = [(header.index(column), minimum) for column, minimum in rules]
+    except ValueError as error:
+        raise ValueError(f'QC file is missing a column needed by the rules ({error})')
+    def check_scores(row):
+        for index, minimum in bound_rules:
+            try:
+                if float(row[index]) < minimum:
+                    return False
+            #Missing or empty scores do not pass
+            except (IndexError, ValueError):
+                return False
         return True
-    else: 
-        return False
+    return check_scores
 
-def parse_args(): 
+def stream_qc_rows(qc_path):
     """
-    Arguments: 
-    1) qc_data - path to the qc .csv file
-    2) ab1_path: path to all of the ab1 files
+    Yields (header, row) for each data row of a SeqStudio QC .csv file.
+    Rows before the data header (flag headers: Sample File Name, QC, Issues) are skipped while reading.
+    """
+    with open(qc_path, 'r', newline='', encoding='utf-8-sig') as qc_file:
+        qc_reader = csv.reader(qc_file)
+        header = None
+        for row in qc_reader:
+            if not row or not row[0]:
+                continue
+            #Find data header row; the flag header table also starts with Sample File Name, so the last one is used
+            if row[0] == DATA_HEADER:
+                header = row
+                continue
+            if header is not None and len(header) > 1 and header[1] == 'Sample Name':
+                yield (header, row)
+
+def expand_paths(qc_paths):
+    """
+    Expands glob patterns (e.g. 'runs/*/*.csv') in the given paths; paths without wildcards are kept as is.
+    """
+    expanded_paths = []
+    for qc_path in qc_paths:
+        if glob.has_magic(str(qc_path)):
+            expanded_paths.extend(sorted(pathlib.Path(path) for path in glob.glob(str(qc_path), recursive=True)))
+        else:
+            expanded_paths.append(qc_path)
+    return expanded_paths
+
+def parse_args():
+    """
+    Arguments:
+    1) qc_paths - paths (or glob patterns) of the qc .csv files
+    2) rule thresholds and the output path
     """
     parser = argparse.ArgumentParser(description='Automated QC of sanger electropherograms.')
     parser.add_argument(
-        'qc_path',
+        'qc_paths',
         action='store',
-        type=pathlib.Path, 
-        help='Path to QC .csv file generated by the SeqStudio' 
+        type=pathlib.Path,
+        nargs='+',
+        help='Paths to QC .csv files generated by the SeqStudio; glob patterns such as "runs/*/*.csv" are expanded'
     )
     parser.add_argument(
         '--min_pup', '-p',
         action='store',
-        type=int,
+        type=float,
         dest='min_pup_score',
         default=10,
         help='Minimum pup score for the sequence to be considered usable'
@@ -32,41 +90,61 @@ def parse_args():
     parser.add_argument(
         '--min_trace', '-t',
         action='store',
-        type=int,
-        dest='min_trace_score', 
+        type=float,
+        dest='min_trace_score',
         default=30,
         help='Minimum mean trace score for the sequence to be considered usable'
     )
+    parser.add_argument(
+        '--min_crl', '-c',
+        action='store',
+        type=float,
+        dest='min_crl',
+        default=None,
+        help='Minimum contiguous read length (CRL) for the sequence to be considered usable'
+    )
+    parser.add_argument(
+        '--min_signal', '-s',
+        action='store',
+        type=float,
+        dest='min_signal',
+        default=None,
+        help='Minimum signal strength for the sequence to be considered usable'
+    )
+    parser.add_argument(
+        '--output', '-o',
+        action='store',
+        type=pathlib.Path,
+        dest='output_path',
+        default=pathlib.Path('qc_report.csv'),
+        help='Path of the combined QC report (default: qc_report.csv)'
+    )
     args = parser.parse_args()
-    return (args.qc_path, args.min_pup_score, args.min_trace_score)
+    #The report is never read back as an input, e.g. when it matches the glob
+    args.qc_paths = [qc_path for qc_path in expand_paths(args.qc_paths) if qc_path.resolve() != args.output_path.resolve()]
+    if not args.qc_paths:
+        parser.error('No QC .csv files matched.')
+    return (args)
 
-def main(qc_path, min_pup_score, min_trace_score): 
-    qc_data = []
-    qc_file = open(qc_path, 'r')
-    qc_reader = csv.reader(qc_file)
-    for row in qc_reader: 
-        qc_data.append(row)
-    #Find data header row
-    flag_header = 0
-    data_header = None
-    for i in range(1, len(qc_data)):
-        if qc_data[i][0] == 'Sample File Name': 
-            data_header = i
-            break
-    #Flag headers: 
-    #Sample File Name, QC, Issues
-    #Data headers: 
-    #Sample File Name, Sample Name, Well ID, Cap#, Median PUP, Trace Score, CRL, Signal Strength
-    qc_pass = []
-    for i in range(data_header+1, len(qc_data)): 
-        if check_scores(qc_data[i][4], qc_data[i][5], min_pup_score, min_trace_score) is True: 
-            qc_pass.append((qc_data[i][1], qc_data[i][4], qc_data[i][5]))
-    #Data output: 
-    output_file = open('qc_report.csv', 'w', newline='')
-    csv_writer = csv.writer(output_file)
-    csv_writer.writerow(('Sample name', 'Median PUP', 'Trace Score'))
-    csv_writer.writerows(qc_pass)
+def main(qc_paths, rules, output_path):
+    #Rows are checked as they are read and written straight to the report, so no QC file is held in memory
+    num_passed = 0
+    with open(output_path, 'w', newline='') as output_file:
+        csv_writer = csv.writer(output_file)
+        csv_writer.writerow(('Sample name',) + REPORT_COLUMNS[1:] + ('QC file',))
+        for qc_path in qc_paths:
+            bound_header = None
+            for header, row in stream_qc_rows(qc_path):
+                if header is not bound_header:
+                    check_scores = bind_rules(rules, header)
+                    report_indices = [header.index(column) if column in header else None for column in REPORT_COLUMNS]
+                    bound_header = header
+                if check_scores(row):
+                    csv_writer.writerow([row[i] if i is not None and i < len(row) else '' for i in report_indices] + [qc_path.name])
+                    num_passed += 1
+    print(f'{num_passed} sequences passed QC across {len(qc_paths)} QC file(s).')
 
-if __name__ == '__main__': 
-    qc_path, min_pup_score, min_trace_score = parse_args()
-    main(qc_path, min_pup_score, min_trace_score)
+if __name__ == '__main__':
+    args = parse_args()
+    rules = compile_rules(args.min_pup_score, args.min_trace_score, args.min_crl, args.min_signal)
+    main(args.qc_paths, rules, args.output_path)
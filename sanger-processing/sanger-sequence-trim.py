@@ -5,52 +5,130 @@ sanger-sequence-trim.py - script to automate trimming and QC of ab1 sequencing f
 """
 
 __author__ = 'Michael Ke'
-__version__ = '1.1.0'
+__version__ = '1.7.2'
 __comments__ = 'stable'
 
 #Standard libraries
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 import csv
+from itertools import repeat
 from pathlib import Path
 from sys import exit
 import csv
-#Third-party modules
-from Bio import SeqIO
+#Local modules
+from abif_reader import read_ab1_record
+from quality_trim import mott_trim, window_trim, quality_summary
+from sequence_sinks import GroupedFastaSink, GroupedFastqSink, IndexedFastaSink, UnalignedBamSink, MultiSink, primer_name, sample_name
+from trace_metrics import read_traces, trace_metrics, write_plate_metrics
 
-def output_fastas(ab1_data: list, output_path: Path, con_flag: bool, single_flag: bool) -> None: 
+def open_sinks(output_path: Path, group_by: str, single_flag: bool, indexed_flag: bool, fastq_flag: bool = False, bam_flag: bool = False) -> MultiSink: 
     """
-    Outputs the fastas either concatenated by primer set or into individual files
+    Opens the FASTA (and FASTQ/BAM) outputs that trimmed reads are written to as they are processed. 
+
+    Parameters: 
+        output_path (Path): output directory
+        group_by (str): 'read' (one file per read), 'primer', 'sample' or 'none' (no grouped files)
+        single_flag (bool): whether grouped files have each sequence on one line
+        indexed_flag (bool): whether to also write all reads to one FASTA file with a .fai index
+        fastq_flag (bool): whether to also write FASTQ files, grouped the same way (one file if group_by is 'none')
+        bam_flag (bool): whether to also write all reads to one unaligned BAM file
+    
+    Returns: 
+        (MultiSink): sink of all outputs
     """
-    #Concatenate by primers
-    if con_flag: 
-        #Determine which primers are present
-        primer_data = dict()
-        for data in ab1_data: 
-            primer_name = data.id.split('_')[1]
-            if primer_name not in primer_data.keys(): 
-                primer_data[primer_name] = []
-                primer_data[primer_name].append(data)
-            else: 
-                primer_data[primer_name].append(data)
-        
-        #Write individual primer data
-        for primer_name in primer_data.keys(): 
-            fasta_output_path = output_path.joinpath(f'{primer_name}_sequences.fasta')
-            #Write to 2-line format if specified; otherwise, follow standard FASTA format
-            if single_flag: 
-                SeqIO.write(primer_data[primer_name], fasta_output_path, 'fasta-2line')
-            else:
-                SeqIO.write(primer_data[primer_name], fasta_output_path, 'fasta')
-    #No concatenation of FASTA sequences
-    else:  
-        for data in ab1_data: 
-            fasta_output_path = output_path.joinpath(f'{data.id}_trimmed.fasta')
-            SeqIO.write(data, fasta_output_path, 'fasta')
+    sinks = []
+    if group_by == 'read': 
+        sinks.append(GroupedFastaSink(output_path, lambda read_id: read_id, file_name='{}_trimmed.fasta', max_open=1, one_per_group=True))
+    elif group_by == 'primer': 
+        sinks.append(GroupedFastaSink(output_path, primer_name, single_line=single_flag))
+    elif group_by == 'sample': 
+        sinks.append(GroupedFastaSink(output_path, sample_name, single_line=single_flag))
+    if indexed_flag: 
+        sinks.append(IndexedFastaSink(output_path.joinpath('trimmed_sequences.fasta')))
+    if fastq_flag: 
+        if group_by == 'read': 
+            sinks.append(GroupedFastqSink(output_path, lambda read_id: read_id, file_name='{}_trimmed.fastq', max_open=1, one_per_group=True))
+        elif group_by == 'primer': 
+            sinks.append(GroupedFastqSink(output_path, primer_name))
+        elif group_by == 'sample': 
+            sinks.append(GroupedFastqSink(output_path, sample_name))
+        else: 
+            sinks.append(GroupedFastqSink(output_path, lambda read_id: 'trimmed', file_name='{}_sequences.fastq', max_open=1))
+    if bam_flag: 
+        sinks.append(UnalignedBamSink(output_path.joinpath('trimmed_sequences.bam')))
+    return MultiSink(sinks)
+
+def process_ab1(ab1_file_path: Path, qc_flag: bool, min_trace: int, min_pup: int, trim_method: str = 'mott', window: int = 10, window_quality: float = 20, analytics: bool = False, ab1_record: tuple = None) -> tuple: 
+    """
+    Parse, trim and score a single ab1 file. 
+
+    Parameters: 
+        ab1_file_path (Path): path of the ab1 file
+        qc_flag (bool): whether reads have to pass the trace score and PUP score minimums
+        min_trace (int): minimum trace score
+        min_pup (int): minimum median PUP score
+        trim_method (str): 'mott' (same as the 'abi-trim' format) or 'window' (sliding window)
+        window (int): sliding window size for 'window' trimming
+        window_quality (float): minimum mean window quality for 'window' trimming
+        analytics (bool): whether to compute trace metrics from the raw trace channels
+        ab1_record (tuple): (record, AbifReader) from read_ab1_record if the file is already open, closed when done
+    
+    Returns: 
+        (tuple): (trimmed SeqRecord, True if the read is kept, metadata row, (plate, trace metrics) or None)
+            trace metrics are None without analytics, or if the file has no trace data
+    """
+    #Import once, and trim the parsed record in memory.
+    #Mott's trimming algorithm gives the same trimmed sequence as the 'abi-trim' format, along with how much was removed.
+    #Only the base calls, qualities and scores are decoded from the ab1 file, not the trace data.
+    ab1_file, abif = ab1_record if ab1_record else read_ab1_record(ab1_file_path)
+    with abif: 
+        #Trace score and PUP score in the ab1 file structure.
+        trace_score = abif.get('TrSc1', -1)
+        pup_score = abif.get('PuSc1', -1)
+        qualities = ab1_file.letter_annotations.get('phred_quality', [])
+        if trim_method == 'window': 
+            trim_start, trim_finish = window_trim(qualities, window, window_quality)
+        else: 
+            trim_start, trim_finish = mott_trim(qualities)
+
+        #The trace channels are only decoded for analytics
+        #A file without trace data is still trimmed, it is only left out of the trace metrics
+        plate_metrics = None
+        if analytics: 
+            plate_name = abif.get('CTNM1', b'unknown_plate').decode(errors='replace')
+            try: 
+                plate_metrics = (plate_name, trace_metrics(*read_traces(abif), trim_start, trim_finish))
+            except ValueError as error: 
+                print(f'Skipped trace metrics of {ab1_file_path.name} ({error})')
+    ab1_file_trim = ab1_file[trim_start:trim_finish]
+    left_trim = trim_start
+    right_trim = len(ab1_file.seq) - trim_finish
+
+    #TODO: validation of proper filename convention
+    #To allow for manual correction of ID, the ab1 file name ID is used instead of the ab1 file ID
+    ab1_file_id = '_'.join(ab1_file_path.stem.split('_')[0:2])
+    
+    #Check: see if the ab1 file ID is the same as the filename ID. This is to allow for manual correction of sequence file names.
+    if ab1_file_trim.id != ab1_file_id: 
+        print(f'{ab1_file_trim.id} differs from filename {ab1_file_id}. Changing ID to filename ID..')
+        ab1_file_trim.id = ab1_file_id
+
+    #Quality of the trimmed read
+    quality = quality_summary(qualities[trim_start:trim_finish])
+
+    #Check for QC flag
+    passed = (not qc_flag) or (trace_score > min_trace and pup_score > min_pup)
+    return (ab1_file_trim, passed, (
+        ab1_file_trim.id, trace_score, pup_score, left_trim, right_trim, 
+        round(quality['mean_quality'], 2), round(quality['q20_fraction'], 4), round(quality['q30_fraction'], 4),
+    ), plate_metrics)
 
 def parse_args(): 
     parser = ArgumentParser(
         description='Process ab1 files and get Mott algorithm-trimmed sequences',
-        epilog='V1.1.0'
+        epilog='V1.7.2'
         )
     parser.add_argument(
         'ab1_path', 
@@ -70,7 +148,21 @@ def parse_args():
         '-c', '--concat',
         dest='con_flag',
         action='store_true',
-        help='Flag to concatenate by primers.'
+        help='Flag to concatenate by primers (same as --group_by primer).'
+    )
+    parser.add_argument(
+        '-g', '--group_by',
+        dest='group_by',
+        action='store',
+        choices=('read', 'primer', 'sample', 'none'),
+        default=None,
+        help='FASTA files per read (default), per primer, per sample, or none (e.g. with --indexed).'
+    )
+    parser.add_argument(
+        '-i', '--indexed',
+        dest='indexed_flag',
+        action='store_true',
+        help='Flag to also write all reads to trimmed_sequences.fasta with a .fai index.'
     )
     parser.add_argument(
         '-s', '--oneline',
@@ -78,6 +170,57 @@ def parse_args():
         action='store_true',
         help='Flag to output each fasta entry onto one line.'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        dest='jobs',
+        action='store',
+        type=int,
+        default=1,
+        help='Number of processes used to parse, trim and score the ab1 files.'
+    )
+    parser.add_argument(
+        '--fastq',
+        dest='fastq_flag',
+        action='store_true',
+        help='Flag to also write FASTQ files with the quality scores, grouped the same way as the FASTA files.'
+    )
+    parser.add_argument(
+        '--bam',
+        dest='bam_flag',
+        action='store_true',
+        help='Flag to also write all reads to trimmed_sequences.bam (unaligned, requires pysam).'
+    )
+    parser.add_argument(
+        '-a', '--analytics',
+        dest='analytics_flag',
+        action='store_true',
+        help='Flag to compute trace metrics (mixed peaks, signal decay, noise, dye blobs) into <plate>_trace_metrics.npz.'
+    )
+    trim_group = parser.add_argument_group('trim_options')
+    trim_group.add_argument(
+        '--trim',
+        dest='trim_method',
+        action='store',
+        choices=('mott', 'window'),
+        default='mott',
+        help='Trimming method: Mott algorithm (default) or sliding window mean quality.'
+    )
+    trim_group.add_argument(
+        '--window',
+        dest='window',
+        action='store',
+        type=int,
+        default=10,
+        help='Sliding window size for window trimming.'
+    )
+    trim_group.add_argument(
+        '--window_quality',
+        dest='window_quality',
+        action='store',
+        type=float,
+        default=20,
+        help='Minimum mean quality of a window for window trimming.'
+    )
     qc_group = parser.add_argument_group('qc_options')
     qc_group.add_argument(
         '-q', '--filter_qc',
@@ -106,6 +249,8 @@ def parse_args():
 
     if not(args.output_path): 
         args.output_path = args.ab1_path
+    if not(args.group_by): 
+        args.group_by = 'primer' if args.con_flag else 'read'
 
     return (args)
 
@@ -114,15 +259,14 @@ def main():
 
     #Setting up args
     ab1_path = args.ab1_path
-    con_flag = args.con_flag
     single_flag = args.single_flag
     qc_flag = args.qc_flag
     min_trace = args.min_trace
     min_pup = args.min_pup
     output_path = args.output_path
     metadata = [] 
+    analytics = dict()
 
-    ab1_data = []
     ab1_file_paths = []
 
     #Get all ab1 files in directory
@@ -145,46 +289,42 @@ def main():
 
     #Trimming process for each file
     #------------------------------
-    for ab1_file_path in ab1_file_paths:
-        #Import
-        ab1_file = SeqIO.read(ab1_file_path, 'abi')
-        ab1_file_trim = SeqIO.read(ab1_file_path, 'abi-trim')
-
-        #Determine how much Mott's trimming algorithm removed from the sequence.
-        #Left trim is found by searching the first 5 nucleotides of the trimmed sequence
-        #in the original file. 
-        left_trim = ab1_file.seq.find(ab1_file_trim.seq[0:5])-1
-        right_trim = len(ab1_file.seq) - len(ab1_file_trim) - left_trim
-
-        #TODO: validation of proper filename convention
-        #To allow for manual correction of ID, the ab1 file name ID is used instead of the ab1 file ID
-        ab1_file_id = '_'.join(ab1_file_path.stem.split('_')[0:2])
-        
-        #Check: see if the ab1 file ID is the same as the filename ID. This is to allow for manual correction of sequence file names.
-        if ab1_file_trim.id != ab1_file_id: 
-            print(f'{ab1_file_trim.id} differs from filename {ab1_file_id}. Changing ID to filename ID..')
-            ab1_file_trim.id = ab1_file_id
-
-        #quality_score = sum(ab1_file.letter_annotations['phred_quality'])/len(ab1_file.letter_annotations['phred_quality'])
-
-        #Trace score and PUP score in the ab1 file structure.
-        #NOTE: these are lost in the trimmed file, so we have to go back to the original imported ab1 file in order
-        #      to find these.
-        trace_score = ab1_file.annotations['abif_raw']['TrSc1'] if 'TrSc1' in ab1_file.annotations['abif_raw'] else -1
-        pup_score = ab1_file.annotations['abif_raw']['PuSc1'] if 'PuSc1' in ab1_file.annotations['abif_raw'] else -1
-
-        #Check for QC flag
-        if not qc_flag:
-            ab1_data.append(ab1_file_trim)
+    #Files are sorted and results are collected in that order, so the output does not depend on the number of jobs.
+    ab1_file_paths.sort()
+    #Trimmed reads are written to the FASTA outputs as they come in, instead of being held until the end.
+    with ExitStack() as stack: 
+        try: 
+            sink = stack.enter_context(open_sinks(output_path, args.group_by, single_flag, args.indexed_flag, args.fastq_flag, args.bam_flag))
+        except ImportError as error: 
+            print(f'{error} Terminating program..')
+            exit()
+        if args.jobs > 1: 
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=args.jobs))
+            results = executor.map(
+                process_ab1, ab1_file_paths, 
+                repeat(qc_flag), repeat(min_trace), repeat(min_pup), 
+                repeat(args.trim_method), repeat(args.window), repeat(args.window_quality), repeat(args.analytics_flag), 
+                chunksize=max(1, len(ab1_file_paths) // (args.jobs * 4)),
+            )
         else: 
-            if (
-                trace_score > min_trace 
-                and pup_score > min_pup
-            ): 
-                ab1_data.append(ab1_file_trim)
-        metadata.append((ab1_file_trim.id, trace_score, pup_score, left_trim, right_trim))
+            results = (
+                process_ab1(ab1_file_path, qc_flag, min_trace, min_pup, args.trim_method, args.window, args.window_quality, args.analytics_flag) 
+                for ab1_file_path in ab1_file_paths
+            )
+
+        for ab1_file_trim, passed, metadata_row, plate_metrics in results: 
+            if passed: 
+                sink.write(ab1_file_trim)
+            metadata.append(metadata_row)
+            if plate_metrics: 
+                plate_name, read_metrics = plate_metrics
+                analytics.setdefault(plate_name, ([], []))
+                analytics[plate_name][0].append(ab1_file_trim.id)
+                analytics[plate_name][1].append(read_metrics)
 
-    output_fastas(ab1_data, output_path, con_flag, single_flag)
+    #Output trace metrics, one columnar file per plate
+    for plate_name, (read_ids, plate_read_metrics) in analytics.items(): 
+        write_plate_metrics(output_path.joinpath(f'{plate_name}_trace_metrics.npz'), read_ids, plate_read_metrics)
 
     #Output metadata
     metadata_path = output_path.joinpath('metadata.csv')
@@ -194,7 +334,7 @@ def main():
         print('Sort failed due to filenames.')
     with open(metadata_path, 'w', newline='') as metadata_file:  
         csvwriter = csv.writer(metadata_file)
-        csvwriter.writerow(('ID', 'trace_score', 'median_pup', 'left_trim','right_trim'))
+        csvwriter.writerow(('ID', 'trace_score', 'median_pup', 'left_trim','right_trim', 'mean_quality', 'q20_fraction', 'q30_fraction'))
         csvwriter.writerows(metadata)
 
 if __name__ == '__main__':
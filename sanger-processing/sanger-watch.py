@@ -0,0 +1,414 @@
+"""
+sanger-watch.py - watches a SeqStudio output directory and trims/QCs each run as its ab1 files come in.
+
+New ab1 files are picked up with inotify (if the inotify_simple package is installed) or by polling the
+directory. A file is only processed once its size and modification time have been seen unchanged for settle
+seconds (and at least twice), so files that are still being written or copied are left alone, even if the copy
+keeps the original modification time. Only files that were already there at startup and have not been modified
+for settle seconds skip the wait. Completed files are processed in batches:
+- trimmed sequences that pass QC are appended to <primer>_sequences.fasta
+- trimming metadata is appended to metadata.csv
+- the SeqStudio-like QC .csv of each plate that received files is regenerated, in the subdirectory of the
+  output directory matching its run folder (as generate-seqstudio-qc.py -r does)
+A file missing QC tags is still trimmed, and a file that can't be trimmed still gets its QC row.
+
+Processed files, and files that could not be read, are recorded in a state file (same format as the
+generate-seqstudio-qc.py manifest), so restarting the watcher does not re-process them. The state is saved
+with each batch; a batch interrupted before that is undone at the next start and processed again, so its
+sequences and metadata rows are not appended twice. A file that changes after it was processed is
+processed again: its QC row is replaced, but its sequence and metadata row are appended again, so the
+FASTA and metadata.csv then hold both versions (a warning is printed for each such file).
+"""
+
+__author__ = 'Michael Ke'
+__version__ = '1.2.0'
+__comments__ = 'stable'
+
+#Standard libraries
+from argparse import ArgumentParser
+import csv
+import importlib.util
+import json
+import os
+from pathlib import Path
+import sys
+import time
+#Third-party modules
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+#Local modules
+from abif_reader import read_ab1_record
+from sequence_sinks import GroupedFastaSink, primer_name
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+STATE_NAME = 'sanger-watch-state.json'
+JOURNAL_NAME = 'sanger-watch-journal.json'
+METADATA_HEADER = ('ID', 'trace_score', 'median_pup', 'left_trim','right_trim', 'mean_quality', 'q20_fraction', 'q30_fraction')
+#Errors of truncated/unreadable ab1 files, or files missing tags
+READ_ERRORS = (OSError, ValueError, AttributeError, TypeError, ZeroDivisionError)
+
+def load_script(module_name: str, script_name: str):
+    """
+    Imports one of the (hyphenated) scripts of this directory as a module.
+    """
+    spec = importlib.util.spec_from_file_location(module_name, SCRIPT_DIR.joinpath(script_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+sequence_trim = load_script('sanger_sequence_trim', 'sanger-sequence-trim.py')
+seqstudio_qc = load_script('generate_seqstudio_qc', 'generate-seqstudio-qc.py')
+
+class PollingWatcher():
+    """
+    Finds ab1 files by scanning the watched directory (and its run subdirectories) every interval.
+    """
+    def __init__(self, watch_path: Path) -> None:
+        self.watch_path = watch_path
+
+    def scan(self) -> set:
+        return set(self.watch_path.rglob('*.ab1'))
+
+    def wait(self, timeout: float) -> set:
+        time.sleep(timeout)
+        return self.scan()
+
+    def close(self) -> None:
+        pass
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Finds ab1 files from inotify events, so only files that were written, moved or created are looked at.
+    New run subdirectories are watched as they are created.
+    """
+    MASK = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.MODIFY if INotify else 0
+
+    def __init__(self, watch_path: Path) -> None:
+        super().__init__(watch_path)
+        self.inotify = INotify()
+        self.directories = {}
+        for directory in [watch_path] + [path for path in watch_path.rglob('*') if path.is_dir()]:
+            self._add_watch(directory)
+
+    def _add_watch(self, directory: Path) -> None:
+        self.directories[self.inotify.add_watch(directory, self.MASK)] = directory
+
+    def wait(self, timeout: float) -> set:
+        paths = set()
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.wd not in self.directories:
+                continue
+            path = self.directories[event.wd].joinpath(event.name)
+            if event.mask & flags.ISDIR:
+                #Files can land in a new run directory before its watch is added
+                self._add_watch(path)
+                paths.update(path.rglob('*.ab1'))
+            elif path.suffix == '.ab1':
+                paths.add(path)
+        return paths
+
+    def close(self) -> None:
+        self.inotify.close()
+
+class StabilityTracker():
+    """
+    Keeps track of ab1 files until their size and modification time have not changed for settle seconds,
+    over at least two observations.
+    """
+    def __init__(self, settle: float) -> None:
+        self.settle = settle
+        self.pending = {}
+
+    def add(self, path: Path, at_startup: bool = False) -> None:
+        """
+        Tracks a file. Files found at startup that have not been modified for settle seconds are
+        taken as complete once a second observation shows them unchanged.
+        """
+        if path not in self.pending:
+            self.pending[path] = (None, None, at_startup)
+
+    def completed(self) -> list:
+        """
+        Returns (path, size, mtime in ns) of the files that are done being written, and stops tracking them.
+        """
+        now = time.monotonic()
+        completed_files = []
+        for path, (last_stat, stable_since, at_startup) in list(self.pending.items()):
+            try:
+                file_stat = path.stat()
+            except OSError:
+                del self.pending[path]
+                continue
+            current_stat = (file_stat.st_size, file_stat.st_mtime_ns)
+            if current_stat != last_stat:
+                #First observation, or the file changed: it has to be seen unchanged again
+                self.pending[path] = (current_stat, now, at_startup)
+                continue
+            #The modification time is only trusted for files that were there at startup, as copies can keep an old one
+            settled = (now - stable_since >= self.settle) or (at_startup and time.time() - file_stat.st_mtime >= self.settle)
+            if settled and file_stat.st_size > 0:
+                completed_files.append((path, file_stat.st_size, file_stat.st_mtime_ns))
+                del self.pending[path]
+        return completed_files
+
+def rollback_outputs(journal_path: Path, state: dict) -> None:
+    """
+    Undoes the appends of a batch that was interrupted before its state was saved: the output files are cut
+    back to their size before the batch (files that the batch created are removed), so its files can be
+    processed again without duplicating their sequences and metadata rows.
+    """
+    if not journal_path.exists():
+        return
+    try:
+        with open(journal_path, encoding='utf-8') as journal_file:
+            journal = json.load(journal_file)
+        sizes, batch = journal['sizes'], journal['batch']
+    except (OSError, ValueError, KeyError, TypeError):
+        #The journal is written (and replaced) before anything is appended, so nothing was appended yet
+        sizes, batch = {}, {}
+    #The state was saved, only the journal was not removed yet
+    if all(key in state and [state[key].get('size'), state[key].get('mtime')] == stat for key, stat in batch.items()):
+        sizes = {}
+    for file_path, size in sizes.items():
+        file_path = Path(file_path)
+        if size is None:
+            file_path.unlink(missing_ok=True)
+        elif file_path.exists() and file_path.stat().st_size > size:
+            os.truncate(file_path, size)
+    journal_path.unlink()
+
+def process_batch(batch: list, watch_path: Path, output_path: Path, state: dict, args) -> None:
+    """
+    Trims and QCs a batch of completed ab1 files, appends the results to the output files, and saves the state.
+    The size of each output file before the batch is kept in a journal until the state is saved, so an
+    interrupted batch is undone at the next start (see rollback_outputs).
+
+    Parameters:
+        batch (list): (path, size, mtime in ns) of the completed ab1 files
+        watch_path (Path): watched directory, state keys are paths relative to it
+        output_path (Path): output directory
+        state (dict): processed files, updated with the batch
+        args (Namespace): trimming and QC options
+    """
+    records = []
+    metadata = []
+    changed_plates = set()
+    for ab1_file_path, size, mtime in sorted(batch):
+        key = ab1_file_path.relative_to(watch_path).as_posix()
+        old_entry = state.get(key)
+        if old_entry and old_entry.get('plate') is not None:
+            changed_plates.add(seqstudio_qc._plate_csv_path(output_path, key, old_entry['plate']))
+        try:
+            ab1_record = read_ab1_record(ab1_file_path)
+        except READ_ERRORS as error:
+            print(f'Skipped {ab1_file_path} ({type(error).__name__}: {error})', file=sys.stderr)
+            state[key] = {'size': size, 'mtime': mtime, 'plate': None, 'row': None, 'error': f'{type(error).__name__}: {error}'}
+            continue
+        #The file is opened once, for both the QC row and the trimming, but a missing QC tag does not stop the trimming
+        entry = {'size': size, 'mtime': mtime, 'plate': None, 'row': None}
+        try:
+            plate_name, row = seqstudio_qc._read_values(ab1_record[1], ab1_file_path.name)
+            entry.update({'plate': plate_name, 'row': list(row)})
+            changed_plates.add(seqstudio_qc._plate_csv_path(output_path, key, plate_name))
+        except READ_ERRORS as error:
+            print(f'No QC row for {ab1_file_path} ({type(error).__name__}: {error})', file=sys.stderr)
+            entry['error'] = f'QC: {type(error).__name__}: {error}'
+        try:
+            ab1_file_trim, passed, metadata_row, _ = sequence_trim.process_ab1(
+                ab1_file_path, args.qc_flag, args.min_trace, args.min_pup, args.trim_method, ab1_record=ab1_record)
+        except READ_ERRORS as error:
+            ab1_record[1].close()
+            print(f'Not trimmed {ab1_file_path} ({type(error).__name__}: {error})', file=sys.stderr)
+            entry['error'] = '; '.join(filter(None, (entry.get('error'), f'trimming: {type(error).__name__}: {error}')))
+            state[key] = entry
+            continue
+        if old_entry:
+            print(f'{key} changed after it was processed, its sequence and metadata are appended again.', file=sys.stderr)
+        state[key] = entry
+        if passed:
+            records.append(ab1_file_trim)
+        metadata.append(metadata_row)
+
+    #Sizes of the output files before the batch, until the state is saved
+    fasta_sink = GroupedFastaSink(output_path, primer_name, append=True)
+    metadata_path = output_path.joinpath('metadata.csv')
+    output_files = {metadata_path} | {output_path.joinpath(fasta_sink.file_name.format(primer_name(record.id))) for record in records}
+    journal_path = output_path.joinpath(JOURNAL_NAME)
+    with open(journal_path.with_name(JOURNAL_NAME + '.partial'), 'w', encoding='utf-8') as journal_file:
+        json.dump({
+            'sizes': {str(file_path): (file_path.stat().st_size if file_path.exists() else None) for file_path in output_files},
+            'batch': {ab1_file_path.relative_to(watch_path).as_posix(): [size, mtime] for ab1_file_path, size, mtime in batch},
+        }, journal_file)
+    os.replace(journal_path.with_name(JOURNAL_NAME + '.partial'), journal_path)
+
+    #Passing reads are appended to the per-primer FASTA files
+    with fasta_sink:
+        for record in records:
+            fasta_sink.write(record)
+
+    #Append to the metadata
+    write_header = not metadata_path.exists() or metadata_path.stat().st_size == 0
+    with open(metadata_path, 'a', newline='') as metadata_file:
+        csvwriter = csv.writer(metadata_file)
+        if write_header:
+            csvwriter.writerow(METADATA_HEADER)
+        csvwriter.writerows(metadata)
+
+    seqstudio_qc._write_manifest(output_path.joinpath(STATE_NAME), state)
+    journal_path.unlink()
+
+    #Regenerate the QC .csv of each plate that gained, lost or changed files (one per run folder and plate name)
+    plate_rows = {}
+    for key, entry in state.items():
+        if entry.get('plate') is not None:
+            plate_rows.setdefault(seqstudio_qc._plate_csv_path(output_path, key, entry['plate']), []).append(entry['row'])
+    for plate_csv_path in sorted(changed_plates):
+        if plate_csv_path in plate_rows:
+            plate_csv_path.parent.mkdir(parents=True, exist_ok=True)
+            seqstudio_qc._generate_csv(plate_csv_path, plate_rows[plate_csv_path])
+        elif plate_csv_path.exists():
+            plate_csv_path.unlink()
+    print(f'Processed {len(metadata)} of {len(batch)} ab1 files, {len(records)} passed.')
+
+def parse_args():
+    parser = ArgumentParser(
+        description='Watch a SeqStudio output directory and trim/QC ab1 files as runs complete.',
+        epilog='V1.2.0'
+        )
+    parser.add_argument(
+        'watch_path',
+        action='store',
+        type=Path,
+        help='Directory the SeqStudio writes runs (ab1 files) to.'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        dest='output_path',
+        action='store',
+        default=None,
+        type=Path,
+        help='Output path for FASTA, metadata and QC files (default: the watched directory).'
+    )
+    parser.add_argument(
+        '--settle',
+        dest='settle',
+        action='store',
+        type=float,
+        default=30,
+        help='Seconds that the size of an ab1 file has to stay the same before it is processed.'
+    )
+    parser.add_argument(
+        '--interval',
+        dest='interval',
+        action='store',
+        type=float,
+        default=5,
+        help='Seconds between checks for new files.'
+    )
+    parser.add_argument(
+        '--poll',
+        dest='poll_flag',
+        action='store_true',
+        help='Poll the directory even if inotify is available (e.g. for network shares).'
+    )
+    parser.add_argument(
+        '--once',
+        dest='once_flag',
+        action='store_true',
+        help='Process the ab1 files that are there, wait for them to settle, and exit.'
+    )
+    parser.add_argument(
+        '--trim',
+        dest='trim_method',
+        action='store',
+        choices=('mott', 'window'),
+        default='mott',
+        help='Trimming method: Mott algorithm (default) or sliding window mean quality.'
+    )
+    qc_group = parser.add_argument_group('qc_options')
+    qc_group.add_argument(
+        '-q', '--filter_qc',
+        dest='qc_flag',
+        action='store_true',
+        help='Flag to filter by trace score and median PUP score.'
+    )
+    qc_group.add_argument(
+        '-t', '--min_trace',
+        dest='min_trace',
+        action='store',
+        type=int,
+        default=30,
+        help='Minimum trace score for a sequence to be passed.',
+    )
+    qc_group.add_argument(
+        '-p', '--min_pup',
+        dest='min_pup',
+        action='store',
+        type=int,
+        default=10,
+        help='Minimum median PUP score for a sequence to be passed.'
+    )
+
+    args = parser.parse_args()
+
+    if not args.watch_path.is_dir():
+        parser.error('Not a directory.')
+    if not(args.output_path):
+        args.output_path = args.watch_path
+
+    return (args)
+
+def main():
+    args = parse_args()
+    watch_path = args.watch_path.resolve()
+    output_path = args.output_path
+    output_path.mkdir(parents=True, exist_ok=True)
+    #A batch that was interrupted is undone, its files are not in the state and are processed again
+    state = seqstudio_qc._read_manifest(output_path.joinpath(STATE_NAME))
+    rollback_outputs(output_path.joinpath(JOURNAL_NAME), state)
+
+    if INotify is not None and not args.poll_flag:
+        watcher = InotifyWatcher(watch_path)
+    else:
+        watcher = PollingWatcher(watch_path)
+    tracker = StabilityTracker(args.settle)
+
+    print(f'Watching {watch_path} ({type(watcher).__name__})..')
+    def is_done(path: Path, size: int, mtime: int) -> bool:
+        #Files that could not be read are in the state too, and are only retried once they change
+        entry = state.get(path.relative_to(watch_path).as_posix())
+        return bool(entry) and (entry.get('size'), entry.get('mtime')) == (size, mtime)
+
+    def track(paths: set, at_startup: bool = False) -> None:
+        #Files that were already processed (or failed) and did not change since are not tracked again
+        for path in paths:
+            try:
+                file_stat = path.stat()
+            except OSError:
+                continue
+            if not is_done(path, file_stat.st_size, file_stat.st_mtime_ns):
+                tracker.add(path, at_startup)
+
+    track(watcher.scan(), at_startup=True)
+    try:
+        while True:
+            batch = []
+            for ab1_file_path, size, mtime in tracker.completed():
+                if is_done(ab1_file_path, size, mtime):
+                    continue
+                batch.append((ab1_file_path, size, mtime))
+            if batch:
+                process_batch(batch, watch_path, output_path, state, args)
+
+            if args.once_flag and not tracker.pending:
+                break
+            track(watcher.wait(args.interval))
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+    finally:
+        watcher.close()
+
+if __name__ == '__main__':
+    main()
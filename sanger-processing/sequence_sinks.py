@@ -0,0 +1,239 @@
+__description__ =\
+"""
+sequence_sinks.py - Output sinks for trimmed Sanger reads. Reads are written as they are processed,
+instead of being collected in memory first, through buffered file handles that stay open between reads.
+
+Classes
+-------
+GroupedFastaSink : one FASTA file per group of reads (per primer, per sample, or per read)
+GroupedFastqSink : one FASTQ file per group of reads, keeping the phred qualities
+IndexedFastaSink : single multi-FASTA file with a samtools-style .fai index
+UnalignedBamSink : single unaligned BAM file with the phred qualities (requires pysam)
+MultiSink : writes each read to several sinks
+
+Functions
+---------
+primer_name : primer of a read ID following the <sample>_<primer> convention
+sample_name : sample of a read ID following the <sample>_<primer> convention
+"""
+
+__author__  = "Michael Ke"
+__version__ = "1.1.1"
+__comments__ = "stable"
+
+from array import array
+from pathlib import Path
+import sys
+
+from Bio.SeqIO.FastaIO import as_fasta, as_fasta_2line
+from Bio.SeqIO.QualityIO import as_fastq
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+#Line width of wrapped FASTA, same as SeqIO's 'fasta' format
+LINE_WIDTH = 60
+#Buffer size of each open file
+BUFFER_SIZE = 1 << 16
+
+def primer_name(read_id: str) -> str:
+    """Primer of a read ID (<sample>_<primer>), 'unsorted' if the ID doesn't follow the convention"""
+    id_fields = read_id.split('_')
+    return id_fields[1] if len(id_fields) > 1 else 'unsorted'
+
+def sample_name(read_id: str) -> str:
+    """Sample of a read ID (<sample>_<primer>)"""
+    return read_id.split('_')[0]
+
+class GroupedFastaSink():
+    """
+    GroupedFastaSink - appends each read to the FASTA file of its group, e.g. <primer>_sequences.fasta.
+    Files are opened on the first read of their group and kept open (up to max_open at a time).
+
+    Attributes
+    ----------
+    output_path : directory of the FASTA files
+    group : function of a read ID to its group name
+    file_name : format string of the file name of a group, e.g. '{}_sequences.fasta'
+    single_line : whether to write each sequence on one line ('fasta-2line')
+    append : whether to append to existing files instead of overwriting them
+    one_per_group : whether each file holds a single read (e.g. one file per read); a later read of the
+        same group replaces the file, with a warning, instead of being added to it
+
+    Methods
+    -------
+    write : write a SeqRecord to the file of its group
+    close : close all files
+    """
+
+    def __init__(self, output_path: Path, group, file_name: str = '{}_sequences.fasta', single_line: bool = False, append: bool = False, max_open: int = 128, one_per_group: bool = False) -> None:
+        self.output_path = Path(output_path)
+        self.group = group
+        self.file_name = file_name
+        self.format = as_fasta_2line if single_line else as_fasta
+        self.append = append
+        self.one_per_group = one_per_group
+        self.max_open = max_open
+        self._handles = {}
+        #Groups whose file was already started by this sink, these are reopened in append mode
+        self._started = set()
+
+    def _handle(self, group_name: str, overwrite: bool = False):
+        if group_name in self._handles:
+            return self._handles[group_name]
+        if len(self._handles) >= self.max_open:
+            #Close the file that was opened first; dictionaries keep insertion order
+            self._handles.pop(next(iter(self._handles))).close()
+        mode = 'a' if not overwrite and (self.append or group_name in self._started) else 'w'
+        handle = open(self.output_path.joinpath(self.file_name.format(group_name)), mode, buffering=BUFFER_SIZE)
+        self._handles[group_name] = handle
+        self._started.add(group_name)
+        return handle
+
+    def write(self, record) -> None:
+        group_name = self.group(record.id)
+        if self.one_per_group and group_name in self._started:
+            print(f'Duplicate read ID {record.id}, {self.file_name.format(group_name)} is overwritten by the later read.', file=sys.stderr)
+            if group_name in self._handles:
+                self._handles.pop(group_name).close()
+            #The file was started by this sink, so it is overwritten even when appending
+            self._handle(group_name, overwrite=True).write(self.format(record))
+            return
+        self._handle(group_name).write(self.format(record))
+
+    def close(self) -> None:
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class GroupedFastqSink(GroupedFastaSink):
+    """
+    GroupedFastqSink - appends each read, with its 'phred_quality' letter annotation, to the FASTQ
+    file of its group, e.g. <primer>_sequences.fastq. Reads without qualities are left out.
+    """
+
+    def __init__(self, output_path: Path, group, file_name: str = '{}_sequences.fastq', append: bool = False, max_open: int = 128, one_per_group: bool = False) -> None:
+        super().__init__(output_path, group, file_name=file_name, append=append, max_open=max_open, one_per_group=one_per_group)
+        self.format = as_fastq
+
+    def write(self, record) -> None:
+        if 'phred_quality' not in record.letter_annotations:
+            print(f'{record.id} has no quality scores, left out of the FASTQ output.', file=sys.stderr)
+            return
+        super().write(record)
+
+class IndexedFastaSink():
+    """
+    IndexedFastaSink - writes all reads to one multi-FASTA file, and a samtools-style .fai index
+    (name, length, offset, line bases, line bytes) next to it, so single reads can be fetched by ID
+    (e.g. samtools faidx, pysam.FastaFile or Bio.SeqIO.index) without scanning the file.
+
+    Methods
+    -------
+    write : write a SeqRecord to the FASTA file and record its index entry
+    close : close the FASTA file and write the index
+    """
+
+    def __init__(self, fasta_path: Path, line_width: int = LINE_WIDTH) -> None:
+        self.fasta_path = Path(fasta_path)
+        self.line_width = line_width
+        self._handle = open(self.fasta_path, 'wb', buffering=BUFFER_SIZE)
+        self._offset = 0
+        self._index = []
+        self._names = set()
+
+    def write(self, record) -> None:
+        sequence = str(record.seq)
+        title = f'>{record.id}\n'.encode()
+        lines = [sequence[i:i + self.line_width] for i in range(0, len(sequence), self.line_width)]
+        data = title + ''.join(line + '\n' for line in lines).encode()
+        line_bases = len(lines[0]) if lines else 0
+        if record.id in self._names:
+            print(f'Duplicate read ID {record.id} in {self.fasta_path.name}, fetching it by ID returns the first read.', file=sys.stderr)
+        self._names.add(record.id)
+        self._index.append((record.id, len(sequence), self._offset + len(title), line_bases, line_bases + 1))
+        self._handle.write(data)
+        self._offset += len(data)
+
+    def close(self) -> None:
+        if self._handle.closed:
+            return
+        self._handle.close()
+        with open(self.fasta_path.with_name(self.fasta_path.name + '.fai'), 'w') as index_file:
+            for entry in self._index:
+                index_file.write('\t'.join(str(field) for field in entry) + '\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class UnalignedBamSink():
+    """
+    UnalignedBamSink - writes all reads to one unaligned BAM file (flag 4, no reference), keeping the
+    phred qualities, as used as input by aligners and variant calling pipelines.
+
+    Methods
+    -------
+    write : write a SeqRecord as an unmapped read
+    close : close the BAM file
+    """
+
+    def __init__(self, bam_path: Path) -> None:
+        if pysam is None:
+            raise ImportError('Writing BAM files requires pysam (pip install pysam).')
+        self.bam_path = Path(bam_path)
+        self._header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6', 'SO': 'unsorted'}})
+        self._handle = pysam.AlignmentFile(str(self.bam_path), 'wb', header=self._header)
+
+    def write(self, record) -> None:
+        segment = pysam.AlignedSegment(self._header)
+        segment.query_name = record.id
+        segment.query_sequence = str(record.seq)
+        segment.flag = 4
+        segment.reference_id = -1
+        segment.reference_start = -1
+        segment.next_reference_id = -1
+        segment.next_reference_start = -1
+        if 'phred_quality' in record.letter_annotations:
+            segment.query_qualities = array('B', record.letter_annotations['phred_quality'])
+        self._handle.write(segment)
+
+    def close(self) -> None:
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+class MultiSink():
+    """
+    MultiSink - writes each read to all of its sinks.
+    """
+
+    def __init__(self, sinks: list) -> None:
+        self.sinks = sinks
+
+    def write(self, record) -> None:
+        for sink in self.sinks:
+            sink.write(record)
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
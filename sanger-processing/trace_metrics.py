@@ -0,0 +1,140 @@
+__description__ =\
+"""
+trace_metrics.py - Trace-level quality metrics of Sanger reads, computed with NumPy from the raw trace
+channels (DATA9-DATA12) and peak locations (PLOC2) of ab1 files, for finding dye blobs, mixed peaks
+and signal decay across whole plates.
+
+Functions
+---------
+read_traces : trace channels and peak locations of an ab1 file as arrays
+trace_metrics : per-read metrics from the trace channels at the called peaks
+write_plate_metrics : write the metrics of a plate's reads as one columnar .npz file
+read_plate_metrics : read a .npz file written by write_plate_metrics
+"""
+
+__author__  = "Michael Ke"
+__version__ = "1.0.0"
+__comments__ = "stable"
+
+from pathlib import Path
+
+import numpy as np
+
+#Analyzed trace channels, in the base order of the FWO_1 tag
+TRACE_CHANNELS = ('DATA9', 'DATA10', 'DATA11', 'DATA12')
+#Secondary/primary peak height ratio above which a peak counts as mixed
+MIXED_PEAK_RATIO = 0.35
+#Bases where dye blobs (unincorporated dye terminators) usually show up
+DYE_BLOB_BASES = (40, 130)
+METRIC_NAMES = ('num_peaks', 'signal_median', 'secondary_ratio', 'mixed_fraction', 'noise_floor', 'signal_to_noise', 'decay_slope', 'dye_blob_score')
+
+def read_traces(abif) -> tuple:
+    """
+    Trace channels and called peak locations of an ab1 file.
+
+    Parameters
+    ----------
+    abif : AbifReader
+        open ab1 file
+
+    Return
+    ------
+    (traces, peaks) : tuple
+        (4, n) float array of the trace channels, and the trace position of each called base
+    """
+    missing_channels = [channel for channel in TRACE_CHANNELS if channel not in abif]
+    if missing_channels:
+        raise ValueError(f'{abif.path} has no trace data ({", ".join(missing_channels)}).')
+    traces = np.vstack([abif.array(channel) for channel in TRACE_CHANNELS]).astype(np.float64)
+    peaks = abif.array('PLOC2').astype(np.intp) if 'PLOC2' in abif else np.zeros(0, dtype=np.intp)
+    return (traces, peaks[(peaks >= 0) & (peaks < traces.shape[1])])
+
+def trace_metrics(traces: np.ndarray, peaks: np.ndarray, trim_start: int = 0, trim_finish: int = None) -> dict:
+    """
+    Per-read trace metrics. Peak heights are the four channel intensities at each called base; the
+    primary peak is the highest channel and the secondary peak the second highest.
+    - signal_median: median primary peak height of the trimmed read
+    - secondary_ratio: median secondary/primary ratio of the trimmed read (mixed templates are high)
+    - mixed_fraction: fraction of trimmed bases with a secondary/primary ratio above MIXED_PEAK_RATIO
+    - noise_floor: median of the mean of the three non-primary channels at the trimmed bases
+    - signal_to_noise: signal_median / noise_floor
+    - decay_slope: slope of log10 primary peak height per 100 bases over the whole read (negative is decay)
+    - dye_blob_score: highest signal around DYE_BLOB_BASES over the median primary peak height of the read
+
+    Parameters
+    ----------
+    traces : np.ndarray
+        (4, n) trace channels
+    peaks : np.ndarray
+        trace position of each called base
+    trim_start, trim_finish : int
+        trimmed bases are peaks[trim_start:trim_finish]
+
+    Return
+    ------
+    metrics : dict
+        metric name to value, NaN where the read has too few bases
+    """
+    metrics = dict.fromkeys(METRIC_NAMES, np.nan)
+    metrics['num_peaks'] = len(peaks)
+    if len(peaks) < 2:
+        return metrics
+
+    #Channel heights at every called base, sorted so the last row is the primary peak
+    heights = np.sort(traces[:, peaks], axis=0)
+    primary = heights[-1]
+    read_median = np.median(primary)
+
+    trimmed = slice(trim_start, trim_finish)
+    trimmed_heights = heights[:, trimmed]
+    if trimmed_heights.shape[1]:
+        trimmed_primary = trimmed_heights[-1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratios = np.where(trimmed_primary > 0, trimmed_heights[-2] / trimmed_primary, np.nan)
+            metrics['signal_median'] = float(np.median(trimmed_primary))
+            metrics['secondary_ratio'] = float(np.nanmedian(ratios)) if np.isfinite(ratios).any() else np.nan
+            metrics['mixed_fraction'] = float(np.mean(ratios >= MIXED_PEAK_RATIO))
+            metrics['noise_floor'] = float(np.median(trimmed_heights[:-1].mean(axis=0)))
+            metrics['signal_to_noise'] = metrics['signal_median'] / metrics['noise_floor'] if metrics['noise_floor'] > 0 else np.nan
+
+    #Least-squares slope of log10 intensity against base position
+    positions = np.arange(len(primary), dtype=np.float64)
+    log_primary = np.log10(np.maximum(primary, 1))
+    centered = positions - positions.mean()
+    metrics['decay_slope'] = float(100 * np.dot(centered, log_primary - log_primary.mean()) / np.dot(centered, centered))
+
+    #Dye blobs are broad and fall between called peaks, so the whole trace around those bases is used
+    blob_start, blob_finish = DYE_BLOB_BASES
+    if len(peaks) > blob_start and read_median > 0:
+        blob_region = traces[:, peaks[blob_start]:peaks[min(blob_finish, len(peaks) - 1)] + 1]
+        metrics['dye_blob_score'] = float(blob_region.max() / read_median)
+    return metrics
+
+def write_plate_metrics(output_path: Path, ids: list, metrics: list) -> None:
+    """
+    Write the metrics of a plate's reads as one compressed, columnar .npz file: an 'id' array and
+    one array per metric (int32 for num_peaks, float32 otherwise), in the order of the reads.
+
+    Parameters
+    ----------
+    output_path : Path
+        path of the .npz file
+    ids : list
+        read IDs
+    metrics : list
+        metrics dictionary of each read, as returned by trace_metrics
+    """
+    columns = {name: np.array([read_metrics[name] for read_metrics in metrics], dtype=np.int32 if name == 'num_peaks' else np.float32) for name in METRIC_NAMES}
+    np.savez_compressed(output_path, id=np.array(ids, dtype=str), **columns)
+
+def read_plate_metrics(input_path: Path) -> dict:
+    """
+    Read a .npz file written by write_plate_metrics.
+
+    Return
+    ------
+    columns : dict
+        column name ('id' or a metric name) to array
+    """
+    with np.load(input_path) as data:
+        return {name: data[name] for name in data.files}
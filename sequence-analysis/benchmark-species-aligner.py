@@ -0,0 +1,355 @@
+"""
+benchmark_species_aligner.py - Benchmark harness for species_aligner_analysis.py. Synthetic multi-species
+GenBank files are generated at several scales (number of sequences x sequence length), and each stage of
+the pipeline (parse_gb, dereplication, FASTA output, alignment, in-memory and streaming consensus) is timed
+over repeated runs.
+
+Alignment is done by a stub aligner that places each synthetic sequence at its known offset, so the
+benchmark runs offline and without MAFFT installed; alignment times therefore only reflect file I/O.
+
+Results can be saved as a baseline JSON file (--save) and later runs compared against it (--compare),
+so regressions between versions of species_aligner_analysis.py show up as slowdowns per stage.
+
+Author: Michael Ke
+Version: 1.0
+Date: October 19th 2026
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+import importlib.util
+import json
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import Bio
+from Bio import SeqIO, AlignIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+SCRIPT_PATH = Path(__file__).resolve().parent.joinpath('species-aligner-analysis.py')
+DEFAULT_SIZES = [10, 100, 1000]
+DEFAULT_LENGTHS = [500, 2000]
+FULL_SIZES = [10, 100, 1000, 10000]
+FULL_LENGTHS = [500, 2000, 20000]
+
+def load_pipeline(script_path : Path = SCRIPT_PATH):
+    """
+    Import species-aligner-analysis.py as a module (the file name is not a valid module name).
+    """
+    spec = importlib.util.spec_from_file_location('species_aligner_analysis', script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def parse_args():
+    parser = ArgumentParser('Benchmark the species aligner pipeline on synthetic data')
+    parser.add_argument(
+        '--sizes',
+        '-n',
+        action='store',
+        dest='sizes',
+        nargs='+',
+        type=int,
+        default=None,
+        help=f'Numbers of sequences to benchmark (default: {DEFAULT_SIZES})',
+    )
+    parser.add_argument(
+        '--lengths',
+        '-l',
+        action='store',
+        dest='lengths',
+        nargs='+',
+        type=int,
+        default=None,
+        help=f'Sequence lengths to benchmark (default: {DEFAULT_LENGTHS})',
+    )
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        dest='full',
+        help=f'Benchmark the full grid of sizes {FULL_SIZES} and lengths {FULL_LENGTHS}',
+    )
+    parser.add_argument(
+        '--species',
+        '-s',
+        action='store',
+        dest='num_species',
+        type=int,
+        default=5,
+        help='Number of species the sequences are spread over',
+    )
+    parser.add_argument(
+        '--repeats',
+        '-r',
+        action='store',
+        dest='repeats',
+        type=int,
+        default=3,
+        help='Number of timed runs per stage',
+    )
+    parser.add_argument(
+        '--min_cons',
+        action='store',
+        dest='min_cons',
+        type=float,
+        default=0.9,
+        help='min_cons passed to the consensus stage',
+    )
+    parser.add_argument(
+        '--min_rep',
+        action='store',
+        dest='min_rep',
+        type=float,
+        default=0.5,
+        help='min_rep passed to the consensus stage',
+    )
+    parser.add_argument(
+        '--save',
+        action='store',
+        dest='save_path',
+        default=None,
+        type=Path,
+        help='Save the results as a baseline JSON file',
+    )
+    parser.add_argument(
+        '--compare',
+        action='store',
+        dest='baseline_path',
+        default=None,
+        type=Path,
+        help='Compare the results against a saved baseline JSON file',
+    )
+    parser.add_argument(
+        '--tolerance',
+        action='store',
+        dest='tolerance',
+        type=float,
+        default=0.2,
+        help='Relative slowdown against the baseline that is reported as a regression',
+    )
+    parser.add_argument(
+        '--seed',
+        action='store',
+        dest='seed',
+        type=int,
+        default=0,
+        help='Random seed for the synthetic data',
+    )
+    args = parser.parse_args()
+
+    if args.full:
+        args.sizes = args.sizes or FULL_SIZES
+        args.lengths = args.lengths or FULL_LENGTHS
+    args.sizes = args.sizes or DEFAULT_SIZES
+    args.lengths = args.lengths or DEFAULT_LENGTHS
+
+    return args
+
+def generate_genbank(gb_path : Path, num_sequences : int, seq_length : int, num_species : int, seed : int) -> None:
+    """
+    Write a synthetic GenBank file. Every species gets a random reference sequence, and every
+    entry is a mutated (1% substitutions) window of its species' reference with ragged ends.
+    The offset of the window is stored in the description so the stub aligner can place it.
+
+    Parameters:
+    gb_path - path of the GenBank file to write
+    num_sequences - total number of entries
+    seq_length - length of the species reference sequences
+    num_species - number of species the entries are spread over
+    seed - random seed
+    """
+    rng = random.Random(seed)
+    references = [
+        ''.join(rng.choices('ACGT', k=seq_length))
+        for _ in range(num_species)
+    ]
+    max_trim = max(1, seq_length // 20)
+    gb_entries = []
+    for index in range(num_sequences):
+        species_index = index % num_species
+        left_trim = rng.randrange(max_trim)
+        right_trim = rng.randrange(max_trim)
+        sequence = list(references[species_index][left_trim:seq_length - right_trim])
+        for position in rng.sample(range(len(sequence)), k=len(sequence) // 100):
+            sequence[position] = rng.choice('ACGT')
+        gb_entries.append(SeqRecord(
+            Seq(''.join(sequence)),
+            id=f'SYN{index:06d}.1',
+            name=f'SYN{index:06d}',
+            description=f'offset={left_trim} length={seq_length}',
+            annotations={
+                'organism': f'Synthetica species{species_index}',
+                'molecule_type': 'DNA',
+            },
+        ))
+    SeqIO.write(gb_entries, gb_path, 'gb')
+
+def stub_align(species_fasta_path : Path, aligned_fasta_path : Path) -> None:
+    """
+    Stand-in for MAFFT: pads every synthetic sequence with gaps according to the offset and
+    reference length stored in its description.
+    """
+    with open(species_fasta_path) as species_fasta, open(aligned_fasta_path, 'w') as aligned_fasta:
+        for title, sequence in SimpleFastaParser(species_fasta):
+            fields = dict(field.split('=') for field in title.split(' ')[1:] if '=' in field)
+            left_gap = int(fields['offset'])
+            right_gap = int(fields['length']) - left_gap - len(sequence)
+            aligned_fasta.write(f'>{title}\n{"-" * left_gap}{sequence}{"-" * right_gap}\n')
+
+def run_stages(pipeline, gb_path : Path, work_path : Path, args) -> dict:
+    """
+    Run every stage of the pipeline once.
+
+    Return:
+    records - dictionary of stage name to the record filled in by pipeline.measure()
+    """
+    records = {}
+    with pipeline.measure(records.setdefault('parse', {})):
+        species_dict = pipeline.parse_gb(gb_path)
+
+    with pipeline.measure(records.setdefault('derep_exact', {})):
+        for species in species_dict:
+            pipeline.dereplicate(species_dict[species])
+
+    with pipeline.measure(records.setdefault('derep_minhash', {})):
+        for species in species_dict:
+            pipeline.dereplicate(species_dict[species], cluster_jaccard=0.9)
+
+    fasta_path = work_path.joinpath('fasta')
+    fasta_path.mkdir(exist_ok=True)
+    species_fasta_paths = []
+    with pipeline.measure(records.setdefault('fasta', {})):
+        for species in species_dict:
+            if not species_dict[species]:
+                continue
+            species_fasta_path = fasta_path.joinpath(f'{species.replace(" ", "-")}.fasta')
+            SeqIO.write(species_dict[species], species_fasta_path, 'fasta')
+            species_fasta_paths.append(species_fasta_path)
+
+    align_path = work_path.joinpath('aligned')
+    align_path.mkdir(exist_ok=True)
+    aligned_fasta_paths = []
+    with pipeline.measure(records.setdefault('align_stub', {})):
+        for species_fasta_path in species_fasta_paths:
+            aligned_fasta_path = align_path.joinpath(f'{species_fasta_path.stem}_aligned.fasta')
+            stub_align(species_fasta_path, aligned_fasta_path)
+            aligned_fasta_paths.append(aligned_fasta_path)
+
+    with pipeline.measure(records.setdefault('consensus', {})):
+        for aligned_fasta_path in aligned_fasta_paths:
+            species_alignment = AlignIO.read(aligned_fasta_path, 'fasta')
+            pipeline.get_consensus(species_alignment, args.min_cons, args.min_rep)
+
+    with pipeline.measure(records.setdefault('consensus_streaming', {})):
+        for aligned_fasta_path in aligned_fasta_paths:
+            pipeline.count_alignment_columns(aligned_fasta_path).consensus(args.min_cons, args.min_rep)
+
+    return records
+
+def benchmark(pipeline, args) -> dict:
+    """
+    Benchmark every combination of size and length.
+
+    Return:
+    results - dictionary of scale label to per-stage timing summaries
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_path = Path(temp_dir)
+        for num_sequences in args.sizes:
+            for seq_length in args.lengths:
+                scale = f'n{num_sequences}_l{seq_length}'
+                print(f'Benchmarking {scale}...', file=sys.stderr)
+                gb_path = temp_path.joinpath(f'{scale}.gb')
+                generate_genbank(gb_path, num_sequences, seq_length, args.num_species, args.seed)
+
+                runs = {}
+                for repeat in range(args.repeats):
+                    work_path = temp_path.joinpath(f'{scale}_{repeat}')
+                    work_path.mkdir()
+                    for stage, record in run_stages(pipeline, gb_path, work_path, args).items():
+                        runs.setdefault(stage, []).append(record)
+
+                results[scale] = {
+                    'num_sequences': num_sequences,
+                    'seq_length': seq_length,
+                    'stages': {
+                        stage: {
+                            'wall_min_s': min(record['wall_s'] for record in records),
+                            'wall_median_s': statistics.median(record['wall_s'] for record in records),
+                            'cpu_median_s': statistics.median(record['cpu_s'] for record in records),
+                            'wall_runs_s': [record['wall_s'] for record in records],
+                        }
+                        for stage, records in runs.items()
+                    },
+                }
+    return results
+
+def compare(results : dict, baseline : dict, tolerance : float) -> list:
+    """
+    Compare median wall times against a baseline.
+
+    Return:
+    regressions - list of (scale, stage, ratio) that are slower than 1 + tolerance
+    """
+    regressions = []
+    print(f'{"scale":<16}{"stage":<22}{"baseline_s":>12}{"current_s":>12}{"ratio":>8}')
+    for scale, result in results.items():
+        if scale not in baseline['results']:
+            continue
+        for stage, timing in result['stages'].items():
+            baseline_timing = baseline['results'][scale]['stages'].get(stage)
+            if baseline_timing is None:
+                continue
+            ratio = timing['wall_median_s'] / max(baseline_timing['wall_median_s'], 1e-9)
+            flag = ''
+            if ratio > 1 + tolerance:
+                regressions.append((scale, stage, ratio))
+                flag = '  REGRESSION'
+            print(f'{scale:<16}{stage:<22}{baseline_timing["wall_median_s"]:>12.4f}{timing["wall_median_s"]:>12.4f}{ratio:>8.2f}{flag}')
+    return regressions
+
+def main():
+    args = parse_args()
+    pipeline = load_pipeline()
+
+    results = benchmark(pipeline, args)
+
+    print(f'{"scale":<16}{"stage":<22}{"min_s":>10}{"median_s":>10}{"cpu_s":>10}')
+    for scale, result in results.items():
+        for stage, timing in result['stages'].items():
+            print(
+                f'{scale:<16}{stage:<22}{timing["wall_min_s"]:>10.4f}{timing["wall_median_s"]:>10.4f}'
+                f'{timing["cpu_median_s"]:>10.4f}'
+            )
+
+    if args.save_path:
+        baseline = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'biopython': Bio.__version__,
+            'platform': platform.platform(),
+            'repeats': args.repeats,
+            'num_species': args.num_species,
+            'seed': args.seed,
+            'results': results,
+        }
+        with open(args.save_path, 'w') as save_file:
+            json.dump(baseline, save_file, indent=2)
+        print(f'Baseline saved to {args.save_path}')
+
+    if args.baseline_path:
+        with open(args.baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} stage(s) slower than the baseline by more than {args.tolerance:.0%}')
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
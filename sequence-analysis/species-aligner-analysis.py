@@ -3,16 +3,46 @@ species_aligner_analysis.py - This script takes a Genbank file containing sequen
 species at a specific target site, aligns the sequences by species, and generates consensus sequences for
 each species. 
 
+Species that gained sequences since a previous run can be updated incrementally (--incremental), in which
+case only the new sequences are added to the existing alignments. Species that lost sequences are realigned,
+and the consensus of every species is recomputed if the consensus options changed since the previous run.
+
+Consensus sequences are computed in parallel across species (--jobs), and can be written to a single
+multi-FASTA file (--combined) instead of one file per species. For very deep alignments, --streaming reads
+the aligned FASTA one record at a time into per-column counts, so memory scales with the alignment length only.
+Ambiguity codes count as fractional votes for the bases they stand for; mixed positions can be called as IUPAC
+codes (--iupac), and near-duplicate sequences can be down-weighted (--weighting henikoff).
+
+Species can be dereplicated before alignment (--dereplicate): exact duplicates are collapsed by hash, and
+near-duplicates are optionally clustered with MinHash k-mer sketches (--cluster_jaccard). Only one representative
+per cluster is aligned, and its cluster size is used as its weight in the consensus.
+
+Every stage (parsing, metadata, FASTA output, each MAFFT call and each consensus) is timed, and the wall time,
+CPU time, input size and the maximum RSS reached so far of each stage are written to a JSON-lines run report.
+
 Author: Michael Ke
-Version: 1.0
+Version: 1.4
 Date: September 1st 2022
 """
 
 from argparse import ArgumentParser
+from contextlib import contextmanager
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import csv
+import hashlib
+import json
 import subprocess
+import sys
+import time
+try: 
+    import resource
+except ImportError: 
+    #resource is POSIX-only, maximum RSS and child CPU time are not reported without it
+    resource = None
+import numpy as np
 from Bio import SeqIO, AlignIO, Seq
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 
 def parse_args(): 
     parser = ArgumentParser('Analyze and align multiple sequences for genus-level analysis')
@@ -49,10 +79,105 @@ def parse_args():
         default=0.5,
         help='Minimum number of sequences represented for consensus to be generated',
     )
+    parser.add_argument(
+        '--incremental',
+        '-i',
+        action='store_true',
+        dest='incremental',
+        help='Only add new sequences to alignments from a previous run (MAFFT --add) and only recompute consensus for species that changed',
+    )
+    parser.add_argument(
+        '--dereplicate',
+        '-d',
+        action='store_true',
+        dest='dereplicate',
+        help='Collapse identical sequences of a species before alignment, weighting the consensus by cluster size',
+    )
+    parser.add_argument(
+        '--cluster_jaccard',
+        action='store',
+        dest='cluster_jaccard',
+        type=float,
+        default=None,
+        help='Also cluster near-duplicates whose estimated k-mer Jaccard similarity is at least this value (implies --dereplicate)',
+    )
+    parser.add_argument(
+        '--kmer_size',
+        action='store',
+        dest='kmer_size',
+        type=int,
+        default=16,
+        help='k-mer size of the MinHash sketches used for --cluster_jaccard (at most 32)',
+    )
+    parser.add_argument(
+        '--sketch_size',
+        action='store',
+        dest='sketch_size',
+        type=int,
+        default=128,
+        help='Number of hashes kept per MinHash sketch',
+    )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        action='store',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='Number of processes used to compute consensus sequences',
+    )
+    parser.add_argument(
+        '--iupac',
+        action='store_true',
+        dest='iupac',
+        help='Call IUPAC ambiguity codes at positions where no single base reaches min_cons',
+    )
+    parser.add_argument(
+        '--weighting',
+        action='store',
+        dest='weighting',
+        choices=('none', 'henikoff'),
+        default='none',
+        help='Sequence weighting for consensus votes (henikoff: position-based weights that down-weight near-duplicates)',
+    )
+    parser.add_argument(
+        '--streaming',
+        action='store_true',
+        dest='streaming',
+        help='Compute consensus sequences from per-column counts while streaming the alignment, instead of loading it into memory',
+    )
+    parser.add_argument(
+        '--combined',
+        action='store_true',
+        dest='combined',
+        help='Write all consensus sequences to one multi-FASTA file (<output>/consensus/<genbank name>_consensus.fasta)',
+    )
+    parser.add_argument(
+        '--report',
+        action='store',
+        dest='report_path',
+        default=None,
+        type=Path,
+        help='Path of the JSON-lines run report (default: <output>/<genbank name>_run_report.jsonl)',
+    )
+    parser.add_argument(
+        '--top',
+        action='store',
+        dest='top',
+        type=int,
+        default=10,
+        help='Number of slowest species to list in the run summary',
+    )
     args = parser.parse_args()
 
     if args.output_path is None: 
         args.output_path = args.gb_path.parent
+    if args.report_path is None: 
+        args.report_path = args.output_path.joinpath(f'{args.gb_path.stem}_run_report.jsonl')
+    if args.cluster_jaccard is not None: 
+        args.dereplicate = True
+    if not 0 < args.kmer_size <= 32: 
+        parser.error('--kmer_size must be between 1 and 32')
 
     return args
 
@@ -88,75 +213,601 @@ def parse_gb(gb_path : Path) -> list:
     
     return species_dict
 
-def get_consensus(alignment, min_con, min_rep):
+def get_consensus(alignment, min_con, min_rep, iupac=False, weights=None):
     """
-    Get the consensus sequence
+    Get the consensus sequence of an in-memory alignment. 
+
+    Parameters: 
+    alignment - MultipleSeqAlignment of the species
+    min_con - minimum fraction of covering sequences that must share the dominant base
+    min_rep - minimum fraction of sequences covering a position for it to be kept at the ends
+    iupac - call IUPAC ambiguity codes at mixed positions instead of 'N'
+    weights - optional dictionary of sequence ID to weight (missing IDs weigh 1)
+
+    Return: 
+    consensus sequence
     """
-    cons_sequence = []
-    
-    #Determine sequence representation
-    sequence_regions = []
-    num_sequence = len(alignment)
+    column_counts = ColumnCounts()
     for sequence in alignment: 
-        start_base = sequence.seq.ungap()[0]
-        end_base = sequence.seq.ungap()[-1]
-        start_index = sequence.seq.find(start_base) #inclusive
-        end_index = sequence.seq.rfind(end_base)+1 #exclusive
-        sequence_regions.append((start_index, end_index))
-    
-    seq_rep = []
+        weight = 1.0 if weights is None else weights.get(sequence.id, 1.0)
+        column_counts.add(str(sequence.seq), weight)
+    return column_counts.consensus(min_con, min_rep, iupac)
 
-    for position in range(alignment.get_alignment_length()): 
-        seq_rep.append(0)
-        for region in sequence_regions:
-            if (position >= region[0]) and (position < region[1]): 
-                seq_rep[position] = seq_rep[position] + 1
-    
-    seq_rep_ratio = [position/num_sequence for position in seq_rep]
-
-    #Determine which sequences pass the min_rep score
-    #Start with the left index
-    #Finish with the right index
-    num_sequence = len(alignment)
-    left_index = 0
-    reverse_right_index = -1
-    while (seq_rep_ratio[left_index]) < min_rep: 
-        left_index = left_index + 1
-    while (seq_rep_ratio[reverse_right_index]) < min_rep: 
-        reverse_right_index = reverse_right_index - 1
-    right_index = alignment.get_alignment_length() + reverse_right_index + 1
-
-    #Determine the dominant base at each position
-    for position in range(left_index, right_index): 
-        bases = alignment[:,position].upper()
-        
-        num_bases = seq_rep[position]
-
-        counts = {
-            'A':bases.count('A'),
-            'C':bases.count('C'),
-            'T':bases.count('T'),
-            'G':bases.count('G'),
+#Base order of the consensus votes. This is the order the bases were originally checked in, 
+#so ties between bases keep being resolved the same way.
+CONSENSUS_BASES = 'ACTG'
+
+#Fraction of a vote each IUPAC code gives to A, C, T and G
+IUPAC_BASES = {
+    'A': 'A', 'C': 'C', 'T': 'T', 'G': 'G', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT',
+}
+_BASE_VOTES = np.zeros((256, len(CONSENSUS_BASES)), dtype=np.float64)
+for _code, _bases in IUPAC_BASES.items(): 
+    for _base in _bases: 
+        _BASE_VOTES[ord(_code), CONSENSUS_BASES.index(_base)] = 1 / len(_bases)
+        _BASE_VOTES[ord(_code.lower()), CONSENSUS_BASES.index(_base)] = 1 / len(_bases)
+
+#IUPAC code of every set of bases, indexed by a bit mask in CONSENSUS_BASES order
+_IUPAC_CODES = np.full(2 ** len(CONSENSUS_BASES), ord('N'), dtype=np.uint8)
+for _code, _bases in IUPAC_BASES.items(): 
+    if _code != 'U': 
+        _IUPAC_CODES[sum(1 << CONSENSUS_BASES.index(_base) for _base in _bases)] = ord(_code)
+
+#Symbol classes used for sequence weighting (A, C, T, G, gap, anything else)
+GAP_ROW = len(CONSENSUS_BASES)
+OTHER_ROW = GAP_ROW + 1
+_ROW_LOOKUP = np.full(256, OTHER_ROW, dtype=np.intp)
+for _row, _base in enumerate(CONSENSUS_BASES): 
+    _ROW_LOOKUP[ord(_base)] = _row
+    _ROW_LOOKUP[ord(_base.lower())] = _row
+_ROW_LOOKUP[ord('-')] = GAP_ROW
+
+class ColumnCounts: 
+    """
+    Weighted per-column base votes, gap counts and sequence coverage of an alignment, 
+    accumulated one aligned sequence at a time into fixed-size arrays. Ambiguity codes 
+    split their vote between the bases they stand for. 
+    """
+    def __init__(self): 
+        self.alignment_length = None
+        self.num_sequences = 0
+        self.total_weight = 0.0
+        self.base_votes = None
+        self.gap_counts = None
+        self._coverage_changes = None
+
+    def add(self, sequence : str, weight : float = 1.0) -> None: 
+        """
+        Add one aligned sequence to the counts. 
+
+        Parameters: 
+        sequence - aligned sequence, gaps as '-'
+        weight - weight of the sequence's votes
+        """
+        if self.alignment_length is None: 
+            self.alignment_length = len(sequence)
+            self.base_votes = np.zeros((len(CONSENSUS_BASES), self.alignment_length), dtype=np.float64)
+            self.gap_counts = np.zeros(self.alignment_length, dtype=np.float64)
+            self._coverage_changes = np.zeros(self.alignment_length + 1, dtype=np.float64)
+        elif len(sequence) != self.alignment_length: 
+            raise ValueError('Sequences must all be the same length')
+
+        symbols = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+        self.base_votes += weight * _BASE_VOTES[symbols].T
+        gaps = symbols == ord('-')
+        self.gap_counts[gaps] += weight
+
+        #The sequence covers the span from its first to its last non-gap position
+        non_gap = np.flatnonzero(~gaps)
+        if non_gap.size: 
+            self._coverage_changes[non_gap[0]] += weight
+            self._coverage_changes[non_gap[-1] + 1] -= weight
+        self.num_sequences = self.num_sequences + 1
+        self.total_weight = self.total_weight + weight
+
+    @property
+    def coverage(self) -> np.ndarray: 
+        """
+        Weight of the sequences whose span covers each column. 
+        """
+        return np.cumsum(self._coverage_changes[:-1])
+
+    def consensus(self, min_con : float, min_rep : float, iupac : bool = False) -> str: 
+        """
+        Call the consensus sequence. 
+
+        Parameters: 
+        min_con - minimum fraction of covering sequences that must share the dominant base
+        min_rep - minimum fraction of sequences covering a column for it to be kept at the ends
+        iupac - at columns where no single base reaches min_con, call the IUPAC code of the 
+                fewest bases that together reach it
+
+        Return: 
+        consensus sequence, 'N' where no base (or set of bases) reaches min_con
+        """
+        if not self.num_sequences or self.total_weight <= 0: 
+            return ''
+        coverage = self.coverage
+        represented = np.flatnonzero(coverage / self.total_weight >= min_rep)
+        if not represented.size: 
+            return ''
+        left_index = represented[0]
+        right_index = represented[-1] + 1
+
+        base_votes = self.base_votes[:, left_index:right_index]
+        region_coverage = coverage[left_index:right_index]
+        columns = np.arange(right_index - left_index)
+
+        #Rank the bases of every column by votes, ties keep CONSENSUS_BASES order
+        ranked = np.argsort(-base_votes, axis=0, kind='stable')
+        with np.errstate(divide='ignore', invalid='ignore'): 
+            ranked_fractions = np.cumsum(base_votes[ranked, columns], axis=0) / region_coverage
+        reached = (region_coverage > 0) & (ranked_fractions >= min_con)
+        if not iupac: 
+            #Only the dominant base on its own can be called
+            reached[1:] = False
+
+        #Bit mask of the fewest top-ranked bases that reach min_con
+        num_called = np.argmax(reached, axis=0) + 1
+        included = np.arange(len(CONSENSUS_BASES))[:, None] < num_called
+        masks = np.sum(np.where(included, 1 << ranked, 0), axis=0)
+        symbols = _IUPAC_CODES[masks]
+        symbols[~reached.any(axis=0)] = ord('N')
+        return symbols.tobytes().decode('ascii')
+
+def henikoff_weights(alignment_fasta_path : Path) -> dict: 
+    """
+    Position-based sequence weights (Henikoff & Henikoff 1994), which down-weight 
+    near-duplicate sequences. Each column gives 1/(r*n) to a sequence, with r the 
+    number of different symbols in the column and n the number of sequences sharing 
+    the sequence's symbol. Weights are scaled to average 1. The alignment is streamed 
+    twice, so memory stays proportional to the alignment length. 
+
+    Parameters: 
+    alignment_fasta_path - path to the aligned FASTA file
+
+    Return: 
+    weights - dictionary of sequence ID to weight
+    """
+    symbol_counts = None
+    with open(alignment_fasta_path) as alignment_fasta: 
+        for _, sequence in SimpleFastaParser(alignment_fasta): 
+            rows = _ROW_LOOKUP[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+            if symbol_counts is None: 
+                symbol_counts = np.zeros((OTHER_ROW + 1, rows.size), dtype=np.int64)
+            symbol_counts[rows, np.arange(rows.size)] += 1
+    if symbol_counts is None: 
+        return {}
+
+    num_symbols = np.count_nonzero(symbol_counts, axis=0)
+    with np.errstate(divide='ignore'): 
+        symbol_scores = 1 / (symbol_counts * num_symbols)
+    weights = {}
+    with open(alignment_fasta_path) as alignment_fasta: 
+        for title, sequence in SimpleFastaParser(alignment_fasta): 
+            rows = _ROW_LOOKUP[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+            weights[title.split(' ')[0]] = float(symbol_scores[rows, np.arange(rows.size)].sum())
+    scale = len(weights) / sum(weights.values())
+    return {sequence_id: weight * scale for sequence_id, weight in weights.items()}
+
+def count_alignment_columns(alignment_fasta_path : Path, weights : dict = None) -> ColumnCounts: 
+    """
+    Stream an aligned FASTA file one record at a time into a ColumnCounts, so memory 
+    is proportional to the alignment length rather than the whole alignment. 
+
+    Parameters: 
+    alignment_fasta_path - path to the aligned FASTA file
+    weights - optional dictionary of sequence ID to weight (missing IDs weigh 1)
+
+    Return: 
+    column_counts - ColumnCounts of every sequence in the file
+    """
+    column_counts = ColumnCounts()
+    with open(alignment_fasta_path) as alignment_fasta: 
+        for title, sequence in SimpleFastaParser(alignment_fasta): 
+            weight = 1.0 if weights is None else weights.get(title.split(' ')[0], 1.0)
+            column_counts.add(sequence, weight)
+    return column_counts
+
+#2-bit codes of the bases for k-mer hashing, anything else breaks a k-mer
+_KMER_CODES = np.full(256, 4, dtype=np.uint64)
+for _code, _base in enumerate('ACGT'): 
+    _KMER_CODES[ord(_base)] = _code
+    _KMER_CODES[ord(_base.lower())] = _code
+
+def _mix64(values : np.ndarray) -> np.ndarray: 
+    """
+    splitmix64 finalizer, spreads k-mer codes uniformly over 64-bit hashes. 
+    """
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+def kmer_sketch(sequence : str, kmer_size : int, sketch_size : int) -> np.ndarray: 
+    """
+    Bottom-k MinHash sketch of the canonical k-mers of a sequence. 
+
+    Parameters: 
+    sequence - unaligned sequence
+    kmer_size - k-mer length (at most 32)
+    sketch_size - number of smallest hashes kept
+
+    Return: 
+    sketch - sorted array of up to sketch_size unique hashes
+    """
+    codes = _KMER_CODES[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+    num_kmers = codes.size - kmer_size + 1
+    if num_kmers < 1: 
+        return np.empty(0, dtype=np.uint64)
+    #k-mers containing anything other than A/C/G/T are skipped
+    invalid = np.concatenate([[0], np.cumsum(codes > 3)])
+    valid = (invalid[kmer_size:] - invalid[:num_kmers]) == 0
+    complement = np.uint64(3) - np.minimum(codes, np.uint64(3))
+    forward = np.zeros(num_kmers, dtype=np.uint64)
+    reverse = np.zeros(num_kmers, dtype=np.uint64)
+    for offset in range(kmer_size): 
+        forward = (forward << np.uint64(2)) | np.minimum(codes[offset:offset + num_kmers], np.uint64(3))
+        reverse = reverse | (complement[offset:offset + num_kmers] << np.uint64(2 * offset))
+    return np.unique(_mix64(np.minimum(forward, reverse)[valid]))[:sketch_size]
+
+def sketch_jaccard(sketch : np.ndarray, cluster_sketches : np.ndarray, cluster_maxima : np.ndarray) -> np.ndarray: 
+    """
+    Estimate the Jaccard similarity between one sequence and many others from their 
+    bottom-k sketches. For each pair, only hashes up to the smaller of the two sketch 
+    maxima are compared, where both sketches are complete. 
+
+    Parameters: 
+    sketch - sorted sketch of the sequence
+    cluster_sketches - 2D array of the other sketches, padded with the maximum uint64
+    cluster_maxima - largest real hash of each of the other sketches
+
+    Return: 
+    jaccard - estimated Jaccard similarity to each of the other sketches
+    """
+    thresholds = np.minimum(cluster_maxima, sketch[-1])[:, None]
+    in_range = cluster_sketches <= thresholds
+    positions = np.minimum(np.searchsorted(sketch, cluster_sketches), sketch.size - 1)
+    shared = np.count_nonzero((sketch[positions] == cluster_sketches) & in_range, axis=1)
+    union = np.searchsorted(sketch, thresholds[:, 0], side='right') + np.count_nonzero(in_range, axis=1) - shared
+    return shared / np.maximum(union, 1)
+
+def dereplicate(gb_entries : list, cluster_jaccard : float = None, kmer_size : int = 16, sketch_size : int = 128, preferred_ids : set = None) -> tuple: 
+    """
+    Collapse the sequences of a species into representatives before alignment. Exact 
+    duplicates (case-insensitive) are collapsed by hash; with cluster_jaccard, the 
+    remaining sequences are greedily clustered by MinHash sketch similarity. The first 
+    sequence of a cluster is its representative, with preferred IDs (e.g. sequences 
+    that are already aligned) considered first so they stay representatives. 
+
+    Parameters: 
+    gb_entries - list of SeqRecords of the species
+    cluster_jaccard - minimum estimated Jaccard similarity to join a cluster, None for exact only
+    kmer_size - k-mer length of the sketches
+    sketch_size - number of hashes per sketch
+    preferred_ids - IDs to consider first
+
+    Return: 
+    (representatives, multiplicity) - list of representative SeqRecords, and dictionary 
+    of representative ID to the number of sequences it stands for
+    """
+    preferred_ids = preferred_ids or set()
+    ordered_entries = (
+        [gb_entry for gb_entry in gb_entries if gb_entry.id in preferred_ids]
+        + [gb_entry for gb_entry in gb_entries if gb_entry.id not in preferred_ids]
+    )
+
+    #Exact duplicates
+    unique_entries = {}
+    multiplicity = {}
+    for gb_entry in ordered_entries: 
+        sequence_hash = hashlib.sha1(str(gb_entry.seq).upper().encode('ascii')).digest()
+        if sequence_hash in unique_entries: 
+            multiplicity[unique_entries[sequence_hash].id] += 1
+        else: 
+            unique_entries[sequence_hash] = gb_entry
+            multiplicity[gb_entry.id] = 1
+    representatives = list(unique_entries.values())
+    if cluster_jaccard is None: 
+        return (representatives, multiplicity)
+
+    #Near-duplicates, every sequence is compared to all cluster representatives at once
+    cluster_representatives = []
+    cluster_sketches = np.full((16, sketch_size), np.iinfo(np.uint64).max, dtype=np.uint64)
+    cluster_maxima = np.zeros(16, dtype=np.uint64)
+    for gb_entry in representatives: 
+        sketch = kmer_sketch(str(gb_entry.seq), kmer_size, sketch_size)
+        num_clusters = len(cluster_representatives)
+        if sketch.size and num_clusters: 
+            jaccard = sketch_jaccard(sketch, cluster_sketches[:num_clusters], cluster_maxima[:num_clusters])
+            best_index = int(np.argmax(jaccard))
+            if jaccard[best_index] >= cluster_jaccard: 
+                multiplicity[cluster_representatives[best_index].id] += multiplicity.pop(gb_entry.id)
+                continue
+        if num_clusters == len(cluster_maxima): 
+            cluster_sketches = np.vstack([cluster_sketches, np.full_like(cluster_sketches, np.iinfo(np.uint64).max)])
+            cluster_maxima = np.concatenate([cluster_maxima, np.zeros_like(cluster_maxima)])
+        cluster_representatives.append(gb_entry)
+        cluster_sketches[num_clusters, :sketch.size] = sketch
+        cluster_maxima[num_clusters] = sketch[-1] if sketch.size else 0
+    return (cluster_representatives, multiplicity)
+
+def read_weights(weights_path : Path) -> dict: 
+    """
+    Read a tab-separated file of sequence ID and weight. 
+    """
+    with open(weights_path, newline='') as weights_file: 
+        return {sequence_id: float(weight) for sequence_id, weight in csv.reader(weights_file, delimiter='\t')}
+
+def write_weights(weights_path : Path, weights : dict) -> bool: 
+    """
+    Write a tab-separated file of sequence ID and weight. 
+
+    Return: 
+    True if the weights differ from the ones already in the file
+    """
+    changed = (not weights_path.exists()) or read_weights(weights_path) != {sequence_id: float(weight) for sequence_id, weight in weights.items()}
+    with open(weights_path, 'w', newline='') as weights_file: 
+        csv.writer(weights_file, delimiter='\t').writerows(weights.items())
+    return changed
+
+#Consensus options of the last run, stored next to the consensus files
+CONSENSUS_PARAMETERS_NAME = 'consensus_parameters.json'
+
+def get_aligned_ids(aligned_fasta_path : Path) -> set: 
+    """
+    Get the IDs of the sequences already present in an aligned FASTA file. 
+
+    Parameters: 
+    aligned_fasta_path - path to the aligned FASTA file produced by a previous run
+
+    Return: 
+    aligned_ids - set of sequence IDs (first word of each FASTA header)
+    """
+    with open(aligned_fasta_path) as aligned_fasta: 
+        return {title.split(' ')[0] for title, _ in SimpleFastaParser(aligned_fasta)}
+
+def run_alignment(species_fasta_path : Path, aligned_fasta_path : Path) -> bool: 
+    """
+    Align all the sequences of a species FASTA file from scratch with MAFFT. 
+
+    Parameters: 
+    species_fasta_path - path to the unaligned species FASTA file
+    aligned_fasta_path - path the alignment is written to
+
+    Return: 
+    True if the alignment was written, False if MAFFT failed (nothing is written, 
+    so a failed run never leaves an empty alignment behind for incremental runs). 
+    """
+    mafft_args = [
+        'mafft',
+        '--auto',
+        str(species_fasta_path),
+    ]
+    result = subprocess.run(mafft_args, capture_output=True)
+    if result.returncode != 0 or not result.stdout.strip(): 
+        return False
+    with open(aligned_fasta_path, 'w') as aligned_fasta: 
+        decoded = result.stdout.decode('utf-8')
+        aligned_fasta.write(decoded)
+    return True
+
+def add_to_alignment(new_entries : list, aligned_fasta_path : Path) -> bool: 
+    """
+    Add new sequences to an existing alignment with MAFFT's --add mode, so only 
+    the new sequences are aligned instead of the whole species. 
+
+    Parameters: 
+    new_entries - list of SeqRecords that are not in the alignment yet
+    aligned_fasta_path - path to the existing alignment, replaced on success
+
+    Return: 
+    True if the alignment was updated, False if MAFFT failed (the existing 
+    alignment is left untouched). 
+    """
+    new_fasta_path = aligned_fasta_path.with_name(f'{aligned_fasta_path.stem}_new.fasta')
+    SeqIO.write(new_entries, new_fasta_path, 'fasta')
+    mafft_args = [
+        'mafft',
+        '--auto',
+        '--add',
+        str(new_fasta_path),
+        str(aligned_fasta_path),
+    ]
+    result = subprocess.run(mafft_args, capture_output=True)
+    new_fasta_path.unlink()
+    if result.returncode != 0 or not result.stdout.strip(): 
+        return False
+    with open(aligned_fasta_path, 'w') as aligned_fasta: 
+        aligned_fasta.write(result.stdout.decode('utf-8'))
+    return True
+
+def _resource_usage() -> tuple: 
+    """
+    Get the current CPU time (this process and its finished children, e.g. MAFFT) 
+    and the maximum RSS in MB reached so far by this process or its largest child. 
+    ru_maxrss is a high-water mark over the whole process lifetime, not per stage. 
+    """
+    cpu_time = time.process_time()
+    if resource is None: 
+        return (cpu_time, None)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = cpu_time + child_usage.ru_utime + child_usage.ru_stime
+    #ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    rss_unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    max_rss = max(self_usage.ru_maxrss, child_usage.ru_maxrss) / rss_unit
+    return (cpu_time, max_rss)
+
+@contextmanager
+def measure(record : dict): 
+    """
+    Context manager that adds the wall time and CPU time of the enclosed block to a 
+    stage record, and the maximum RSS reached so far at its end (max_rss_so_far_mb). 
+    The RSS only shows a stage's own memory use when the maximum grows during that stage. 
+
+    Parameters: 
+    record - dictionary describing the stage, timing keys are added to it
+    """
+    start_cpu, _ = _resource_usage()
+    start_wall = time.perf_counter()
+    try: 
+        yield record
+    finally: 
+        end_wall = time.perf_counter()
+        end_cpu, max_rss = _resource_usage()
+        record['wall_s'] = round(end_wall - start_wall, 6)
+        record['cpu_s'] = round(end_cpu - start_cpu, 6)
+        record['max_rss_so_far_mb'] = None if max_rss is None else round(max_rss, 2)
+
+class RunReport: 
+    """
+    Collects one record per pipeline stage and writes each one as a line of 
+    JSON as soon as the stage finishes. 
+    """
+    def __init__(self, report_path : Path): 
+        self.report_path = report_path
+        self.records = []
+        self._report_file = open(report_path, 'w')
+
+    def write(self, record : dict) -> None: 
+        """
+        Add a finished stage record to the report. 
+        """
+        if record.get('num_sequences') is not None and record.get('seq_length') is not None: 
+            record['input_cells'] = record['num_sequences'] * record['seq_length']
+        self.records.append(record)
+        self._report_file.write(json.dumps(record) + '\n')
+        self._report_file.flush()
+
+    @contextmanager
+    def stage(self, stage : str, species : str = None, num_sequences : int = None, seq_length : int = None): 
+        """
+        Time the enclosed block and write it to the report as a stage record. 
+
+        Parameters: 
+        stage - name of the stage (parse, metadata, fasta, align, consensus)
+        species - species the stage worked on, if any
+        num_sequences - number of sequences given to the stage
+        seq_length - (maximum) length of those sequences
+        """
+        record = {
+            'stage': stage,
+            'species': species,
+            'num_sequences': num_sequences,
+            'seq_length': seq_length,
         }
-        cons_base = max(counts, key=counts.get)
-        if (counts[cons_base]/num_bases) >= min_con: 
-            cons_sequence.append(cons_base)
+        try: 
+            with measure(record): 
+                yield record
+        finally: 
+            self.write(record)
+
+    def close(self) -> None: 
+        self._report_file.close()
+
+    def summary(self, top : int) -> str: 
+        """
+        Summarize where the time went: totals per stage, and the slowest species 
+        split into alignment (MAFFT) and consensus (Python) time. 
+
+        Parameters: 
+        top - number of species to list
+
+        Return: 
+        summary - printable table
+        """
+        stage_totals = {}
+        species_totals = {}
+        for record in self.records: 
+            stage_totals[record['stage']] = stage_totals.get(record['stage'], 0) + record['wall_s']
+            if record['species'] is None: 
+                continue
+            totals = species_totals.setdefault(record['species'], {'align': 0, 'consensus': 0, 'num_sequences': 0})
+            if record['stage'] in totals: 
+                totals[record['stage']] = totals[record['stage']] + record['wall_s']
+            if record['stage'] == 'consensus': 
+                totals['num_sequences'] = record['num_sequences']
+
+        lines = ['Time per stage (s):']
+        for stage, total in stage_totals.items(): 
+            lines.append(f'  {stage:<12}{total:>12.3f}')
+        slowest = sorted(species_totals.items(), key=lambda x: x[1]['align'] + x[1]['consensus'], reverse=True)[:top]
+        lines.append(f'Slowest {len(slowest)} species (s):')
+        lines.append(f'  {"species":<40}{"#_seqs":>8}{"align":>12}{"consensus":>12}{"total":>12}')
+        for species, totals in slowest: 
+            lines.append(
+                f'  {species:<40}{totals["num_sequences"]:>8}{totals["align"]:>12.3f}'
+                f'{totals["consensus"]:>12.3f}{totals["align"] + totals["consensus"]:>12.3f}'
+            )
+        return '\n'.join(lines)
+
+def consensus_worker(alignment_fasta_path : Path, min_con : float, min_rep : float, streaming : bool = False, iupac : bool = False, weighting : str = 'none') -> tuple: 
+    """
+    Read one species alignment and compute its consensus sequence. Runs in a 
+    worker process, so the stage record is measured here and returned. 
+
+    Parameters: 
+    alignment_fasta_path - path to the aligned species FASTA file
+    min_con - minimum fraction of identical bases for a consensus base
+    min_rep - minimum fraction of sequences represented for a position to be kept
+    streaming - use count_alignment_columns() instead of holding the alignment in memory
+    iupac - call IUPAC ambiguity codes at mixed positions
+    weighting - 'none' or 'henikoff' sequence weights
+
+    Return: 
+    (species_name, cons_seq, record)
+    """
+    species_name = alignment_fasta_path.stem.split('_')[0]
+    record = {
+        'stage': 'consensus',
+        'species': species_name,
+        'num_sequences': None,
+        'seq_length': None,
+    }
+    with measure(record): 
+        weights = henikoff_weights(alignment_fasta_path) if weighting == 'henikoff' else None
+        #Dereplicated representatives also count for the sequences collapsed into them
+        weights_path = alignment_fasta_path.with_name(f'{species_name}_weights.tsv')
+        if weights_path.exists(): 
+            multiplicity = read_weights(weights_path)
+            if weights is None: 
+                weights = multiplicity
+            else: 
+                weights = {sequence_id: weight * multiplicity.get(sequence_id, 1) for sequence_id, weight in weights.items()}
+        if streaming: 
+            column_counts = count_alignment_columns(alignment_fasta_path, weights)
+            cons_seq = column_counts.consensus(min_con, min_rep, iupac)
+            record['num_sequences'] = column_counts.num_sequences
+            record['seq_length'] = column_counts.alignment_length
         else: 
-            cons_sequence.append('N')
-    return ''.join(cons_sequence)
+            species_alignment = AlignIO.read(alignment_fasta_path, 'fasta')
+            cons_seq = get_consensus(species_alignment, min_con, min_rep, iupac, weights)
+            record['num_sequences'] = len(species_alignment)
+            record['seq_length'] = species_alignment.get_alignment_length()
+    return (species_name, cons_seq, record)
 
 def main(): 
     args = parse_args()
+    report = RunReport(args.report_path)
     
     #Parse Genbank file data
     print('Parsing Genbank file..')
-    species_dict = parse_gb(args.gb_path)
+    with report.stage('parse') as record: 
+        species_dict = parse_gb(args.gb_path)
+        record['num_sequences'] = sum(len(entries) for entries in species_dict.values())
+        record['seq_length'] = max((len(gb_entry) for entries in species_dict.values() for gb_entry in entries), default=0)
+        record['num_species'] = len(species_dict)
+    #The metadata and FASTA stages work on all of the parsed sequences
+    input_size = {key: record[key] for key in ('num_sequences', 'seq_length', 'num_species')}
     print('Parsing complete!')
 
     #Generate metadata for entire analysis:
     print('Generating metadata...') 
     metadata_path = args.output_path.joinpath(f'{args.gb_path.stem}_metadata.csv')
-    with open(metadata_path, 'w', newline='') as metadata_file: 
+    with report.stage('metadata', None, input_size['num_sequences'], input_size['seq_length']) as record, open(metadata_path, 'w', newline='') as metadata_file: 
+        record['num_species'] = input_size['num_species']
         num_species = len(species_dict.keys()) - 1 # -1 cause of 'unknown' key
         num_unknown = len(species_dict['unknown'])
 
@@ -178,46 +829,185 @@ def main():
     print('Outputting species fasta files...')
     species_path = args.output_path.joinpath('fasta')
     Path.mkdir(species_path, exist_ok=True)
-    for species in species_dict: 
-        species_fasta_path = species_path.joinpath(f'{species.replace(" ", "-")}.fasta')
-        SeqIO.write(species_dict[species], species_fasta_path, 'fasta')
+    species_fasta_paths = {}
+    with report.stage('fasta', None, input_size['num_sequences'], input_size['seq_length']) as record: 
+        record['num_species'] = input_size['num_species']
+        for species in species_dict: 
+            species_fasta_path = species_path.joinpath(f'{species.replace(" ", "-")}.fasta')
+            SeqIO.write(species_dict[species], species_fasta_path, 'fasta')
+            species_fasta_paths[species] = species_fasta_path
     print('Species fasta files outputted!')
 
     #Create alignments
+    #In incremental mode, species whose sequences were all aligned in a previous run are skipped,
+    #and species that only gained sequences have the new ones added to the existing alignment.
+    #With dereplication, only the representative of each cluster is aligned.
     align_path = args.output_path.joinpath('aligned')
     Path.mkdir(align_path, exist_ok=True)
+    if args.dereplicate: 
+        derep_path = args.output_path.joinpath('derep')
+        Path.mkdir(derep_path, exist_ok=True)
     print('Generating alignments..')
-    for species_fasta_path in species_path.glob('*.fasta'): 
-        print(f'{species_fasta_path.stem} being aligned...')
+    updated_alignments = []
+    #Alignments kept from the previous run, whose consensus is only reused if the consensus options did not change
+    kept_alignments = []
+    for species, species_fasta_path in species_fasta_paths.items(): 
+        if not species_dict[species]: 
+            continue
         aligned_fasta_path = align_path.joinpath(f'{species_fasta_path.stem}_aligned.fasta')
-        mafft_args = [
-            'mafft',
-            '--auto',
-            str(species_fasta_path),
-        ]
-        result = subprocess.run(mafft_args, capture_output=True)
-        with open(aligned_fasta_path, 'w') as aligned_fasta: 
-            decoded = result.stdout.decode('utf-8')
-            aligned_fasta.write(decoded)
+        weights_path = align_path.joinpath(f'{species_fasta_path.stem}_weights.tsv')
+        seq_length = max(len(gb_entry) for gb_entry in species_dict[species])
+        previous_alignment = args.incremental and aligned_fasta_path.exists()
+        aligned_ids = get_aligned_ids(aligned_fasta_path) if previous_alignment else set()
+
+        species_entries = species_dict[species]
+        align_input_path = species_fasta_path
+        if args.dereplicate: 
+            with report.stage('derep', species_fasta_path.stem, len(species_entries), seq_length) as record: 
+                species_entries, multiplicity = dereplicate(
+                    species_entries, args.cluster_jaccard, args.kmer_size, args.sketch_size, aligned_ids,
+                )
+                record['num_representatives'] = len(species_entries)
+            weights_changed = write_weights(weights_path, multiplicity)
+            align_input_path = derep_path.joinpath(species_fasta_path.name)
+            SeqIO.write(species_entries, align_input_path, 'fasta')
+            print(f'{species_fasta_path.stem}: {len(species_entries)} representative(s) of {len(species_dict[species])} sequence(s)')
+        else: 
+            weights_changed = weights_path.exists()
+            if weights_changed: 
+                weights_path.unlink()
+
+        if previous_alignment: 
+            species_ids = {gb_entry.id for gb_entry in species_entries}
+            new_entries = [gb_entry for gb_entry in species_entries if gb_entry.id not in aligned_ids]
+            if aligned_ids <= species_ids and not new_entries: 
+                if weights_changed: 
+                    print(f'{species_fasta_path.stem} has no new sequences, but its weights changed.')
+                    updated_alignments.append(aligned_fasta_path)
+                else: 
+                    print(f'{species_fasta_path.stem} has no new sequences, skipping.')
+                    kept_alignments.append(aligned_fasta_path)
+                continue
+            if aligned_ids <= species_ids: 
+                print(f'{species_fasta_path.stem}: adding {len(new_entries)} new sequence(s) to existing alignment...')
+                with report.stage('align', species_fasta_path.stem, len(new_entries), seq_length) as record: 
+                    record['mode'] = 'add'
+                    added = add_to_alignment(new_entries, aligned_fasta_path)
+                if added: 
+                    updated_alignments.append(aligned_fasta_path)
+                    print(f'{species_fasta_path.stem} aligned.')
+                else: 
+                    print(f'{species_fasta_path.stem}: MAFFT --add failed, existing alignment kept.')
+                    kept_alignments.append(aligned_fasta_path)
+                continue
+            #Sequences were removed since the last run, so the existing alignment can't be reused
+            print(f'{species_fasta_path.stem} lost sequences since the last run, realigning...')
+
+        print(f'{species_fasta_path.stem} being aligned...')
+        with report.stage('align', species_fasta_path.stem, len(species_entries), seq_length) as record: 
+            record['mode'] = 'full'
+            aligned = run_alignment(align_input_path, aligned_fasta_path)
+        if not aligned: 
+            print(f'{species_fasta_path.stem}: MAFFT failed, no alignment written.')
+            continue
+        updated_alignments.append(aligned_fasta_path)
         print(f'{species_fasta_path.stem} aligned.')
     print('Alignments completed.')
 
     #Generate consensus sequences
+    #Species are spread over a process pool and each consensus is written as soon as it is ready.
     print('Generating consensus sequences...')
     consensus_path = args.output_path.joinpath('consensus')
     Path.mkdir(consensus_path, exist_ok=True)
-    for alignment_fasta_path in align_path.glob('*.fasta'):
-        species_name = alignment_fasta_path.stem.split('_')[0]
-        print(f'Working on {species_name}')
-        species_alignment = AlignIO.read(alignment_fasta_path, 'fasta')
-        cons_seq = get_consensus(species_alignment, args.min_cons, args.min_rep)
+    parameters_path = consensus_path.joinpath(CONSENSUS_PARAMETERS_NAME)
+    consensus_parameters = {'min_cons': args.min_cons, 'min_rep': args.min_rep, 'iupac': args.iupac, 'weighting': args.weighting}
+    previous_parameters = None
+    if parameters_path.exists(): 
+        with open(parameters_path) as parameters_file: 
+            previous_parameters = json.load(parameters_file)
+    if kept_alignments and previous_parameters != consensus_parameters: 
+        print('Consensus options changed since the last run, recomputing the consensus of every species.')
+        updated_alignments.extend(kept_alignments)
+        kept_alignments = []
+    combined_fasta_path = consensus_path.joinpath(f'{args.gb_path.stem}_consensus.fasta')
+    #Previous consensus of the species that are not recomputed: from the combined file, or else from the
+    #per-species files (the last run may have written the other output); species without one are recomputed
+    previous_consensus = dict()
+    if args.incremental and args.combined and combined_fasta_path.exists(): 
+        with open(combined_fasta_path) as previous_fasta: 
+            previous_consensus = dict(SimpleFastaParser(previous_fasta))
+    for aligned_fasta_path in list(kept_alignments): 
+        species_name = aligned_fasta_path.stem.split('_')[0]
         consensus_fasta_path = consensus_path.joinpath(f'{species_name}_consensus.fasta')
-        with open(consensus_fasta_path, 'w') as consensus_fasta: 
-            consensus_fasta.write(f'>{species_name}\n')
-            consensus_fasta.write(f'{cons_seq}')
+        if args.combined and species_name not in previous_consensus and consensus_fasta_path.exists(): 
+            with open(consensus_fasta_path) as consensus_fasta: 
+                previous_consensus.update(SimpleFastaParser(consensus_fasta))
+        if species_name in previous_consensus if args.combined else consensus_fasta_path.exists(): 
+            continue
+        print(f'{species_name} has no consensus from the last run, recomputing it.')
+        kept_alignments.remove(aligned_fasta_path)
+        updated_alignments.append(aligned_fasta_path)
+    combined_fasta = None
+    if args.combined: 
+        partial_fasta_path = combined_fasta_path.with_suffix('.fasta.partial')
+        combined_fasta = open(partial_fasta_path, 'w')
+    finished_species = set()
+
+    def output_consensus(species_name : str, cons_seq : str, record : dict) -> None: 
+        report.write(record)
+        if combined_fasta is not None: 
+            combined_fasta.write(f'>{species_name}\n{cons_seq}\n')
+        else: 
+            consensus_fasta_path = consensus_path.joinpath(f'{species_name}_consensus.fasta')
+            with open(consensus_fasta_path, 'w') as consensus_fasta: 
+                consensus_fasta.write(f'>{species_name}\n')
+                consensus_fasta.write(f'{cons_seq}')
+        finished_species.add(species_name)
         print(f'{species_name} consensus: ')
         print(cons_seq)
+
+    #A failed consensus (e.g. an unreadable alignment) leaves no partial combined file behind
+    try: 
+        if args.jobs > 1: 
+            with ProcessPoolExecutor(max_workers=args.jobs) as executor: 
+                futures = [
+                    executor.submit(
+                        consensus_worker, alignment_fasta_path, args.min_cons, args.min_rep, 
+                        args.streaming, args.iupac, args.weighting,
+                    )
+                    for alignment_fasta_path in updated_alignments
+                ]
+                for future in as_completed(futures): 
+                    output_consensus(*future.result())
+        else: 
+            for alignment_fasta_path in updated_alignments:
+                print(f'Working on {alignment_fasta_path.stem.split("_")[0]}')
+                output_consensus(*consensus_worker(
+                    alignment_fasta_path, args.min_cons, args.min_rep, 
+                    args.streaming, args.iupac, args.weighting,
+                ))
+    except BaseException: 
+        if combined_fasta is not None: 
+            combined_fasta.close()
+            partial_fasta_path.unlink()
+        raise
+
+    if combined_fasta is not None: 
+        #Keep the consensus of species that were not recomputed in this incremental run; species that
+        #are no longer in the input are dropped, and a full run rewrites the whole file
+        kept_species = {aligned_fasta_path.stem.split('_')[0] for aligned_fasta_path in kept_alignments}
+        for title, cons_seq in previous_consensus.items(): 
+            if title not in finished_species and title in kept_species: 
+                combined_fasta.write(f'>{title}\n{cons_seq}\n')
+        combined_fasta.close()
+        partial_fasta_path.replace(combined_fasta_path)
+    with open(parameters_path, 'w') as parameters_file: 
+        json.dump(consensus_parameters, parameters_file)
     print('Consensus sequences generated!')
 
+    report.close()
+    print(report.summary(args.top))
+    print(f'Run report written to {args.report_path}')
+
 if __name__ == '__main__': 
     main()
\ No newline at end of file